@@ -2,10 +2,125 @@ import numpy as np
 import healpy as hp
 import os, sys
 import foscat.backend as bk
+import foscat.template_store as TS
 from scipy.interpolate import griddata
 
 TMPFILE_VERSION='V2_6'
 
+# ---------------------------------------------−---------
+# Compute the wavelet and smoothing kernels of the nested HEALPix pixels [pix0,pix1[
+# All the pixels of the range are processed at once. The result is identical to the
+# historical computation done one pixel at a time with a healpy Rotator.
+# return iwav [npix,l_kernel**2] : neighbour indices
+#        wwav [npix,l_kernel**2] : normalized smoothing weights
+#        wav  [npix,l_kernel**2,norient] : normalized complex wavelets
+def comp_wave_chunk(nside,l_kernel,norient,pix0,pix1):
+
+    nk=l_kernel**2
+    npix=12*nside*nside
+    scale=4
+
+    pw=np.pi/4.0
+    pw2=1/2.0
+    if l_kernel==3:
+        pw=1.0
+        pw2=1.0
+    elif l_kernel==7:
+        pw=np.pi/4.0
+        pw2=1.0/3.0
+
+    aa=np.cos(np.arange(norient)/norient*np.pi).reshape(1,norient)
+    bb=np.sin(np.arange(norient)/norient*np.pi).reshape(1,norient)
+
+    k=np.arange(pix0,pix1)
+
+    # candidate neighbours : the 16 sub-pixels of the 8 neighbours of the parent pixel at nside//4
+    # they are shared by the 16 pixels of the same parent and are thus computed once per parent
+    if nside>scale*2:
+        parent=np.arange(pix0//(scale*scale),(pix1-1)//(scale*scale)+1)
+        th,ph=hp.pix2ang(nside//scale,parent,nest=True)
+        lidx=hp.get_all_neighbours(nside//scale,th,ph,nest=True).T
+        lidx=np.concatenate([lidx,np.expand_dims(parent,1)],1)
+        lidx=np.repeat(lidx*(scale*scale),(scale*scale),axis=1)+ \
+              np.tile(np.arange((scale*scale)),lidx.shape[1]).reshape(1,lidx.shape[1]*scale*scale)
+        ilidx=k//(scale*scale)-parent[0]
+    else:
+        lidx=np.arange(npix).reshape(1,npix)
+        ilidx=np.zeros([k.shape[0]],dtype='int')
+
+    # a missing neighbour gives negative indices that are wrapped as done by numpy indexing
+    x,y,z=hp.pix2vec(nside,lidx%npix,nest=True)
+    lidx=lidx[ilidx]
+    xk,yk,zk=hp.pix2vec(nside,k,nest=True)
+    delta=(x[ilidx]-np.expand_dims(xk,1))**2+(y[ilidx]-np.expand_dims(yk,1))**2+(z[ilidx]-np.expand_dims(zk,1))**2
+
+    valid=delta<(10)/(nside**2)
+    nvalid=np.sum(valid,1)
+    valid[nvalid<nk,:]=True
+
+    # keep the nk closest valid candidates (largest weights)
+    key=np.where(valid,delta,np.inf)
+    if nk<lidx.shape[1]:
+        pidx=np.argpartition(key,nk,1)
+        wlim=np.exp(-pw2*np.max(np.take_along_axis(key,pidx[:,0:nk],1),1)*(nside**2))
+        wnext=np.exp(-pw2*np.take_along_axis(key,pidx[:,nk:nk+1],1)[:,0]*(nside**2))
+        pidx=pidx[:,0:nk]
+        # equal weights straddling the selection boundary are resolved by the per-pixel sort
+        for i in np.where(wlim==wnext)[0]:
+            w=np.exp(-pw2*delta[i]*(nside**2))
+            l_pidx=np.where(valid[i])[0]
+            l_pidx=l_pidx[np.argsort(-w[l_pidx])[0:nk]]
+            pidx[i]=l_pidx
+    else:
+        pidx=np.tile(np.arange(nk),k.shape[0]).reshape(k.shape[0],nk)
+
+    iwav=np.take_along_axis(lidx,pidx,1)
+    order=np.argsort(iwav,1,kind='stable')
+    pidx=np.take_along_axis(pidx,order,1)
+    iwav=np.ascontiguousarray(np.take_along_axis(iwav,order,1))
+    wwav=np.exp(-pw2*np.take_along_axis(delta,pidx,1)*(nside**2))
+
+    # rotate the neighbours to the pole of the pixel (same matrix as hp.Rotator)
+    to,po=hp.pix2ang(nside,k,nest=True)
+    a1=(po/np.pi*180.0)*(np.pi/180.0)
+    a2=-((90+(-to)/np.pi*180.0)*(np.pi/180.0))
+    c1,s1,c2,s2=np.cos(a1),np.sin(a1),np.cos(a2),np.sin(a2)
+    mat=np.zeros([k.shape[0],3,3])
+    mat[:,0,0]=c2*c1
+    mat[:,0,1]=c2*s1
+    mat[:,0,2]=-s2
+    mat[:,1,0]=-s1
+    mat[:,1,1]=c1
+    mat[:,2,0]=s2*c1
+    mat[:,2,1]=s2*s1
+    mat[:,2,2]=c2
+
+    tn,pn=hp.pix2ang(nside,iwav%npix,nest=True)
+    st=np.sin(tn)
+    vec=np.stack([st*np.cos(pn),st*np.sin(pn),np.cos(tn)],1)
+    vec=np.matmul(mat,vec)
+    vx=np.ascontiguousarray(vec[:,0])
+    vy=np.ascontiguousarray(vec[:,1])
+    vz=np.ascontiguousarray(vec[:,2])
+    r=np.sqrt(vx**2+vy**2+vz**2)
+    ty=np.arccos(vz/r)
+    tx=np.arctan2(vy,vx)
+    ty=ty-np.pi/2
+
+    xx=np.expand_dims(pw*nside*np.pi*tx/np.cos(ty),-1)
+    yy=np.expand_dims(pw*nside*np.pi*ty,-1)
+
+    arg=xx*aa+yy*bb
+    wav=np.zeros(arg.shape,dtype='complex')
+    wav.real=np.cos(arg)*np.expand_dims(wwav,-1)
+    wav.imag=np.sin(arg)*np.expand_dims(wwav,-1)
+
+    wav=wav-np.expand_dims(np.mean(wav,1),1)
+    wav=wav/np.expand_dims(np.std(wav,1),1)
+    wwav=wwav/np.expand_dims(np.sum(wwav,1),1)
+
+    return iwav,wwav,wav
+
 class FoCUS:
     def __init__(self,
                  NORIENT=4,
@@ -29,12 +144,18 @@ class FoCUS:
                  InitWave=None,
                  silent=False,
                  mpi_size=1,
-                 mpi_rank=0):
+                 mpi_rank=0,
+                 init_nproc=1,
+                 conv_engine='sparse',
+                 nthreads=None,
+                 batch_C11=False):
 
         # P00 coeff for normalization for scat_cov
         self.TMPFILE_VERSION=TMPFILE_VERSION
         self.P1_dic = None
         self.P2_dic = None
+        # compiled eval functions (scat_cov.funct.eval_fast) keyed by the call signature
+        self.eval_comp_cache = {}
         self.isMPI=isMPI
         self.mask_thres = mask_thres
         self.mask_norm = mask_norm
@@ -44,6 +165,17 @@ class FoCUS:
         self.mpi_rank=mpi_rank
         self.return_data=return_data
         self.silent=silent
+        self.init_nproc=init_nproc
+
+        # HEALPix convolution engine :
+        # 'sparse' : sparse operator [NORIENT*Npix,Npix] applied by a sparse-dense product
+        # 'gather' : int32 neighbour table [Npix,K^2], the neighbours are gathered and combined with the weights
+        if conv_engine not in ['sparse','gather']:
+            print('conv_engine should be sparse or gather and not %s'%(conv_engine))
+            exit(0)
+        self.conv_engine=conv_engine
+        # compute all the C11 coefficients of one scale with a single contraction (scat_cov)
+        self.batch_C11=batch_C11
 
         if not silent:
             print('================================================')
@@ -98,10 +230,15 @@ class FoCUS:
             
         self.all_type=all_type
         self.BACKEND=BACKEND
+        if nthreads is None and isMPI:
+            # the cores of a node are shared by the ranks
+            ncpu=len(os.sched_getaffinity(0)) if hasattr(os,'sched_getaffinity') else os.cpu_count()
+            nthreads=max(1,ncpu//mpi_size)
         self.backend=bk.foscat_backend(BACKEND,
                                        all_type=all_type,
                                        mpi_rank=mpi_rank,
-                                       gpupos=gpupos)
+                                       gpupos=gpupos,
+                                       nthreads=nthreads)
 
         self.all_bk_type=self.backend.all_bk_type
         self.all_cbk_type=self.backend.all_cbk_type
@@ -135,6 +272,12 @@ class FoCUS:
             
         self.ww_Real  = {} 
         self.ww_Imag  = {} 
+        self.ww_Wave  = {}
+        self.ww_WaveR = {}
+        self.ww_Gather  = {}
+        self.w_smooth_down = {}
+        self.mean_mask_cache = None
+        self.wave_template = {}
         self.ww_CNN_Transpose  = {}
         self.ww_CNN  = {}
         
@@ -214,25 +357,9 @@ class FoCUS:
         self.Idx_Neighbours={}
         
         if not self.use_2D:
+            # the wavelet and smoothing operators of a given nside are computed on first use
+            # (see init_wave) or in advance with warmup
             self.w_smooth = {}
-            for i in range(nstep_max):
-                lout=(2**i)
-                self.ww_Real[lout]=None
-
-            for i in range(1,6):
-                lout=(2**i)
-                if not silent:
-                    print('Init Wave ',lout)
-                
-                if self.InitWave is None:
-                    wr,wi,ws,widx=self.init_index(lout)
-                else:
-                    wr,wi,ws,widx=self.InitWave(self,lout)
-                    
-                self.Idx_Neighbours[lout]=1 #self.backend.constant(widx)
-                self.ww_Real[lout]=wr
-                self.ww_Imag[lout]=wi
-                self.w_smooth[lout]=ws
         else:
             self.w_smooth=slope*(w_smooth/w_smooth.sum()).astype(self.all_type)
             self.ww_RealT={}
@@ -265,26 +392,6 @@ class FoCUS:
         self.remove_border={}
             
         self.ampnorm={}
-        
-        for i in range(nstep_max):
-            lout=(2**i)
-            self.pix_interp_val[lout]={}
-            self.weight_interp_val[lout]={}
-            for j in range(nstep_max):
-                lout2=(2**j)
-                self.pix_interp_val[lout][lout2]=None
-                self.weight_interp_val[lout][lout2]=None
-            self.ring2nest[lout]=None
-            self.Idx_Neighbours[lout]=None
-            self.nest2R[lout]=None
-            self.nest2R1[lout]=None
-            self.nest2R2[lout]=None
-            self.nest2R3[lout]=None
-            self.nest2R4[lout]=None
-            self.inv_nest2R[lout]=None
-            self.remove_border[lout]=None
-            self.ww_CNN_Transpose[lout]=None
-            self.ww_CNN[lout]=None
 
         self.loss={}
 
@@ -372,7 +479,7 @@ class FoCUS:
                 print('Weights channels should be equal to the input image channels')
             return -1
         
-        if self.ww_CNN_Transpose[nside] is None:
+        if nside not in self.ww_CNN_Transpose:
             self.init_CNN_index(nside,transpose=True)
             
         tmp=self.backend.bk_sparse_dense_matmul(self.ww_CNN_Transpose[nside],im)
@@ -392,7 +499,7 @@ class FoCUS:
                 print('Weights channels should be equal to the input image channels')
             return -1
         
-        if self.ww_CNN[nside] is None:
+        if nside not in self.ww_CNN:
             self.init_CNN_index(nside,transpose=False)
             
         tmp=self.backend.bk_sparse_dense_matmul(self.ww_CNN[nside],im)
@@ -417,7 +524,7 @@ class FoCUS:
     def toring(self,image,axis=0):
         lout=int(np.sqrt(image.shape[axis]//12))
         
-        if self.ring2nest[lout] is None:
+        if lout not in self.ring2nest:
             self.ring2nest[lout]=hp.ring2nest(lout,np.arange(12*lout**2))
             
         return image.numpy()[self.ring2nest[lout]]
@@ -426,8 +533,7 @@ class FoCUS:
     def ud_grade(self,im,j,axis=0):
         rim=im
         for k in range(j):
-            rim=self.smooth(rim,axis=axis)
-            rim=self.ud_grade_2(rim,axis=axis)
+            rim=self.smooth_ud_grade_2(rim,axis=axis)
         return rim
     
     #--------------------------------------------------------
@@ -539,32 +645,10 @@ class FoCUS:
 
             lout=int(np.sqrt(im.shape[axis]//12))
             
-            if self.pix_interp_val[lout][nout] is None:
-                if not self.silent:
-                    print('compute lout nout',lout,nout)
-                th,ph=hp.pix2ang(nout,np.arange(12*nout**2,dtype='int'),nest=True)
-                p, w = hp.get_interp_weights(lout,th,ph,nest=True)
-                del th
-                del ph
-                
-                indice=np.zeros([12*nout*nout*4,2],dtype='int')
-                p=p.T
-                w=w.T
-                t=np.argsort(p,1).flatten() # to make oder indices for sparsematrix computation
-                t=(t+np.repeat(np.arange(12*nout*nout)*4,4))
-                p=p.flatten()[t]
-                w=w.flatten()[t]
-                indice[:,0]=np.repeat(np.arange(12*nout**2),4)
-                indice[:,1]=p
-
-                self.pix_interp_val[lout][nout]=1
-                self.weight_interp_val[lout][nout] = self.backend.bk_SparseTensor(self.backend.constant(indice), \
-                                                                                  self.backend.constant(self.backend.bk_cast(w.flatten())), \
-                                                                                  dense_shape=[12*nout**2,12*lout**2])
-
             if lout==nout:
                 imout=im
             else:
+                l_ww=self.init_up_grade(lout,nout)
 
                 ishape=list(im.shape)
                 odata=1
@@ -575,26 +659,7 @@ class FoCUS:
                 for k in range(axis):
                     ndata=ndata*ishape[k]
                 tim=self.backend.bk_reshape(self.backend.bk_cast(im),[ndata,12*lout**2,odata])
-                if tim.dtype==self.all_cbk_type:
-                    rr=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(self.weight_interp_val[lout][nout]
-                                                                                   ,self.backend.bk_real(tim[0])),[1,12*nout**2,odata])
-                    ii=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(self.weight_interp_val[lout][nout]
-                                                                                   ,self.backend.bk_imag(tim[0])),[1,12*nout**2,odata])
-                    imout=self.backend.bk_complex(rr,ii)
-                else:
-                    imout=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(self.weight_interp_val[lout][nout]
-                                                                                    ,tim[0]),[1,12*nout**2,odata])
-
-                for k in range(1,ndata):
-                    if tim.dtype==self.all_cbk_type:
-                        rr=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(self.weight_interp_val[lout][nout]
-                                                                                       ,self.backend.bk_real(tim[k])),[1,12*nout**2,odata])
-                        ii=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(self.weight_interp_val[lout][nout]
-                                                                                       ,self.backend.bk_imag(tim[k])),[1,12*nout**2,odata])
-                        imout=self.backend.bk_concat([imout,self.backend.bk_complex(rr,ii)],0)
-                    else:
-                        imout=self.backend.bk_concat([imout,self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(self.weight_interp_val[lout][nout]
-                                                                                                                    ,tim[k]),[1,12*nout**2,odata])],0)
+                imout=self.apply_operator(l_ww,tim)
 
                 if axis==0:
                     if len(ishape)==1:
@@ -608,6 +673,27 @@ class FoCUS:
                         return self.backend.bk_reshape(imout,ishape[0:axis]+[12*nout**2]+ishape[axis+1:])
         return(imout)
 
+    # ---------------------------------------------−---------
+    # apply the real sparse operator l_ww [nout,nin] to tim [ndata,nin,odata] with a single product:
+    # the batch, the trailing dimensions and the real and imaginary parts are folded in the columns
+    def apply_operator(self,l_ww,tim):
+        ndata,nin,odata=list(tim.shape)
+        iscomplex=tim.dtype==self.all_cbk_type
+        if iscomplex:
+            tim=self.backend.bk_concat([self.backend.bk_real(tim),self.backend.bk_imag(tim)],0)
+        nd=tim.shape[0]
+        if nd>1:
+            tim=self.backend.bk_transpose(tim,[1,0,2])
+        res=self.backend.bk_sparse_dense_matmul(l_ww,self.backend.bk_reshape(tim,[nin,nd*odata]))
+        nout=res.shape[0]
+        if nd>1:
+            res=self.backend.bk_transpose(self.backend.bk_reshape(res,[nout,nd,odata]),[1,0,2])
+        else:
+            res=self.backend.bk_reshape(res,[1,nout,odata])
+        if iscomplex:
+            res=self.backend.bk_complex(res[0:ndata],res[ndata:])
+        return res
+
     #--------------------------------------------------------
     def fill_1d(self,i_arr,nullval=0):
         arr=i_arr.copy()
@@ -849,6 +935,198 @@ class FoCUS:
             res=self.up_grade_2_1d(res,axis=axis)
         return(res)
         
+    # ---------------------------------------------−---------
+    # Compute the kernels of all the pixels by chunks (see comp_wave_chunk). The chunks are
+    # distributed over the MPI ranks (if isMPI) and over init_nproc local processes.
+    def comp_wave(self,nside,l_kernel):
+        npix=12*nside*nside
+        nk=l_kernel*l_kernel
+        ncand=144 if nside>8 else npix
+        nchunk=max(1,(1<<22)//max(ncand,nk*self.NORIENT))
+        if self.init_nproc>1 or self.isMPI:
+            # smaller chunks to balance the load between the workers
+            nchunk=max(256,min(nchunk,npix//(4*self.init_nproc*self.mpi_size)))
+
+        chunks=list(range(0,npix,nchunk))
+        if self.isMPI:
+            chunks=chunks[self.mpi_rank::self.mpi_size]
+        ends=[min(k+nchunk,npix) for k in chunks]
+
+        if self.init_nproc>1 and len(chunks)>1:
+            import concurrent.futures
+            import multiprocessing
+            # fork does not re-execute the main script of the user in the workers
+            ctx=multiprocessing.get_context('fork')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.init_nproc,mp_context=ctx) as pool:
+                res=pool.map(comp_wave_chunk,[nside]*len(chunks),[l_kernel]*len(chunks),
+                             [self.NORIENT]*len(chunks),chunks,ends)
+                res=list(res)
+        else:
+            res=[]
+            for k in range(len(chunks)):
+                if not self.silent:
+                    print('Pre-compute nside=%6d %.2f%%'%(nside,100*chunks[k]/npix))
+                res.append(comp_wave_chunk(nside,l_kernel,self.NORIENT,chunks[k],ends[k]))
+
+        if self.isMPI:
+            res=self.comm.allgather(list(zip(chunks,res)))
+            res=[v for l in res for v in l]
+        else:
+            res=list(zip(chunks,res))
+
+        wav=np.zeros([npix,self.NORIENT,nk],dtype='complex')
+        wwav=np.zeros([npix,nk])
+        iwav=np.zeros([npix,nk],dtype='int')
+        for k,(l_iwav,l_wwav,l_wav) in res:
+            iwav[k:k+l_iwav.shape[0]]=l_iwav
+            wwav[k:k+l_iwav.shape[0]]=l_wwav
+            wav[k:k+l_iwav.shape[0]]=np.transpose(l_wav,[0,2,1])
+            
+        return iwav,wwav,wav
+    
+    # ---------------------------------------------−---------
+    # return the wavelet and smoothing operators of nside, they are computed on first use
+    def init_wave(self,nside):
+        if nside not in self.ww_Real:
+            if not self.silent:
+                print('Init Wave ',nside)
+            if self.InitWave is None:
+                wr,wi,ws,widx=self.init_index(nside)
+            else:
+                wr,wi,ws,widx=self.InitWave(self,nside)
+                
+            self.Idx_Neighbours[nside]=1
+            self.ww_Real[nside]=wr
+            self.ww_Imag[nside]=wi
+            self.w_smooth[nside]=ws
+            
+        return self.ww_Real[nside],self.ww_Imag[nside],self.w_smooth[nside]
+
+    # ---------------------------------------------−---------
+    # return the interpolation operator used by up_grade from lout to nout, computed on first use
+    def init_up_grade(self,lout,nout):
+        if lout not in self.weight_interp_val:
+            self.pix_interp_val[lout]={}
+            self.weight_interp_val[lout]={}
+            
+        if nout not in self.weight_interp_val[lout]:
+            # the interpolation weights are stored with the other templates
+            filename='%s/FOSCAT_%s_UP_%d_%d.tpl'%(self.TEMPLATE_PATH,TMPFILE_VERSION,lout,nout)
+            tpl=TS.read_template(filename)
+            if tpl is None:
+                if not self.silent:
+                    print('compute lout nout',lout,nout)
+                th,ph=hp.pix2ang(nout,np.arange(12*nout**2,dtype='int'),nest=True)
+                p, w = hp.get_interp_weights(lout,th,ph,nest=True)
+                del th
+                del ph
+                
+                p=p.T
+                w=w.T
+                t=np.argsort(p,1).flatten() # to make oder indices for sparsematrix computation
+                t=(t+np.repeat(np.arange(12*nout*nout)*4,4))
+                tpl={'pidx':p.flatten()[t].astype('int32'),
+                     'weight':w.flatten()[t]}
+                TS.write_template(filename,tpl,{'version':TMPFILE_VERSION,'lout':lout,'nout':nout})
+            else:
+                tpl=tpl[1]
+                
+            indice=np.zeros([12*nout*nout*4,2],dtype='int')
+            indice[:,0]=np.repeat(np.arange(12*nout**2),4)
+            indice[:,1]=tpl['pidx']
+            w=np.array(tpl['weight'])
+
+            self.pix_interp_val[lout][nout]=1
+            self.weight_interp_val[lout][nout] = self.backend.bk_SparseTensor(self.backend.constant(indice), \
+                                                                              self.backend.constant(self.backend.bk_cast(w.flatten())), \
+                                                                              dense_shape=[12*nout**2,12*lout**2])
+
+        return self.weight_interp_val[lout][nout]
+
+    # ---------------------------------------------−---------
+    # compute in advance the operators used at the given resolutions (for latency sensitive use)
+    # nsides : list of nside for the wavelet and smoothing operators
+    # interp : list of (nside_in,nside_out) for the interpolation operators of up_grade
+    def warmup(self,nsides=[],interp=[]):
+        if self.use_2D:
+            return
+        for nside in nsides:
+            self.init_wave(nside)
+        for lout,nout in interp:
+            self.init_up_grade(lout,nout)
+
+    # ---------------------------------------------−---------
+    # build the wavelet operator of nside from its template
+    # fused=True  : one complex operator [NORIENT*Npix,Npix], the neighbourhood of a pixel is read once
+    #               for the real and imaginary parts
+    # fused=False : the real and imaginary operators [NORIENT*Npix,Npix]
+    # real=True   : one real operator [2*NORIENT*Npix,Npix], the real rows followed by the imaginary ones,
+    #               applied to the real images
+    def wave_operator(self,nside,fused=True,real=False):
+        tpl=self.wave_template[nside]
+        iwav=tpl['iwav']
+        npix=12*nside*nside
+        nk=iwav.shape[1]
+
+        tmp=np.zeros([npix,self.NORIENT,nk,2],dtype='int')
+        tmp[:,:,:,0]=np.arange(npix*self.NORIENT).reshape(npix,self.NORIENT,1)
+        tmp[:,:,:,1]=np.expand_dims(iwav,1)
+        tmp=tmp.reshape(npix*self.NORIENT*nk,2)
+
+        if real:
+            tmp=np.concatenate([tmp,tmp+np.array([[npix*self.NORIENT,0]])],0)
+            w=np.concatenate([tpl['wave_real'],tpl['wave_imag']],0)
+            return self.backend.bk_SparseTensor(self.backend.constant(tmp),self.backend.constant(self.backend.bk_cast(w)),
+                                                dense_shape=[2*12*nside**2*self.NORIENT,12*nside**2])
+
+        if fused:
+            w=np.zeros([npix*self.NORIENT*nk],dtype='complex')
+            w.real=tpl['wave_real']
+            w.imag=tpl['wave_imag']
+            return self.backend.bk_SparseTensor(self.backend.constant(tmp),self.backend.constant(self.backend.bk_cast(w)),
+                                                dense_shape=[12*nside**2*self.NORIENT,12*nside**2])
+
+        wr=self.backend.bk_SparseTensor(self.backend.constant(tmp),self.backend.constant(self.backend.bk_cast(tpl['wave_real'])),dense_shape=[12*nside**2*self.NORIENT,12*nside**2])
+        wi=self.backend.bk_SparseTensor(self.backend.constant(tmp),self.backend.constant(self.backend.bk_cast(tpl['wave_imag'])),dense_shape=[12*nside**2*self.NORIENT,12*nside**2])
+        return wr,wi
+
+    # ---------------------------------------------−---------
+    # build the tables of the gather engine of nside from its template
+    # idx : int32 [Npix,K^2] neighbour table
+    # w   : [Npix,2*NORIENT,K^2] weights, the real parts of the NORIENT wavelets followed by the imaginary ones
+    def gather_operator(self,nside):
+        tpl=self.wave_template[nside]
+        iwav=tpl['iwav']
+        npix=12*nside*nside
+        nk=iwav.shape[1]
+
+        w=np.zeros([npix,2,self.NORIENT,nk])
+        w[:,0]=np.reshape(tpl['wave_real'],[npix,self.NORIENT,nk])
+        w[:,1]=np.reshape(tpl['wave_imag'],[npix,self.NORIENT,nk])
+
+        return self.backend.bk_index(iwav%npix), \
+            self.backend.constant(self.backend.bk_cast(w.reshape(npix,2*self.NORIENT,nk)))
+
+    # ---------------------------------------------−---------
+    def template_name(self,nside):
+        return '%s/FOSCAT_%s_W%d_%d_%d.tpl'%(self.TEMPLATE_PATH,TMPFILE_VERSION,self.KERNELSZ**2,self.NORIENT,nside)
+
+    # ---------------------------------------------−---------
+    # read the kernel tables stored as .npy files by the previous versions and convert them
+    def read_legacy_template(self,nside):
+        name='%s/FOSCAT_%s_W%d_%d_%d'%(self.TEMPLATE_PATH,TMPFILE_VERSION,self.KERNELSZ**2,self.NORIENT,nside)
+        try:
+            tmp2=np.load(name+'_PIDX2.npy')
+            wav=np.load(name+'_WAVE.npy')
+            wwav=np.load(name+'_SMOO.npy')
+        except:
+            return None
+        npix=12*nside*nside
+        return {'iwav':tmp2[:,1].reshape(npix,tmp2.shape[0]//npix).astype('int32'),
+                'wave_real':np.ascontiguousarray(wav.real),
+                'wave_imag':np.ascontiguousarray(wav.imag),
+                'smooth':wwav}
+    
     # ---------------------------------------------−---------
     def init_index(self,nside,kernel=-1):
 
@@ -857,107 +1135,10 @@ class FoCUS:
         else:
             l_kernel=kernel
             
-        
-        try:
-            if self.use_2D:
+        if self.use_2D:
+            try:
                 tmp=np.load('%s/W%d_%s_%d_IDX.npy'%(self.TEMPLATE_PATH,l_kernel**2,TMPFILE_VERSION,nside))
-            else:
-                tmp=np.load('%s/FOSCAT_%s_W%d_%d_%d_PIDX.npy'%(self.TEMPLATE_PATH,TMPFILE_VERSION,l_kernel**2,self.NORIENT,nside))
-        except:
-            if self.use_2D==False:
-                if self.KERNELSZ*self.KERNELSZ>12*nside*nside:
-                    l_kernel=2*nside
-                    
-                aa=np.cos(np.arange(self.NORIENT)/self.NORIENT*np.pi).reshape(1,self.NORIENT)
-                bb=np.sin(np.arange(self.NORIENT)/self.NORIENT*np.pi).reshape(1,self.NORIENT)
-                x,y,z=hp.pix2vec(nside,np.arange(12*nside*nside),nest=True)
-                to,po=hp.pix2ang(nside,np.arange(12*nside*nside),nest=True)
-
-                wav=np.zeros([12*nside*nside,l_kernel**2,self.NORIENT],dtype='complex')
-                wwav=np.zeros([12*nside*nside,l_kernel**2])
-                iwav=np.zeros([12*nside*nside,l_kernel**2],dtype='int')
-
-                scale=4
-                if nside>scale*2:
-                    th,ph=hp.pix2ang(nside//scale,np.arange(12*(nside//scale)**2),nest=True)
-                else:
-                    lidx=np.arange(12*nside*nside)
-
-                pw=np.pi/4.0
-                pw2=1/2.0
-        
-                if l_kernel==5:
-                    pw=np.pi/4.0
-                    pw2=1/2.0
-                elif l_kernel==3:
-                    pw=1.0
-                    pw2=1.0
-                elif l_kernel==7:
-                    pw=np.pi/4.0
-                    pw2=1.0/3.0
-                    
-                for k in range(12*nside*nside):
-                    if k%(nside*nside)==0:
-                        if not self.silent:
-                            print('Pre-compute nside=%6d %.2f%%'%(nside,100*k/(12*nside*nside)))
-                    if nside>scale*2:
-                        lidx=hp.get_all_neighbours(nside//scale,th[k//(scale*scale)],ph[k//(scale*scale)],nest=True)
-                        lidx=np.concatenate([lidx,np.array([(k//(scale*scale))])],0)
-                        lidx=np.repeat(lidx*(scale*scale),(scale*scale))+ \
-                              np.tile(np.arange((scale*scale)),lidx.shape[0])
-        
-                    delta=(x[lidx]-x[k])**2+(y[lidx]-y[k])**2+(z[lidx]-z[k])**2
-                    pidx=np.where(delta<(10)/(nside**2))[0]
-                    if len(pidx)<l_kernel**2:
-                        pidx=np.arange(delta.shape[0])
-                    
-                    w=np.exp(-pw2*delta[pidx]*(nside**2))
-                    pidx=pidx[np.argsort(-w)[0:l_kernel**2]]
-                    pidx=pidx[np.argsort(lidx[pidx])]
-                    
-                    w=np.exp(-pw2*delta[pidx]*(nside**2))
-                    iwav[k]=lidx[pidx]
-                    wwav[k]=w
-                    rot=[po[k]/np.pi*180.0,90+(-to[k])/np.pi*180.0]
-                    r=hp.Rotator(rot=rot)
-                    ty,tx=r(to[iwav[k]],po[iwav[k]])
-                    ty=ty-np.pi/2
-                        
-                    xx=np.expand_dims(pw*nside*np.pi*tx/np.cos(ty),-1)
-                    yy=np.expand_dims(pw*nside*np.pi*ty,-1)
-                    
-                    wav[k,:,:]=(np.cos(xx*aa+yy*bb)+complex(0.0,1.0)*np.sin(xx*aa+yy*bb))*np.expand_dims(w,-1)
-    
-                wav=wav-np.expand_dims(np.mean(wav,1),1)
-                wav=wav/np.expand_dims(np.std(wav,1),1)
-                wwav=wwav/np.expand_dims(np.sum(wwav,1),1)
-                
-                nk=l_kernel*l_kernel
-                indice=np.zeros([12*nside*nside*nk*self.NORIENT,2],dtype='int')
-                lidx=np.arange(self.NORIENT)
-                for i in range(12*nside*nside):
-                    indice[i*nk*self.NORIENT:i*nk*self.NORIENT+nk*self.NORIENT,0]=i*self.NORIENT+np.repeat(lidx,nk)
-                    indice[i*nk*self.NORIENT:i*nk*self.NORIENT+nk*self.NORIENT,1]=np.tile(iwav[i],self.NORIENT)
-
-                indice2=np.zeros([12*nside*nside*nk,2],dtype='int')
-                for i in range(12*nside*nside):
-                    indice2[i*nk:i*nk+nk,0]=i
-                    indice2[i*nk:i*nk+nk,1]=iwav[i]
-                
-                w=np.zeros([12*nside*nside,wav.shape[2],wav.shape[1]],dtype='complex')
-                for i in range(wav.shape[1]):
-                    for j in range(wav.shape[2]):
-                        w[:,j,i]=wav[:,i,j]
-                wav=w.flatten()
-                wwav=wwav.flatten()
-                
-                if not self.silent:
-                    print('Write FOSCAT_%s_W%d_%d_%d_PIDX.npy'%(TMPFILE_VERSION,self.KERNELSZ**2,self.NORIENT,nside))
-                np.save('%s/FOSCAT_%s_W%d_%d_%d_PIDX.npy'%(self.TEMPLATE_PATH,TMPFILE_VERSION,self.KERNELSZ**2,self.NORIENT,nside),indice)
-                np.save('%s/FOSCAT_%s_W%d_%d_%d_WAVE.npy'%(self.TEMPLATE_PATH,TMPFILE_VERSION,self.KERNELSZ**2,self.NORIENT,nside),wav)
-                np.save('%s/FOSCAT_%s_W%d_%d_%d_PIDX2.npy'%(self.TEMPLATE_PATH,TMPFILE_VERSION,self.KERNELSZ**2,self.NORIENT,nside),indice2)
-                np.save('%s/FOSCAT_%s_W%d_%d_%d_SMOO.npy'%(self.TEMPLATE_PATH,TMPFILE_VERSION,self.KERNELSZ**2,self.NORIENT,nside),wwav)
-            else:
+            except:
                 if l_kernel**2==9:
                     if self.rank==0:
                         self.comp_idx_w9(nside)
@@ -969,29 +1150,73 @@ class FoCUS:
                         if not self.silent:
                             print('Only 3x3 and 5x5 kernel have been developped for Healpix and you ask for %dx%d'%(KERNELSZ,KERNELSZ))
                         exit(0)
-
-        self.barrier()  
-        if self.use_2D:          
+                        
+            self.barrier()  
             tmp=np.load('%s/W%d_%s_%d_IDX.npy'%(self.TEMPLATE_PATH,l_kernel**2,TMPFILE_VERSION,nside))
+            if kernel==-1:
+                self.Idx_Neighbours[nside]=tmp
+            return tmp
+
+        filename=self.template_name(nside)
+        tpl=TS.read_template(filename)
+        if tpl is None:
+            tpl=self.read_legacy_template(nside)
+            if tpl is not None:
+                TS.write_template(filename,tpl,{'version':TMPFILE_VERSION,'KERNELSZ':self.KERNELSZ,
+                                                'NORIENT':self.NORIENT,'nside':nside})
+        else:
+            tpl=tpl[1]
+        l_missing=tpl is None
+            
+        missing=l_missing
+        if self.isMPI:
+            # all the ranks share the computation as soon as one of them misses the tables
+            missing=self.comm.allreduce(int(l_missing))>0
+
+        if missing:
+            if self.KERNELSZ*self.KERNELSZ>12*nside*nside:
+                l_kernel=2*nside
+                    
+            iwav,wwav,wav=self.comp_wave(nside,l_kernel)
+            
+            if l_missing:
+                tpl={'iwav':iwav.astype('int32'),
+                     'wave_real':np.ascontiguousarray(wav.real).flatten(),
+                     'wave_imag':np.ascontiguousarray(wav.imag).flatten(),
+                     'smooth':wwav.flatten()}
+                del wav
+                # every process lacking the tables writes them: the file is replaced atomically
+                # and has the same content, readers thus always see a complete file
+                if not self.silent:
+                    print('Write %s'%(filename))
+                TS.write_template(filename,tpl,{'version':TMPFILE_VERSION,'KERNELSZ':self.KERNELSZ,
+                                                'NORIENT':self.NORIENT,'nside':nside})
+
+        self.barrier()
+
+        self.wave_template[nside]=tpl
+        iwav=tpl['iwav']
+        npix=12*nside*nside
+        nk=iwav.shape[1]
+
+        tmp2=np.zeros([npix,nk,2],dtype='int')
+        tmp2[:,:,0]=np.arange(npix).reshape(npix,1)
+        tmp2[:,:,1]=iwav
+        tmp2=tmp2.reshape(npix*nk,2)
+
+        ws=self.slope*tpl['smooth']
+        ws=self.backend.bk_SparseTensor(self.backend.constant(tmp2),self.backend.constant(self.backend.bk_cast(ws)),dense_shape=[12*nside**2,12*nside**2])
+
+        if self.conv_engine=='gather':
+            self.ww_Gather[nside]=self.gather_operator(nside)
         else:
-            tmp=np.load('%s/FOSCAT_%s_W%d_%d_%d_PIDX.npy'%(self.TEMPLATE_PATH,TMPFILE_VERSION,self.KERNELSZ**2,self.NORIENT,nside))
-            tmp2=np.load('%s/FOSCAT_%s_W%d_%d_%d_PIDX2.npy'%(self.TEMPLATE_PATH,TMPFILE_VERSION,self.KERNELSZ**2,self.NORIENT,nside))
-            wr=np.load('%s/FOSCAT_%s_W%d_%d_%d_WAVE.npy'%(self.TEMPLATE_PATH,TMPFILE_VERSION,self.KERNELSZ**2,self.NORIENT,nside)).real
-            wi=np.load('%s/FOSCAT_%s_W%d_%d_%d_WAVE.npy'%(self.TEMPLATE_PATH,TMPFILE_VERSION,self.KERNELSZ**2,self.NORIENT,nside)).imag
-            ws=self.slope*np.load('%s/FOSCAT_%s_W%d_%d_%d_SMOO.npy'%(self.TEMPLATE_PATH,TMPFILE_VERSION,self.KERNELSZ**2,self.NORIENT,nside))
-
-            wr=self.backend.bk_SparseTensor(self.backend.constant(tmp),self.backend.constant(self.backend.bk_cast(wr)),dense_shape=[12*nside**2*self.NORIENT,12*nside**2])
-            wi=self.backend.bk_SparseTensor(self.backend.constant(tmp),self.backend.constant(self.backend.bk_cast(wi)),dense_shape=[12*nside**2*self.NORIENT,12*nside**2])
-            ws=self.backend.bk_SparseTensor(self.backend.constant(tmp2),self.backend.constant(self.backend.bk_cast(ws)),dense_shape=[12*nside**2,12*nside**2])
+            self.ww_Wave[nside]=self.wave_operator(nside)
                 
         if kernel==-1:
-            self.Idx_Neighbours[nside]=tmp
-                
-        if self.use_2D:
-            if kernel!=-1:
-                return tmp
-            
-        return wr,wi,ws,tmp
+            self.Idx_Neighbours[nside]=iwav
+
+        # the separated real and imaginary operators are only built on demand (see get_ww)
+        return None,None,ws,iwav
 
         
     # ---------------------------------------------−---------
@@ -1049,6 +1274,9 @@ class FoCUS:
         # if second level:  NORIENT[,NORIENT]= NORIENT,NORIENT
         #==========================================================================
         
+        if not self.use_2D and axis==1:
+            return self.masked_means([x],mask,calc_var=calc_var)[0]
+        
         shape=list(x.shape)
         
         if not self.use_2D:
@@ -1152,6 +1380,129 @@ class FoCUS:
             else:
                 return res
         
+    # ---------------------------------------------−---------
+    # the normalised masks are only kept during one eval (between start_mean_mask and stop_mean_mask),
+    # the masks of the different scales are keyed by their identity.
+    def start_mean_mask(self):
+        self.mean_mask_cache={}
+        
+    def stop_mean_mask(self):
+        self.mean_mask_cache=None
+        
+    # ---------------------------------------------−---------
+    # return the mask [Nmask,Npix] normalised to a unit sum and the sum of the weights [Nmask]
+    # used by the variance. They are not kept when the eval is traced (tf.function, torch.compile).
+    def mean_mask(self,mask):
+        if self.mean_mask_cache is not None and id(mask) in self.mean_mask_cache:
+            return self.mean_mask_cache[id(mask)][1:]
+        
+        vh=self.backend.bk_reduce_sum(mask,1)
+        mn=mask/self.backend.bk_expand_dims(vh,1)
+        if self.mask_norm:
+            nside=int(np.sqrt(mask.shape[1]//12))
+            vh=0*vh+12*nside*nside
+            
+        if self.mean_mask_cache is not None and not self.backend.bk_is_tracing():
+            self.mean_mask_cache[id(mask)]=(mask,mn,vh)
+        return mn,vh
+        
+    # ---------------------------------------------−---------
+    # masked mean over the pixels (axis 1) of a list of tensors [Nbatch,Npix,...] sharing the same mask [Nmask,Npix]
+    # all the tensors are reduced with a single product [Nmask,Npix]x[Npix,Ncoeff], the second moments are
+    # only computed for calc_var. Return the list of the [Nbatch,Nmask,...] means (or of the (mean,var) tuples).
+    # With use_2D the masks are [Nmask,X,Y] and masked_mean crops the border of the images, each tensor is reduced alone.
+    def masked_means(self,l_x,mask,calc_var=False):
+        if self.use_2D:
+            return [self.masked_mean(x,mask,axis=1,calc_var=calc_var) for x in l_x]
+        
+        mn,vh=self.mean_mask(mask)
+        nbatch=l_x[0].shape[0]
+        npix=l_x[0].shape[1]
+        
+        data=[]
+        ldesc=[]
+        for x in l_x:
+            shape=list(x.shape)
+            ncoeff=int(np.prod(shape[2:]))
+            x=self.backend.bk_reshape(x,[nbatch,npix,ncoeff])
+            iscomplex=self.backend.bk_is_complex(x)
+            if iscomplex:
+                data=data+[self.backend.bk_real(x),self.backend.bk_imag(x)]
+            else:
+                data=data+[x]
+            ldesc.append((shape,ncoeff,iscomplex))
+            
+        if calc_var:
+            # second moments of x*x, i.e. (a*a-b*b, 2*a*b) for complex values
+            for x,(shape,ncoeff,iscomplex) in zip(l_x,ldesc):
+                x=self.backend.bk_reshape(x,[nbatch,npix,ncoeff])
+                if iscomplex:
+                    a=self.backend.bk_real(x)
+                    b=self.backend.bk_imag(x)
+                    data=data+[a*a-b*b,2*a*b]
+                else:
+                    data=data+[x*x]
+                
+        if len(data)>1:
+            data=self.backend.bk_concat(data,2)
+        else:
+            data=data[0]
+        
+        v=self.backend.bk_einsum('mp,bpr->bmr',mn,data)
+        
+        res=[]
+        k=0
+        for shape,ncoeff,iscomplex in ldesc:
+            oshape=[nbatch,mn.shape[0]]+shape[2:]
+            if iscomplex:
+                res.append(self.backend.bk_reshape(self.backend.bk_complex(v[:,:,k:k+ncoeff],v[:,:,k+ncoeff:k+2*ncoeff]),oshape))
+                k+=2*ncoeff
+            else:
+                res.append(self.backend.bk_reshape(v[:,:,k:k+ncoeff],oshape))
+                k+=ncoeff
+                
+        if not calc_var:
+            return res
+
+        l_vh=self.backend.bk_reshape(vh,[1,vh.shape[0],1])
+        out=[]
+        for i,(shape,ncoeff,iscomplex) in enumerate(ldesc):
+            oshape=[nbatch,mn.shape[0]]+shape[2:]
+            m=self.backend.bk_reshape(res[i],[nbatch,mn.shape[0],ncoeff])
+            if iscomplex:
+                v2r=v[:,:,k:k+ncoeff]
+                v2i=v[:,:,k+ncoeff:k+2*ncoeff]
+                k+=2*ncoeff
+                vr=self.backend.bk_sqrt((v2r-self.backend.bk_real(m)*self.backend.bk_real(m))/(v2r*l_vh))
+                vi=self.backend.bk_sqrt((v2i-self.backend.bk_imag(m)*self.backend.bk_imag(m))/(v2r*l_vh))
+                out.append((res[i],self.backend.bk_reshape(self.backend.bk_complex(vr,vi),oshape)))
+            else:
+                v2=v[:,:,k:k+ncoeff]
+                k+=ncoeff
+                out.append((res[i],self.backend.bk_reshape(self.backend.bk_sqrt((v2-m*m)/l_vh),oshape)))
+        return out
+        
+    # ---------------------------------------------−---------
+    # masked mean over the pixels of the products x*conj(y) without building them:
+    # x [Nbatch,Npix,K,A], y [Nbatch,Npix,K,C] complex and mask [Nmask,Npix] give
+    # res[b,m,k,c,a] = sum_p mask_n[m,p] x[b,p,k,a] conj(y[b,p,k,c]) as a complex [Nbatch,Nmask,K,C,A]
+    # The contraction is done on the real and imaginary parts stacked in the last axis,
+    # the mask is folded in x (the smallest operand for the C01 products).
+    # With use_2D the products are built and reduced by masked_mean.
+    def masked_cross_mean(self,x,y,mask):
+        if self.use_2D:
+            return self.masked_mean(self.backend.bk_expand_dims(x,-2)*self.backend.bk_conjugate(self.backend.bk_expand_dims(y,-1)),mask,axis=1)
+        
+        mn,vh=self.mean_mask(mask)
+        na=x.shape[3]
+        nc=y.shape[3]
+        lx=self.backend.bk_concat([self.backend.bk_real(x),self.backend.bk_imag(x)],3)
+        ly=self.backend.bk_concat([self.backend.bk_real(y),self.backend.bk_imag(y)],3)
+        lx=self.backend.bk_einsum('mp,bpka->bmpka',mn,lx)
+        res=self.backend.bk_einsum('bmpka,bpkc->bmkca',lx,ly)
+        return self.backend.bk_complex(res[:,:,:,0:nc,0:na]+res[:,:,:,nc:,na:],
+                                       res[:,:,:,0:nc,na:]-res[:,:,:,nc:,0:na])
+        
     # ---------------------------------------------−---------
     # convert tensor x [....,a,b,....] to [....,a*b,....]
     def reduce_dim(self,x,axis=0):
@@ -1295,71 +1646,60 @@ class FoCUS:
         else:
             nside=int(np.sqrt(image.shape[axis]//12))
 
-            if self.Idx_Neighbours[nside] is None:
-                if self.InitWave is None:
-                    wr,wi,ws,widx=self.init_index(nside)
-                else:
-                    wr,wi,ws,widx=self.InitWave(self,nside)
-        
-                self.Idx_Neighbours[nside]=1 #self.backend.constant(tmp)
-                self.ww_Real[nside]=wr
-                self.ww_Imag[nside]=wi
-                self.w_smooth[nside]=ws
-                
-            l_ww_real=self.ww_Real[nside]
-            l_ww_imag=self.ww_Imag[nside]
+            l_ww_real,l_ww_imag,l_w_smooth=self.init_wave(nside)
             
             ishape=list(image.shape)
             odata=1
             for k in range(axis+1,len(ishape)):
                 odata=odata*ishape[k]
+                
+            ndata=1
+            for k in range(axis):
+                ndata=ndata*ishape[k]
+
+            npix=12*nside**2
             
-            if axis>0:
-                ndata=1
-                for k in range(axis):
-                    ndata=ndata*ishape[k]
-                tim=self.backend.bk_reshape(self.backend.bk_cast(image),[ndata,12*nside**2,odata])
-                if tim.dtype==self.all_cbk_type:
-                    rr1=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_real,self.backend.bk_real(tim[0])),[1,12*nside**2,self.NORIENT,odata])
-                    ii1=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_imag,self.backend.bk_real(tim[0])),[1,12*nside**2,self.NORIENT,odata])
-                    rr2=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_real,self.backend.bk_imag(tim[0])),[1,12*nside**2,self.NORIENT,odata])
-                    ii2=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_imag,self.backend.bk_imag(tim[0])),[1,12*nside**2,self.NORIENT,odata])
-                    res=self.backend.bk_complex(rr1-ii2,ii1+rr2)
-                else:
-                    rr=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_real,tim[0]),[1,12*nside**2,self.NORIENT,odata])
-                    ii=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_imag,tim[0]),[1,12*nside**2,self.NORIENT,odata])
-                    res=self.backend.bk_complex(rr,ii)
+            # the batch and the trailing dimensions are folded in the columns of a single right-hand side
+            tim=self.backend.bk_reshape(self.backend.bk_cast(image),[ndata,npix,odata])
+            if ndata>1:
+                tim=self.backend.bk_transpose(tim,[1,0,2])
+            tim=self.backend.bk_reshape(tim,[npix,ndata*odata])
+
+            l_ww=self.ww_Wave.get(nside)
+            if nside in self.ww_Gather:
+                res=self.gather_convol(self.ww_Gather[nside],tim,[npix,self.NORIENT,ndata,odata])
+            elif l_ww is not None and tim.dtype==self.all_cbk_type:
+                # complex operator: the neighbourhood is read once for the real and imaginary parts
+                res=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww,tim),[npix,self.NORIENT,ndata,odata])
+            elif l_ww is not None:
+                # real image: one real product with the real and imaginary rows of the operator
+                if nside not in self.ww_WaveR:
+                    self.ww_WaveR[nside]=self.wave_operator(nside,real=True)
+                res=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(self.ww_WaveR[nside],tim),[2,npix,self.NORIENT,ndata,odata])
+                res=self.backend.bk_complex(res[0],res[1])
+            elif tim.dtype==self.all_cbk_type:
+                tr=self.backend.bk_real(tim)
+                ti=self.backend.bk_imag(tim)
+                rr1=self.backend.bk_sparse_dense_matmul(l_ww_real,tr)
+                ii1=self.backend.bk_sparse_dense_matmul(l_ww_imag,tr)
+                rr2=self.backend.bk_sparse_dense_matmul(l_ww_real,ti)
+                ii2=self.backend.bk_sparse_dense_matmul(l_ww_imag,ti)
+                res=self.backend.bk_reshape(self.backend.bk_complex(rr1-ii2,ii1+rr2),[npix,self.NORIENT,ndata,odata])
+            else:
+                rr=self.backend.bk_sparse_dense_matmul(l_ww_real,tim)
+                ii=self.backend.bk_sparse_dense_matmul(l_ww_imag,tim)
+                res=self.backend.bk_reshape(self.backend.bk_complex(rr,ii),[npix,self.NORIENT,ndata,odata])
+
+            # the result is ordered as [ndata,npix,NORIENT,odata]
+            if ndata>1:
+                res=self.backend.bk_transpose(res,[2,0,1,3])
                 
-                for k in range(1,ndata):
-                    if tim.dtype==self.all_cbk_type:
-                        rr1=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_real,self.backend.bk_real(tim[k])),[1,12*nside**2,self.NORIENT,odata])
-                        ii1=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_imag,self.backend.bk_real(tim[k])),[1,12*nside**2,self.NORIENT,odata])
-                        rr2=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_real,self.backend.bk_imag(tim[k])),[1,12*nside**2,self.NORIENT,odata])
-                        ii2=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_imag,self.backend.bk_imag(tim[k])),[1,12*nside**2,self.NORIENT,odata])
-                        res=self.backend.bk_concat([res,self.backend.bk_complex(rr1-ii2,ii1+rr2)],0)
-                    else:
-                        rr=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_real,tim[k]),[1,12*nside**2,self.NORIENT,odata])
-                        ii=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_imag,tim[k]),[1,12*nside**2,self.NORIENT,odata])
-                        res=self.backend.bk_concat([res,self.backend.bk_complex(rr,ii)],0)
-                    
+            if axis>0:
                 if len(ishape)==axis+1:
                     return self.backend.bk_reshape(res,ishape[0:axis]+[12*nside**2,self.NORIENT])
                 else:
                     return self.backend.bk_reshape(res,ishape[0:axis]+[12*nside**2]+ishape[axis+1:]+[self.NORIENT])
-                
-            if axis==0:
-                tim=self.backend.bk_reshape(self.backend.bk_cast(image),[12*nside**2,odata])
-                if tim.dtype==self.all_cbk_type:
-                    rr1=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_real,self.backend.bk_real(tim)),[12*nside**2,self.NORIENT,odata])
-                    ii1=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_imag,self.backend.bk_real(tim)),[12*nside**2,self.NORIENT,odata])
-                    rr2=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_real,self.backend.bk_imag(tim)),[12*nside**2,self.NORIENT,odata])
-                    ii2=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_imag,self.backend.bk_imag(tim)),[12*nside**2,self.NORIENT,odata])
-                    res=self.backend.bk_complex(rr1-ii2,ii1+rr2)
-                else:
-                    rr=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_real,tim),[12*nside**2,self.NORIENT,odata])
-                    ii=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_ww_imag,tim),[12*nside**2,self.NORIENT,odata])
-                    res=self.backend.bk_complex(rr,ii)
-                
+            else:
                 if len(ishape)==1:
                     return self.backend.bk_reshape(res,[12*nside**2,self.NORIENT])
                 else:
@@ -1367,6 +1707,35 @@ class FoCUS:
         return(res)
         
 
+    # ---------------------------------------------−---------
+    # gather engine : tim [Npix,C] -> [Npix,NORIENT,C] reshaped to oshape
+    # the pixels are processed by blocks to bound the size of the gathered neighbourhoods [nblk,K^2,C]
+    def gather_convol(self,l_ww,tim,oshape):
+        idx,w=l_ww
+        npix=tim.shape[0]
+        iscomplex=tim.dtype==self.all_cbk_type
+        if iscomplex:
+            tim=self.backend.bk_concat([self.backend.bk_real(tim),self.backend.bk_imag(tim)],1)
+        ncol=tim.shape[1]
+
+        nblk=max(1,min(npix,(1<<22)//(idx.shape[1]*ncol)))
+        res=[]
+        for k in range(0,npix,nblk):
+            nb=self.backend.bk_gather(tim,idx[k:k+nblk])
+            res.append(self.backend.bk_einsum('pok,pkc->poc',w[k:k+nblk],nb))
+        if len(res)==1:
+            res=res[0]
+        else:
+            res=self.backend.bk_concat(res,0)
+
+        if iscomplex:
+            res=self.backend.bk_reshape(res,[npix,2,self.NORIENT,2,ncol//2])
+            res=self.backend.bk_complex(res[:,0,:,0]-res[:,1,:,1],res[:,1,:,0]+res[:,0,:,1])
+        else:
+            res=self.backend.bk_reshape(res,[npix,2,self.NORIENT,ncol])
+            res=self.backend.bk_complex(res[:,0],res[:,1])
+        return self.backend.bk_reshape(res,oshape)
+
     # ---------------------------------------------−---------
     def smooth(self,in_image,axis=0):
 
@@ -1416,65 +1785,75 @@ class FoCUS:
         else:
             nside=int(np.sqrt(image.shape[axis]//12))
 
-            if self.Idx_Neighbours[nside] is None:
-                
-                if self.InitWave is None:
-                    wr,wi,ws,widx=self.init_index(nside)
-                else:
-                    wr,wi,ws,widx=self.InitWave(self,nside)
-        
-                self.Idx_Neighbours[nside]=1
-                self.ww_Real[nside]=wr
-                self.ww_Imag[nside]=wi
-                self.w_smooth[nside]=ws
-
-            l_w_smooth=self.w_smooth[nside]
+            l_ww_real,l_ww_imag,l_w_smooth=self.init_wave(nside)
             ishape=list(image.shape)
             
             odata=1
             for k in range(axis+1,len(ishape)):
                 odata=odata*ishape[k]
                 
-            if axis==0:
-                tim=self.backend.bk_reshape(image,[12*nside**2,odata])
-                if tim.dtype==self.all_cbk_type:
-                    rr=self.backend.bk_sparse_dense_matmul(l_w_smooth,self.backend.bk_real(tim))
-                    ri=self.backend.bk_sparse_dense_matmul(l_w_smooth,self.backend.bk_imag(tim))
-                    res=self.backend.bk_complex(rr,ri)
-                else:
-                    res=self.backend.bk_sparse_dense_matmul(l_w_smooth,tim)
-                if len(ishape)==1:
-                    return self.backend.bk_reshape(res,[12*nside**2])
-                else:
-                    return self.backend.bk_reshape(res,[12*nside**2]+ishape[axis+1:])
-                
-            if axis>0:
-                ndata=ishape[0]
-                for k in range(1,axis):
-                    ndata=ndata*ishape[k]
-                tim=self.backend.bk_reshape(image,[ndata,12*nside**2,odata])
-                if tim.dtype==self.all_cbk_type:
-                    rr=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_w_smooth,self.backend.bk_real(tim[0])),[1,12*nside**2,odata])
-                    ri=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_w_smooth,self.backend.bk_imag(tim[0])),[1,12*nside**2,odata])
-                    res=self.backend.bk_complex(rr,ri)
-                else:
-                    res=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_w_smooth,tim[0]),[1,12*nside**2,odata])
-                    
-                for k in range(1,ndata):
-                    if tim.dtype==self.all_cbk_type:
-                        rr=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_w_smooth,self.backend.bk_real(tim[k])),[1,12*nside**2,odata])
-                        ri=self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_w_smooth,self.backend.bk_imag(tim[k])),[1,12*nside**2,odata])
-                        res=self.backend.bk_concat([res,self.backend.bk_complex(rr,ri)],0)
-                    else:
-                        res=self.backend.bk_concat([res,self.backend.bk_reshape(self.backend.bk_sparse_dense_matmul(l_w_smooth,tim[k]),[1,12*nside**2,odata])],0)
+            ndata=1
+            for k in range(axis):
+                ndata=ndata*ishape[k]
 
-                if len(ishape)==axis+1:
-                    return self.backend.bk_reshape(res,ishape[0:axis]+[12*nside**2])
-                else:
-                    return self.backend.bk_reshape(res,ishape[0:axis]+[12*nside**2]+ishape[axis+1:])
-                
+            res=self.apply_operator(l_w_smooth,self.backend.bk_reshape(image,[ndata,12*nside**2,odata]))
+            
+            return self.backend.bk_reshape(res,ishape[0:axis]+[12*nside**2]+ishape[axis+1:])
+    
+    # ---------------------------------------------−---------
+    # same as ud_grade_2(smooth(im)) : on HEALPix the smoothing and the NESTED 4 to 1 average are applied
+    # as a single operator [3*nside^2,12*nside^2], the discarded smoothed pixels are not computed
+    def smooth_ud_grade_2(self,im,axis=0):
+
+        if self.use_2D:
+            return self.ud_grade_2(self.smooth(im,axis=axis),axis=axis)
+        
+        image=self.backend.bk_cast(im)
+        nside=int(np.sqrt(image.shape[axis]//12))
+        
+        l_ww=self.init_smooth_down(nside)
+        if l_ww is None:
+            return self.ud_grade_2(self.smooth(image,axis=axis),axis=axis)
+            
+        ishape=list(image.shape)
+        odata=1
+        for k in range(axis+1,len(ishape)):
+            odata=odata*ishape[k]
                 
-        return(res)
+        ndata=1
+        for k in range(axis):
+            ndata=ndata*ishape[k]
+
+        res=self.apply_operator(l_ww,self.backend.bk_reshape(image,[ndata,12*nside**2,odata]))
+        
+        return self.backend.bk_reshape(res,ishape[0:axis]+[3*nside**2]+ishape[axis+1:])
+        
+    # ---------------------------------------------−---------
+    # return the fused smoothing and downsampling operator of nside, computed on first use
+    # (None if the smoothing operator is not built from a template, e.g. with InitWave)
+    def init_smooth_down(self,nside):
+        if nside not in self.w_smooth_down:
+            self.init_wave(nside)
+            if nside not in self.wave_template:
+                return None
+            tpl=self.wave_template[nside]
+            iwav=tpl['iwav']
+            npix=12*nside*nside
+            nk=iwav.shape[1]
+            
+            # the rows of the 4 sub-pixels are summed, the neighbourhoods overlap thus the duplicated
+            # indices are merged
+            idx=np.repeat(np.arange(npix,dtype='int64')//4,nk)*npix+iwav.flatten()
+            idx,inv=np.unique(idx,return_inverse=True)
+            w=np.bincount(inv.flatten(),weights=0.25*self.slope*np.asarray(tpl['smooth']).flatten())
+            indice=np.zeros([idx.shape[0],2],dtype='int')
+            indice[:,0]=idx//npix
+            indice[:,1]=idx%npix
+            
+            self.w_smooth_down[nside]=self.backend.bk_SparseTensor(self.backend.constant(indice),
+                                                                   self.backend.constant(self.backend.bk_cast(w)),
+                                                                   dense_shape=[npix//4,npix])
+        return self.w_smooth_down[nside]
     
     # ---------------------------------------------−---------
     def get_kernel_size(self):
@@ -1486,6 +1865,10 @@ class FoCUS:
     
     # ---------------------------------------------−---------
     def get_ww(self,nside=1):
+        if not self.use_2D:
+            self.init_wave(nside)
+            if self.ww_Real[nside] is None:
+                self.ww_Real[nside],self.ww_Imag[nside]=self.wave_operator(nside,fused=False)
         return(self.ww_Real[nside],self.ww_Imag[nside])
     
     # ---------------------------------------------−---------
@@ -7,6 +7,7 @@ from packaging import version
 from threading import Thread
 from threading import Event
 import scipy.optimize as opt
+import multiprocessing
 
 class Loss:
     
@@ -45,7 +46,8 @@ class Synthesis:
                  beta1=0.9,
                  beta2=0.999,
                  epsilon=1e-7,
-                 decay_rate = 0.999):
+                 decay_rate = 0.999,
+                 compile_loss=False):
 
         self.loss_class=loss_list
         self.number_of_loss=len(loss_list)
@@ -58,6 +60,7 @@ class Synthesis:
         self.pbeta2 = beta2
         self.epsilon = epsilon
         self.eta = eta
+        self.decay_rate = decay_rate
         self.history=np.zeros([10])
         self.curr_gpu=0
         self.event = Event()
@@ -66,6 +69,8 @@ class Synthesis:
         self.mpi_rank=self.operation.mpi_rank
         self.KEEP_TRACK=None
         self.MAXNUMLOSS=len(loss_list)
+        # local worker processes of run(nproc>1)
+        self.pool=None
     
         if self.operation.BACKEND=='tensorflow':
             import foscat.loss_backend_tens as fbk
@@ -73,7 +78,8 @@ class Synthesis:
             
         if self.operation.BACKEND=='torch':
             import foscat.loss_backend_torch as fbk
-            self.bk=fbk.loss_backend(self.operation,self.curr_gpu,self.mpi_rank)
+            # compile_loss : compile the loss functions with torch.compile (tensorflow always uses tf.function)
+            self.bk=fbk.loss_backend(self.operation,self.curr_gpu,self.mpi_rank,compile_loss=compile_loss)
             
         if self.operation.BACKEND=='numpy':
             print('Synthesis does not work with numpy. Please select Torch or Tensorflow FOSCAT backend')
@@ -144,11 +150,16 @@ class Synthesis:
         self.itt=self.itt+1
 
     # ---------------------------------------------−---------
-    def calc_grad(self,in_x):
+    # losses (backend tensors, averaged over the noise steps) and total gradient of the losses.
+    # With rank/nrank only the (noise step, loss) terms number rank modulo nrank are computed
+    # (the other losses are None), with the worker processes of run(nproc>1) the terms are
+    # computed by the workers and summed.
+    def calc_loss_grad(self,in_x,rank=0,nrank=1):
+        
+        if self.pool is not None:
+            return self.pool_loss_grad(in_x)
         
         g_tot=None
-        l_tot=0.0
-
             
         if self.do_all_noise and self.totalsz>self.batchsz:
             nstep=self.totalsz//self.batchsz
@@ -157,12 +168,41 @@ class Synthesis:
 
         x=self.operation.backend.bk_reshape(self.operation.backend.bk_cast(in_x),self.oshape)
         
-        self.l_log[self.mpi_rank*self.MAXNUMLOSS:(self.mpi_rank+1)*self.MAXNUMLOSS]=-1.0
+        l_loss=[None]*self.number_of_loss
         
         for istep in range(nstep):
             
-        
+            if self.fuse_loss:
+                if istep%nrank!=rank:
+                    continue
+                
+                # all the losses in one forward/backward pass
+                l_batch=[None if self.loss_class[k].batch is None else
+                         self.loss_class[k].batch(self.loss_class[k].batch_data,istep) for k in range(self.number_of_loss)]
+                
+                if self.KEEP_TRACK is not None:
+                    l_l,g,l_info=self.bk.loss_all(x,l_batch,self.loss_class,self.KEEP_TRACK)
+                    for linfo in l_info:
+                        self.last_info=self.KEEP_TRACK(linfo,self.mpi_rank,add=True)
+                else:
+                    l_l,g=self.bk.loss_all(x,l_batch,self.loss_class,self.KEEP_TRACK)
+                    
+                if g_tot is None:
+                    g_tot=g
+                else:
+                    g_tot=g_tot+g
+                    
+                for k in range(self.number_of_loss):
+                    if l_loss[k] is None:
+                        l_loss[k]=l_l[k]/nstep
+                    else:
+                        l_loss[k]=l_loss[k]+l_l[k]/nstep
+                continue
+            
             for k in range(self.number_of_loss):
+                if (istep*self.number_of_loss+k)%nrank!=rank:
+                    continue
+                
                 if self.loss_class[k].batch is None:
                     l_batch=None
                 else:
@@ -179,12 +219,21 @@ class Synthesis:
                 else:
                     g_tot=g_tot+g
 
-                l_tot=l_tot+l.numpy()
-
-                if self.l_log[self.mpi_rank*self.MAXNUMLOSS+k]==-1:
-                    self.l_log[self.mpi_rank*self.MAXNUMLOSS+k]=l.numpy()/nstep
+                if l_loss[k] is None:
+                    l_loss[k]=l/nstep
                 else:
-                    self.l_log[self.mpi_rank*self.MAXNUMLOSS+k]=self.l_log[self.mpi_rank*self.MAXNUMLOSS+k]+l.numpy()/nstep
+                    l_loss[k]=l_loss[k]+l/nstep
+                    
+        return l_loss,g_tot
+
+    # ---------------------------------------------−---------
+    def calc_grad(self,in_x):
+        
+        l_loss,g_tot=self.calc_loss_grad(in_x)
+        
+        self.l_log[self.mpi_rank*self.MAXNUMLOSS:(self.mpi_rank+1)*self.MAXNUMLOSS]=-1.0
+        for k in range(self.number_of_loss):
+            self.l_log[self.mpi_rank*self.MAXNUMLOSS+k]=l_loss[k].numpy()
                 
         grd_mask=self.grd_mask
             
@@ -233,6 +282,268 @@ class Synthesis:
         
         return l_tot.astype('float64'),g_tot.astype('float64')
 
+    # ---------------------------------------------−---------
+    # same as calc_grad for the optimizers working on the backend tensors (optimizer='lbfgs' or 'adam'):
+    # x and the returned gradient are flat tensors, the loss is a scalar tensor.
+    # The losses are read by the host only in sync_bk, except with MPI where the reduction
+    # between the processes is done on the host.
+    def calc_grad_bk(self,x):
+
+        bk=self.operation.backend
+
+        l_loss,g_tot=self.calc_loss_grad(x)
+
+        if self.grd_mask is not None:
+            g_tot=self.bk_grd_mask*g_tot
+
+        g_tot=bk.bk_nan_to_zero(bk.bk_flatten(g_tot))
+
+        self.imin=self.imin+self.batchsz
+
+        if self.mpi_size>1:
+            self.l_log[self.mpi_rank*self.MAXNUMLOSS:(self.mpi_rank+1)*self.MAXNUMLOSS]=-1.0
+            for k in range(self.number_of_loss):
+                self.l_log[self.mpi_rank*self.MAXNUMLOSS+k]=bk.to_numpy(l_loss[k])
+            local_log=(self.l_log).astype('float64')
+            self.ltot=np.zeros(self.l_log.shape,dtype='float64')
+            self.comm.Allreduce((local_log,self.MPI.DOUBLE),(self.ltot,self.MPI.DOUBLE))
+
+            grad=np.zeros(g_tot.shape,dtype='float64')
+            self.comm.Allreduce((bk.to_numpy(g_tot).astype('float64'),self.MPI.DOUBLE),
+                                (grad,self.MPI.DOUBLE))
+
+            self.bk_loss=None
+            return bk.bk_cast(self.ltot[self.ltot!=-1].mean()),bk.bk_cast(grad)
+
+        self.bk_loss=l_loss
+
+        return bk.bk_reduce_mean(bk.bk_stack(l_loss)),g_tot
+
+    # ---------------------------------------------−---------
+    # copy to the host the total losses of the last iterations (history) and the
+    # losses of the last call of calc_grad_bk (printed by info_back)
+    def sync_bk(self):
+
+        bk=self.operation.backend
+
+        if len(self.bk_history)>0:
+            l_hist=bk.to_numpy(bk.bk_stack(self.bk_history))
+            while self.nhist+l_hist.shape[0]>self.history.shape[0]:
+                new_log=np.zeros([self.history.shape[0]*2])
+                new_log[0:self.nhist]=self.history[0:self.nhist]
+                self.history=new_log
+            self.history[self.nhist:self.nhist+l_hist.shape[0]]=l_hist
+            self.nhist=self.nhist+l_hist.shape[0]
+            self.bk_history=[]
+
+        if self.bk_loss is not None:
+            l_loss=bk.to_numpy(bk.bk_stack(self.bk_loss))
+            self.l_log[self.mpi_rank*self.MAXNUMLOSS:(self.mpi_rank+1)*self.MAXNUMLOSS]=-1.0
+            self.l_log[self.mpi_rank*self.MAXNUMLOSS:self.mpi_rank*self.MAXNUMLOSS+self.number_of_loss]=l_loss
+            self.ltot=self.l_log
+
+    # ---------------------------------------------−---------
+    # end of an iteration of the backend optimizers, the host is synchronized every EVAL_FREQUENCY iterations
+    def info_back_bk(self,x,l):
+        self.bk_history.append(l)
+        if self.itt%self.EVAL_FREQUENCY==0:
+            self.sync_bk()
+        self.info_back(x)
+
+    # ---------------------------------------------−---------
+    # L-BFGS on the backend tensors : two-loop recursion with the last NMEM (s,y) pairs and a
+    # backtracking line search (Armijo condition). Only the scalars of the line search are read
+    # by the host at each iteration, the maps, gradients and (s,y) pairs stay on the device.
+    def run_lbfgs_bk(self,x,maxitt,factr=10.0,NMEM=10,l=None,g=None):
+
+        bk=self.operation.backend
+
+        def dot(a,b):
+            return bk.bk_reduce_sum(a*b)
+
+        def scalar(a):
+            return float(bk.to_numpy(a))
+
+        if l is None:
+            l,g=self.calc_grad_bk(x)
+        l_host=scalar(l)
+
+        l_s,l_y,l_rho=[],[],[]
+
+        for itt in range(maxitt):
+            if scalar(dot(g,g))==0:
+                # stationary point
+                break
+            
+            # two-loop recursion : d = -H g
+            q=g
+            l_alpha=[]
+            for k in range(len(l_s)-1,-1,-1):
+                alpha=l_rho[k]*dot(l_s[k],q)
+                q=q-alpha*l_y[k]
+                l_alpha.insert(0,alpha)
+            if len(l_s)>0:
+                q=q*(dot(l_s[-1],l_y[-1])/dot(l_y[-1],l_y[-1]))
+            else:
+                # first step of length 1 as in scipy
+                q=q/bk.bk_sqrt(dot(g,g))
+            for k in range(len(l_s)):
+                beta=l_rho[k]*dot(l_y[k],q)
+                q=q+(l_alpha[k]-beta)*l_s[k]
+            d=-q
+
+            gd=scalar(dot(g,d))
+            if gd>=0:
+                # not a descent direction, restart from the gradient
+                l_s,l_y,l_rho=[],[],[]
+                d=-g/bk.bk_sqrt(dot(g,g))
+                gd=scalar(dot(g,d))
+
+            step=1.0
+            for ils in range(20):
+                x_new=x+step*d
+                l_new,g_new=self.calc_grad_bk(x_new)
+                l_new_host=scalar(l_new)
+                if l_new_host<=l_host+1E-4*step*gd:
+                    break
+                step=step/2
+
+            if l_new_host>l_host:
+                # the line search failed
+                break
+
+            s=x_new-x
+            y=g_new-g
+            sy=scalar(dot(s,y))
+            if sy>1E-10:
+                l_s.append(s)
+                l_y.append(y)
+                l_rho.append(1.0/sy)
+                if len(l_s)>NMEM:
+                    l_s,l_y,l_rho=l_s[1:],l_y[1:],l_rho[1:]
+
+            dl=(l_host-l_new_host)/max(abs(l_host),abs(l_new_host),1.0)
+            x,l,g,l_host=x_new,l_new,g_new,l_new_host
+
+            self.info_back_bk(x,l)
+
+            if dl<=factr*np.finfo(float).eps:
+                break
+
+        return x
+
+    # ---------------------------------------------−---------
+    # Adam on the backend tensors (eta, beta1, beta2, epsilon and decay_rate of Synthesis, see run), the
+    # learning rate is multiplied by decay_rate every EVAL_FREQUENCY iterations. No data is read by the host except
+    # at the EVAL_FREQUENCY iterations.
+    def run_adam_bk(self,x,maxitt,l=None,g=None):
+
+        bk=self.operation.backend
+
+        if l is None:
+            l,g=self.calc_grad_bk(x)
+
+        self.m_dw=0.0*g
+        self.v_dw=0.0*g
+        self.pbeta1=self.beta1
+        self.pbeta2=self.beta2
+
+        for itt in range(maxitt):
+
+            self.m_dw=self.beta1*self.m_dw+(1-self.beta1)*g
+            self.v_dw=self.beta2*self.v_dw+(1-self.beta2)*g*g
+
+            eta=self.eta*self.decay_rate**(itt//self.EVAL_FREQUENCY)
+            x=x-eta*(self.m_dw/(1-self.pbeta1))/(bk.bk_sqrt(self.v_dw/(1-self.pbeta2))+self.epsilon)
+
+            self.pbeta1=self.pbeta1*self.beta1
+            self.pbeta2=self.pbeta2*self.beta2
+
+            l,g=self.calc_grad_bk(x)
+
+            self.info_back_bk(x,l)
+
+        return x
+
+    # ---------------------------------------------−---------
+    # Data parallel synthesis on the local CPUs without MPI : nproc worker processes are forked
+    # (they inherit the losses and their data), the (noise step, loss) terms are distributed over
+    # the workers (see calc_loss_grad). At each call the map is written in a shared memory
+    # buffer, each worker writes its losses and its gradient in its own part of two shared
+    # buffers and the parent sums them and runs the optimizer.
+    def start_pool(self,nproc):
+
+        ndata=int(np.prod(self.oshape))
+
+        ctx=multiprocessing.get_context('fork')
+
+        self.pool_x=np.frombuffer(ctx.RawArray('d',ndata),dtype='float64')
+        self.pool_l=np.frombuffer(ctx.RawArray('d',nproc*self.number_of_loss),
+                                  dtype='float64').reshape(nproc,self.number_of_loss)
+        self.pool_g=np.frombuffer(ctx.RawArray('d',nproc*ndata),dtype='float64').reshape(nproc,ndata)
+
+        self.pool=[]
+        for rank in range(nproc):
+            conn,child_conn=ctx.Pipe()
+            proc=ctx.Process(target=self.pool_worker,args=(child_conn,rank,nproc),daemon=True)
+            proc.start()
+            self.pool.append((proc,conn))
+
+    def stop_pool(self):
+        if self.pool is None:
+            return
+        for proc,conn in self.pool:
+            conn.send(None)
+        for proc,conn in self.pool:
+            proc.join()
+        self.pool=None
+
+    def pool_worker(self,conn,rank,nproc):
+
+        bk=self.operation.backend
+        self.pool=None
+        if self.operation.BACKEND=='tensorflow':
+            # the tensorflow graph functions do not run in a forked process
+            self.bk.eager=True
+
+        while True:
+            msg=conn.recv()
+            if msg is None:
+                break
+            try:
+                l_loss,g=self.calc_loss_grad(np.array(self.pool_x),rank=rank,nrank=nproc)
+                for k in range(self.number_of_loss):
+                    self.pool_l[rank,k]=0.0 if l_loss[k] is None else bk.to_numpy(l_loss[k])
+                if g is None:
+                    self.pool_g[rank]=0.0
+                else:
+                    self.pool_g[rank]=bk.to_numpy(bk.bk_flatten(g))
+                conn.send('')
+            except Exception as e:
+                conn.send('[PROC=%04d] %s'%(rank,e))
+
+        os._exit(0)
+
+    def pool_loss_grad(self,in_x):
+
+        bk=self.operation.backend
+
+        self.pool_x[:]=bk.to_numpy(bk.bk_flatten(bk.bk_cast(in_x)))
+
+        for proc,conn in self.pool:
+            conn.send(1)
+        for proc,conn in self.pool:
+            msg=conn.recv()
+            if msg!='':
+                print('Synthesis worker failed :',msg)
+                self.stop_pool()
+                exit(0)
+
+        l_loss=[bk.bk_cast(np.array(v)) for v in self.pool_l.sum(0)]
+        g_tot=bk.bk_reshape(bk.bk_cast(self.pool_g.sum(0)),self.oshape)
+
+        return l_loss,g_tot
+
     # ---------------------------------------------−---------
     def xtractmap(self,x,axis):
         x=self.operation.backend.bk_reshape(x,self.oshape)
@@ -243,12 +554,12 @@ class Synthesis:
     def run(self,
             in_x,
             NUM_EPOCHS = 100,
-            DECAY_RATE=0.95,
+            DECAY_RATE=None,
             EVAL_FREQUENCY = 100,
             DEVAL_STAT_FREQUENCY = 1000,
             NUM_STEP_BIAS = 1,
-            LEARNING_RATE = 0.03,
-            EPSILON = 1E-7,
+            LEARNING_RATE = None,
+            EPSILON = None,
             KEEP_TRACK=None,
             grd_mask=None,
             SHOWGPU=False,
@@ -257,14 +568,37 @@ class Synthesis:
             batchsz=1,
             totalsz=1,
             do_lbfgs=True,
+            optimizer='scipy',
+            fuse_loss=False,
+            nproc=1,
             axis=0):
+
+        # optimizer : 'scipy' scipy.optimize.fmin_l_bfgs_b on the host (float64 numpy arrays),
+        #             'lbfgs' or 'adam' the map and the optimizer state stay as backend tensors
+        #             (see run_lbfgs_bk and run_adam_bk), the losses are copied to the host every
+        #             EVAL_FREQUENCY iterations
+        # nproc : number of local worker processes computing the losses (see start_pool),
+        #         the optimizer runs in the calling process
+        # fuse_loss : if True all the losses are computed in one forward/backward pass (one graph
+        #             with tensorflow) instead of one pass per loss, the per-loss values are kept for the log
+        if optimizer not in ['scipy','lbfgs','adam']:
+            print('optimizer should be scipy, lbfgs or adam and not %s'%(optimizer))
+            exit(0)
+        if nproc>1 and (self.mpi_size>1 or KEEP_TRACK is not None):
+            print('Synthesis with nproc>1 does not work with MPI or KEEP_TRACK')
+            exit(0)
         
         self.KEEP_TRACK=KEEP_TRACK
+        self.fuse_loss=fuse_loss
         self.track={}
         self.ntrack=0
-        self.eta=LEARNING_RATE
-        self.epsilon=EPSILON
-        self.decay_rate = DECAY_RATE
+        # LEARNING_RATE, EPSILON and DECAY_RATE override the eta, epsilon and decay_rate of the constructor
+        if LEARNING_RATE is not None:
+            self.eta=LEARNING_RATE
+        if EPSILON is not None:
+            self.epsilon=EPSILON
+        if DECAY_RATE is not None:
+            self.decay_rate = DECAY_RATE
         self.nlog=0
         self.itt2=0
         self.batchsz=batchsz
@@ -328,10 +662,18 @@ class Synthesis:
         
         self.oshape=list(x.shape)
         
-        if not isinstance(x,np.ndarray):
-            x=x.numpy()
+        if optimizer!='scipy':
+            x=self.operation.backend.bk_flatten(self.operation.backend.bk_cast(x))
+            if grd_mask is not None:
+                self.bk_grd_mask=self.operation.backend.bk_cast(grd_mask)
+            self.bk_history=[]
+            self.bk_loss=None
+            self.nhist=0
+        else:
+            if not isinstance(x,np.ndarray):
+                x=x.numpy()
             
-        x=x.flatten()
+            x=x.flatten()
 
         self.do_all_noise=False
 
@@ -343,22 +685,35 @@ class Synthesis:
             if self.loss_class[k].batch is not None:
                 l_batch=self.loss_class[k].batch(self.loss_class[k].batch_data,0,init=True)
         
-        l_tot,g_tot=self.calc_grad(x)
+        if nproc>1:
+            self.start_pool(nproc)
+        
+        if optimizer=='scipy':
+            l_tot,g_tot=self.calc_grad(x)
 
-        self.info_back(x)
+            self.info_back(x)
+        else:
+            l_tot,g_tot=self.calc_grad_bk(x)
 
-        maxitt=NUM_EPOCHS
+            self.info_back_bk(x,l_tot)
 
-        start_x=x.copy()
+        maxitt=NUM_EPOCHS
 
         for iteration in range(NUM_STEP_BIAS):
         
-            x,l,i=opt.fmin_l_bfgs_b(self.calc_grad,
-                                    x.astype('float64'),
-                                    callback=self.info_back,
-                                    pgtol=1E-32,
-                                    factr=factr,
-                                    maxiter=maxitt)
+            if optimizer=='lbfgs':
+                x=self.run_lbfgs_bk(x,maxitt,factr=factr,l=l_tot,g=g_tot)
+            elif optimizer=='adam':
+                x=self.run_adam_bk(x,maxitt,l=l_tot,g=g_tot)
+            else:
+                x,l,i=opt.fmin_l_bfgs_b(self.calc_grad,
+                                        x.astype('float64'),
+                                        callback=self.info_back,
+                                        pgtol=1E-32,
+                                        factr=factr,
+                                        maxiter=maxitt)
+            # the next step starts from a new evaluation (the bias data change)
+            l_tot,g_tot=None,None
 
             # update bias input data
             if iteration<NUM_STEP_BIAS-1:
@@ -372,8 +727,18 @@ class Synthesis:
                         self.loss_class[k].batch_update(self.loss_class[k].batch_data,omap)
                     if self.loss_class[k].batch is not None:
                         l_batch=self.loss_class[k].batch(self.loss_class[k].batch_data,0,init=True)
+
+                # the workers get the new bias data
+                if nproc>1:
+                    self.stop_pool()
+                    self.start_pool(nproc)
                 #x=start_x.copy()
 
+        if optimizer!='scipy':
+            self.sync_bk()
+
+        self.stop_pool()
+
         if self.mpi_rank==0 and SHOWGPU:
             self.stop_synthesis()
 
@@ -385,3 +750,7 @@ class Synthesis:
 
     def get_history(self):
         return(self.history[0:self.nlog])
+
+    # number of traces of the compiled loss steps (constant once all the steps are compiled)
+    def get_ntrace(self):
+        return(self.bk.ntrace)
@@ -1,9 +1,12 @@
 import sys
+import os
+import warnings
+import concurrent.futures
 import numpy as np
 
 class foscat_backend:
     
-    def __init__(self,name,mpi_rank=0,all_type='float64',gpupos=0):
+    def __init__(self,name,mpi_rank=0,all_type='float64',gpupos=0,nthreads=None):
         
         self.TENSORFLOW=1
         self.TORCH=2
@@ -49,6 +52,12 @@ class foscat_backend:
             self.backend=np
             import scipy as scipy
             self.scipy=scipy
+
+        # number of threads used by the numpy backend for the large sparse-dense products
+        if nthreads is None:
+            nthreads=len(os.sched_getaffinity(0)) if hasattr(os,'sched_getaffinity') else os.cpu_count()
+        self.nthreads=max(1,nthreads)
+        self.thread_pool=None
             
         self.float64=self.backend.float64
         self.float32=self.backend.float32
@@ -243,18 +252,77 @@ class foscat_backend:
         if self.BACKEND==self.TENSORFLOW:
             return(self.backend.SparseTensor(indice,w,dense_shape=dense_shape))
         if self.BACKEND==self.TORCH:
-            return(self.backend.sparse_coo_tensor(indice.T,w,dense_shape))
+            # stored in CSR: the product is about 10 times faster than with a COO tensor
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                return(self.backend.sparse_coo_tensor(indice.T,w,dense_shape).coalesce().to_sparse_csr())
         if self.BACKEND==self.NUMPY:
-            return self.scipy.sparse.coo_matrix((w,(indice[:,0],indice[:,1])),shape=dense_shape)
+            # built once in CSR, a COO matrix is converted at each product
+            return self.scipy.sparse.csr_matrix((w,(indice[:,0],indice[:,1])),shape=dense_shape)
         
     def bk_sparse_dense_matmul(self,smat,mat):
         if self.BACKEND==self.TENSORFLOW:
+            # the tensorflow CPU kernel is much slower for 32 columns or more: split in column blocks
+            ncol=mat.shape[1]
+            if ncol is not None and ncol>=32:
+                return self.backend.concat([self.backend.sparse.sparse_dense_matmul(smat,mat[:,k:k+24]) \
+                                            for k in range(0,ncol,24)],1)
             return self.backend.sparse.sparse_dense_matmul(smat,mat) 
         if self.BACKEND==self.TORCH:
             return smat.matmul(mat)
         if self.BACKEND==self.NUMPY:
+            if self.nthreads>1 and len(mat.shape)==2 and smat.nnz*mat.shape[1]>=(1<<22):
+                return self.threaded_sparse_dense_matmul(smat,mat)
             return smat.dot(mat)
 
+    # numpy backend : the rows of the operator are split between threads, scipy releases the GIL
+    # during the product of each block
+    def threaded_sparse_dense_matmul(self,smat,mat):
+        smat=smat.tocsr()
+        nrow=smat.shape[0]
+        res=np.empty([nrow,mat.shape[1]],dtype=np.result_type(smat.dtype,mat.dtype))
+        # blocks with the same number of non zero values
+        bounds=np.searchsorted(smat.indptr,np.linspace(0,smat.nnz,self.nthreads+1))
+        bounds[0]=0
+        bounds[-1]=nrow
+
+        def doblock(k):
+            r0,r1=bounds[k],bounds[k+1]
+            i0,i1=smat.indptr[r0],smat.indptr[r1]
+            blk=self.scipy.sparse.csr_matrix((smat.data[i0:i1],smat.indices[i0:i1],smat.indptr[r0:r1+1]-i0),
+                                             shape=[r1-r0,smat.shape[1]])
+            res[r0:r1]=blk.dot(mat)
+
+        if self.thread_pool is None:
+            self.thread_pool=concurrent.futures.ThreadPoolExecutor(max_workers=self.nthreads)
+        list(self.thread_pool.map(doblock,range(self.nthreads)))
+        return res
+
+    # integer index table (e.g. neighbour lists) as a backend tensor
+    def bk_index(self,data):
+        data=np.ascontiguousarray(data,dtype='int32')
+        if self.BACKEND==self.TENSORFLOW:
+            return self.backend.constant(data)
+        if self.BACKEND==self.TORCH:
+            return self.backend.from_numpy(np.array(data))
+        if self.BACKEND==self.NUMPY:
+            return data
+
+    def bk_gather(self,data,indices,axis=0):
+        if self.BACKEND==self.TENSORFLOW:
+            return self.backend.gather(data,indices,axis=axis)
+        if self.BACKEND==self.TORCH:
+            if axis==0:
+                return data[indices]
+            return self.backend.index_select(data,axis,indices.flatten()).reshape(list(data.shape[0:axis])+list(indices.shape)+list(data.shape[axis+1:]))
+        if self.BACKEND==self.NUMPY:
+            return np.take(data,indices,axis=axis)
+
+    def bk_einsum(self,equation,*args):
+        if self.BACKEND==self.NUMPY:
+            return np.einsum(equation,*args,optimize=True)
+        return self.backend.einsum(equation,*args)
+
     def conv2d(self,x,w,strides=[1, 1, 1, 1],padding='SAME'):
         if self.BACKEND==self.TENSORFLOW:
                 return self.backend.nn.conv2d(x,w,
@@ -344,16 +412,25 @@ class foscat_backend:
         if self.BACKEND==self.NUMPY:
             return self.bk_cast(self.backend.image.resize(x,shape, method='bilinear'))
         
+    def bk_signed_sqrt(self,x):
+        # sign(x)*sqrt(|x|), the sqrt is not evaluated at 0 so that the gradient is 0 and not NaN there
+        if self.BACKEND==self.NUMPY:
+            return np.sign(x)*np.sqrt(np.sign(x)*x)
+        ax=self.backend.sign(x)*x
+        nz=ax>0
+        s=self.backend.sqrt(self.backend.where(nz,ax,self.backend.ones_like(ax)))
+        return self.backend.where(nz,self.backend.sign(x)*s,self.backend.zeros_like(x))
+        
     def bk_L1(self,x):
         if x.dtype==self.all_cbk_type:
             xr=self.bk_real(x)
             xi=self.bk_imag(x)
                 
-            r=self.backend.sign(xr)*self.backend.sqrt(self.backend.sign(xr)*xr)
-            i=self.backend.sign(xi)*self.backend.sqrt(self.backend.sign(xi)*xi)
+            r=self.bk_signed_sqrt(xr)
+            i=self.bk_signed_sqrt(xi)
             return self.bk_complex(r,i)
         else:
-            return self.backend.sign(x)*self.backend.sqrt(self.backend.sign(x)*x)
+            return self.bk_signed_sqrt(x)
         
     def bk_square_comp(self,x):
         if x.dtype==self.all_cbk_type:
@@ -463,10 +540,19 @@ class foscat_backend:
                 
         return self.bk_reshape(self.backend.matmul(self.bk_reshape(x,oshape),lmat),oshape2)
         
+    def to_numpy(self,data):
+        if data is None or isinstance(data,np.ndarray):
+            return data
+        if self.BACKEND==self.TORCH:
+            return data.detach().cpu().numpy()
+        return data.numpy()
+
     def constant(self,data):
         
         if self.BACKEND==self.TENSORFLOW:
             return(self.backend.constant(data))
+        if self.BACKEND==self.TORCH and hasattr(data,'detach'):
+            return(data.detach())
         return(data)
 
     def bk_reduce_mean(self,data,axis=None):
@@ -665,10 +751,18 @@ class foscat_backend:
         if self.BACKEND==self.TENSORFLOW:
             return(self.backend.transpose(data,thelist))
         if self.BACKEND==self.TORCH:
-            return(self.backend.transpose(data,thelist))
+            return(data.permute(thelist))
         if self.BACKEND==self.NUMPY:
             return(np.transpose(data,thelist))
 
+    def bk_stack(self,data,axis=0):
+        if self.BACKEND==self.TENSORFLOW:
+            return(self.backend.stack(data,axis=axis))
+        if self.BACKEND==self.TORCH:
+            return(self.backend.stack(data,dim=axis))
+        if self.BACKEND==self.NUMPY:
+            return(np.stack(data,axis=axis))
+
     def bk_concat(self,data,axis=None):
                 
         if self.BACKEND==self.TENSORFLOW or self.BACKEND==self.TORCH:
@@ -720,6 +814,22 @@ class foscat_backend:
             return self.backend.relu(x)
         if self.BACKEND==self.NUMPY:
             return (x>0)*x
+
+    def bk_nan_to_zero(self,x):
+        if self.BACKEND==self.TENSORFLOW:
+            return self.backend.where(self.backend.math.is_nan(x),self.backend.zeros_like(x),x)
+        if self.BACKEND==self.TORCH:
+            return self.backend.where(self.backend.isnan(x),self.backend.zeros_like(x),x)
+        if self.BACKEND==self.NUMPY:
+            return np.where(np.isnan(x),0,x)
+        
+    # True if the operations are traced (tf.function, torch.compile) and not executed
+    def bk_is_tracing(self):
+        if self.BACKEND==self.TENSORFLOW:
+            return not self.backend.executing_eagerly()
+        if self.BACKEND==self.TORCH:
+            return self.backend.compiler.is_compiling()
+        return False
         
     def bk_cast(self,x):
         if isinstance(x,np.float64):
@@ -743,6 +853,9 @@ class foscat_backend:
         
         if self.BACKEND==self.TORCH:
             if isinstance(x,np.ndarray):
+                if not x.flags.writeable:
+                    # torch does not support read only memory (e.g. memory mapped templates)
+                    x=np.array(x)
                 x=self.backend.from_numpy(x)
             
             if x.dtype.is_complex:
@@ -3,58 +3,133 @@ import numpy as np
 import sys
 
 class loss_backend:
-    
+
     def __init__(self,backend,curr_gpu,mpi_rank):
-        
+
         self.bk=backend
         self.curr_gpu=curr_gpu
         self.mpi_rank=mpi_rank
+        # compiled loss steps keyed by (losses, KEEP_TRACK, device, signature of x and of the batches)
+        self.comp_loss={}
+        # number of traces of the compiled loss steps, it does not change in steady state
+        self.ntrace=0
+        # if True the loss steps run in eager mode with a GradientTape (the worker processes of
+        # Synthesis.run(nproc>1) can not run tensorflow graph functions after the fork)
+        self.eager=False
+
 
-    
     def check_dense(self,data,datasz):
         if isinstance(data, tf.Tensor):
             return data
-        
+
         return data.to_dense()
-        
+
     # ---------------------------------------------−---------
-    
-    @tf.function
-    def loss(self,x,batch,loss_function,KEEP_TRACK):
+    # device of the next loss step, chosen outside of the compiled function
+    def get_device(self,operation):
+        device=operation.gpulist[(operation.gpupos+self.curr_gpu)%operation.ngpu]
+        self.curr_gpu=self.curr_gpu+1
+        return device
 
-        operation=loss_function.scat_operator
-
-        nx=1
-        if len(x.shape)>1:
-            nx=x.shape[0]
-            
-        with tf.device(operation.gpulist[(operation.gpupos+self.curr_gpu)%operation.ngpu]):
-            print('%s Run [PROC=%04d] on GPU %s'%(loss_function.name,self.mpi_rank,
-                                      operation.gpulist[(operation.gpupos+self.curr_gpu)%operation.ngpu]))
-            sys.stdout.flush()
-
-            l_x=x
-            """
-            if nx>1:
-                l_x={}
-            for i in range(nx):
-            """
-            
-            if nx==1:    
-                ndata=x.shape[0]
-            else:
-                ndata=x.shape[0]*x.shape[1]
-                
+    # ---------------------------------------------−---------
+    # TensorSpec of a (nested) batch, None if it is not only made of tensors or arrays
+    def get_spec(self,data):
+        try:
+            return tf.nest.map_structure(lambda b: tf.TensorSpec(b.shape,tf.as_dtype(b.dtype)),data)
+        except:
+            return None
+
+    # ---------------------------------------------−---------
+    def eval_losses(self,x,l_batch,l_loss_function,KEEP_TRACK):
+        l_l=[]
+        l_info=[]
+        for b,loss_function in zip(l_batch,l_loss_function):
             if KEEP_TRACK is not None:
-                l,linfo=loss_function.eval(l_x,batch,return_all=True)
+                l,linfo=loss_function.eval(x,b,return_all=True)
+                l_info.append(linfo)
             else:
-                l=loss_function.eval(l_x,batch)
-                
-            g=tf.gradients(l,x)[0]
-            g=self.check_dense(g,ndata)
-            self.curr_gpu=self.curr_gpu+1   
-            
+                l=loss_function.eval(x,b)
+            l_l.append(l)
+        return l_l,l_info
+
+    # ---------------------------------------------−---------
+    # compiled function returning the losses of l_loss_function and the gradient of their sum.
+    # The function is traced once for each key, with an explicit input_signature when the
+    # batches are tensors or arrays (the None batches are not given to the function).
+    def get_loss_step(self,x,l_batch,l_loss_function,KEEP_TRACK,device):
+
+        l_idx=[k for k in range(len(l_batch)) if l_batch[k] is not None]
+        l_spec=[self.get_spec(l_batch[k]) for k in l_idx]
+
+        key=(tuple([id(l) for l in l_loss_function]),id(KEEP_TRACK),device,
+             tuple(x.shape),x.dtype,tuple(l_idx),str(l_spec))
+
+        if key in self.comp_loss:
+            return self.comp_loss[key]
+
+        def step(x,*batch):
+            # only executed when the function is traced
+            self.ntrace=self.ntrace+1
+
+            l_b=[None]*len(l_batch)
+            for k,b in zip(l_idx,batch):
+                l_b[k]=b
+
+            with tf.device(device):
+                l_l,l_info=self.eval_losses(x,l_b,l_loss_function,KEEP_TRACK)
+
+                g=tf.gradients(tf.add_n(l_l),x)[0]
+                g=self.check_dense(g,x.shape[0])
+
+            if KEEP_TRACK is not None:
+                return l_l,g,l_info
+            return l_l,g
+
+        if None in l_spec:
+            fct=tf.function(step)
+        else:
+            fct=tf.function(step,input_signature=[tf.TensorSpec(x.shape,x.dtype)]+l_spec)
+
+        for loss_function in l_loss_function:
+            print('%s Run [PROC=%04d] on GPU %s'%(loss_function.name,self.mpi_rank,device))
+        sys.stdout.flush()
+
+        self.comp_loss[key]=fct
+        return fct
+
+    # ---------------------------------------------−---------
+    def run_step(self,x,l_batch,l_loss_function,KEEP_TRACK):
+
+        device=self.get_device(l_loss_function[0].scat_operator)
+
+        if self.eager:
+            with tf.device(device):
+                with tf.GradientTape() as tape:
+                    tape.watch(x)
+                    l_l,l_info=self.eval_losses(x,l_batch,l_loss_function,KEEP_TRACK)
+                    l_sum=tf.add_n(l_l)
+                g=self.check_dense(tape.gradient(l_sum,x),x.shape[0])
+            if KEEP_TRACK is not None:
+                return l_l,g,l_info
+            return l_l,g
+
+        fct=self.get_loss_step(x,l_batch,l_loss_function,KEEP_TRACK,device)
+
+        return fct(x,*[tf.convert_to_tensor(b) if isinstance(b,np.ndarray) else b for b in l_batch if b is not None])
+
+    # ---------------------------------------------−---------
+    def loss(self,x,batch,loss_function,KEEP_TRACK):
+
         if KEEP_TRACK is not None:
-            return l,g,linfo
+            l_l,g,l_info=self.run_step(x,[batch],[loss_function],KEEP_TRACK)
+            return l_l[0],g,l_info[0]
         else:
-            return l,g
+            l_l,g=self.run_step(x,[batch],[loss_function],KEEP_TRACK)
+            return l_l[0],g
+
+    # ---------------------------------------------−---------
+    # all the losses of l_loss_function in one graph : the losses are summed and one gradient
+    # is computed (the transforms of x shared by the losses can be computed once in the graph)
+    def loss_all(self,x,l_batch,l_loss_function,KEEP_TRACK):
+
+        return self.run_step(x,l_batch,l_loss_function,KEEP_TRACK)
@@ -1,17 +1,25 @@
 import torch
-from torch.autograd import grad
+import contextlib
 import numpy as np
 import sys
 
 class loss_backend:
-    
-    def __init__(self,backend,curr_gpu,mpi_rank):
-        
+
+    def __init__(self,backend,curr_gpu,mpi_rank,compile_loss=False):
+
         self.bk=backend
         self.curr_gpu=curr_gpu
         self.mpi_rank=mpi_rank
+        # compile the loss functions with torch.compile (one compiled function per loss)
+        self.compile_loss=compile_loss
+        self.comp_loss={}
+        # number of traces of the compiled loss steps (see Synthesis.get_ntrace),
+        # with torch the number of loss functions given to torch.compile
+        self.ntrace=0
+        # leaf tensor of the map, allocated once and updated in place at each call
+        self.x_leaf=None
+
 
-    
     def check_dense(self,data,datasz):
         if isinstance(data, torch.Tensor):
             return data
@@ -21,44 +29,91 @@ class loss_backend:
                               minlength=datasz)
         """
         return data
-        
+
     # ---------------------------------------------−---------
+    # cuda device of the next loss, nothing to select if torch runs on CPU
+    def get_device(self,operation):
+        if not torch.cuda.is_available():
+            return contextlib.nullcontext()
+        device=torch.cuda.device((operation.gpupos+self.curr_gpu)%operation.ngpu)
+        self.curr_gpu=self.curr_gpu+1
+        return device
 
-    def loss(self,x,batch,loss_function,KEEP_TRACK):
+    # ---------------------------------------------−---------
+    # copy x in the leaf tensor on which the gradients are computed
+    def get_leaf(self,x):
+        with torch.no_grad():
+            if self.x_leaf is None or self.x_leaf.shape!=x.shape or self.x_leaf.dtype!=x.dtype \
+               or self.x_leaf.device!=x.device:
+                self.x_leaf=x.detach().clone().requires_grad_(True)
+            else:
+                self.x_leaf.copy_(x)
+        self.x_leaf.grad=None
+        return self.x_leaf
 
-        operation=loss_function.scat_operator
+    # ---------------------------------------------−---------
+    def eval_loss(self,l_x,batch,loss_function,KEEP_TRACK):
 
-        nx=1
-        if len(x.shape)>1:
-            nx=x.shape[0]
+        fct=None
+        if self.compile_loss:
+            if id(loss_function) not in self.comp_loss:
+                self.comp_loss[id(loss_function)]=torch.compile(loss_function.eval,dynamic=False)
+                self.ntrace=self.ntrace+1
+            fct=self.comp_loss[id(loss_function)]
 
-        with torch.cuda.device((operation.gpupos+self.curr_gpu)%operation.ngpu):
-            #print('%s Run [PROC=%04d] on GPU %s'%(loss_function.name,self.mpi_rank,
-            #                          operation.gpulist[(operation.gpupos+self.curr_gpu)%operation.ngpu]))
-            #sys.stdout.flush()
+        if fct is not None:
+            try:
+                if KEEP_TRACK is not None:
+                    return fct(l_x,batch,return_all=True)
+                return fct(l_x,batch),None
+            except Exception as e:
+                print('%s torch.compile failed, the loss is computed in eager mode : %s'%(loss_function.name,e))
+                sys.stdout.flush()
+                self.comp_loss[id(loss_function)]=None
 
-            l_x=x.clone().detach().requires_grad_(True)
-            
-            if nx==1:    
-                ndata=x.shape[0]
-            else:
-                ndata=x.shape[0]*x.shape[1]
-                
-            if KEEP_TRACK is not None:
-                l,linfo=loss_function.eval(l_x,batch,return_all=True)
-            else:
-                l=loss_function.eval(l_x,batch)
+        if KEEP_TRACK is not None:
+            return loss_function.eval(l_x,batch,return_all=True)
+        return loss_function.eval(l_x,batch),None
+
+    # ---------------------------------------------−---------
+
+    def loss(self,x,batch,loss_function,KEEP_TRACK):
+
+        with self.get_device(loss_function.scat_operator):
+
+            l_x=self.get_leaf(x)
+
+            l,linfo=self.eval_loss(l_x,batch,loss_function,KEEP_TRACK)
 
             l.backward()
-            
+
             g=l_x.grad
 
-            print(g)
-            
-            self.curr_gpu=self.curr_gpu+1   
-            
         if KEEP_TRACK is not None:
             return l.detach(),g,linfo
         else:
             return l.detach(),g
 
+    # ---------------------------------------------−---------
+    # all the losses of l_loss_function with one backward pass on their sum
+    def loss_all(self,x,l_batch,l_loss_function,KEEP_TRACK):
+
+        with self.get_device(l_loss_function[0].scat_operator):
+
+            l_x=self.get_leaf(x)
+
+            l_l=[]
+            l_info=[]
+            for batch,loss_function in zip(l_batch,l_loss_function):
+                l,linfo=self.eval_loss(l_x,batch,loss_function,KEEP_TRACK)
+                l_l.append(l)
+                l_info.append(linfo)
+
+            sum(l_l).backward()
+
+            g=l_x.grad
+
+        if KEEP_TRACK is not None:
+            return [l.detach() for l in l_l],g,l_info
+        else:
+            return [l.detach() for l in l_l],g
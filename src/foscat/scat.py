@@ -1277,21 +1277,17 @@ class funct(FOC.FoCUS):
                 
             if j1!=jmax-1:
                 # Rescale vmask [Nmask,Npix_j1//4]   
-                vmask = self.smooth(vmask,axis=1)
-                vmask = self.ud_grade_2(vmask,axis=1)
+                vmask = self.smooth_ud_grade_2(vmask,axis=1)
                 if self.mask_thres is not None:
                     vmask = self.backend.bk_threshold(vmask,self.mask_thres)
 
                 # Rescale l2_image [....,Npix_j1//4,....,j1,Norient]   
-                l2_image = self.smooth(l2_image,axis=axis+1)
-                l2_image = self.ud_grade_2(l2_image,axis=axis+1)
+                l2_image = self.smooth_ud_grade_2(l2_image,axis=axis+1)
 
                 # Rescale l_image [....,Npix_j1//4,....]  
-                l_image1 = self.smooth(l_image1,axis=axis)
-                l_image1 = self.ud_grade_2(l_image1,axis=axis)
+                l_image1 = self.smooth_ud_grade_2(l_image1,axis=axis)
                 if cross:
-                    l_image2 = self.smooth(l_image2,axis=axis)
-                    l_image2 = self.ud_grade_2(l_image2,axis=axis)
+                    l_image2 = self.smooth_ud_grade_2(l_image2,axis=axis)
                     
         
         if len(image1.shape)==1 or (len(image1.shape)==2 and self.use_2D):
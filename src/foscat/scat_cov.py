@@ -5,6 +5,10 @@ import foscat.backend as bk
 import pickle
 import healpy as hp
 
+# names of the coefficients of a scat_cov, any of them can be None
+# (S1 for the cross statistics, C10 for the auto ones, coefficients not selected in eval)
+SC_COEFFS=['S0','P00','C01','C11','S1','C10']
+
 def read(filename):
     thescat = scat_cov(1, 1, 1, 1)
     return thescat.read(filename)
@@ -24,96 +28,18 @@ class scat_cov:
         self.idx2    = None
         
     def numpy(self):
-        if self.S1 is None:
-            s1 = None
-        else:
-            s1=self.S1.numpy()
-        if self.C10 is None:
-            c10 = None
-        else:
-            c10=self.C10.numpy()
-        
-        return scat_cov((self.S0.numpy()),
-                        (self.P00.numpy()),
-                        (self.C01.numpy()),
-                        (self.C11.numpy()),
-                        s1=s1, c10=c10,backend=self.backend)
+        return sc_apply(self.get_np, self)
         
     def constant(self):
-        
-        if self.S1 is None:
-            s1 = None
-        else:
-            s1=self.backend.constant(self.S1)
-        if self.C10 is None:
-            c10 = None
-        else:
-            c10=self.backend.constant(self.C10)
-        
-        return scat_cov(self.backend.constant(self.S0),
-                        self.backend.constant(self.P00),
-                        self.backend.constant(self.C01),
-                        self.backend.constant(self.C11),
-                        s1=s1, c10=c10,backend=self.backend)
+        return sc_apply(self.backend.constant, self)
 
     # ---------------------------------------------−---------
     def flatten(self):
-        if isinstance(self.P00,np.ndarray):
-            if self.S1 is None:
-                if self.C10 is None:
-                    return np.concatenate([self.S0.flatten(),
-                                           self.P00.flatten(),
-                                           self.C01.flatten(),
-                                           self.C11.flatten()],0)
-                else:
-                    return np.concatenate([self.S0.flatten(),
-                                           self.P00.flatten(),
-                                           self.C01.flatten(),
-                                           self.C10.flatten(),
-                                           self.C11.flatten()],0)
-            else:
-                if self.C10 is None:
-                    return np.concatenate([self.S0.flatten(),
-                                           self.S1.flatten(),
-                                           self.P00.flatten(),
-                                           self.C01.flatten(),
-                                           self.C11.flatten()],0)
-                else:
-                    return np.concatenate([self.S0.flatten(),
-                                           self.S1.flatten(),
-                                           self.P00.flatten(),
-                                           self.C01.flatten(),
-                                           self.C10.flatten(),
-                                           self.C11.flatten()],0)
-        else:
-            if self.S1 is None:
-                if self.C10 is None:
-                    return self.backend.bk_concat([self.backend.bk_flattenR(self.S0),
-                                                   self.backend.bk_flattenR(self.P00),
-                                                   self.backend.bk_flattenR(self.C01),
-                                                   self.backend.bk_flattenR(self.C11)],0)
-                else:
-                    return self.backend.bk_concat([self.backend.bk_flattenR(self.S0),
-                                                   self.backend.bk_flattenR(self.P00),
-                                                   self.backend.bk_flattenR(self.C01),
-                                                   self.backend.bk_flattenR(self.C10),
-                                                   self.backend.bk_flattenR(self.C11)],0)
-            else:
-                if self.C10 is None:
-                    return self.backend.bk_concat([self.backend.bk_flattenR(self.S0),
-                                                   self.backend.bk_flattenR(self.S1),
-                                                   self.backend.bk_flattenR(self.P00),
-                                                   self.backend.bk_flattenR(self.C01),
-                                                   self.backend.bk_flattenR(self.C11)],0)
-                else:
-                    return self.backend.bk_concat([self.backend.bk_flattenR(self.S0),
-                                                   self.backend.bk_flattenR(self.S1),
-                                                   self.backend.bk_flattenR(self.P00),
-                                                   self.backend.bk_flattenR(self.C01),
-                                                   self.backend.bk_flattenR(self.C10),
-                                                   self.backend.bk_flattenR(self.C11)],0)
+        l_x = [getattr(self, k) for k in ['S0', 'S1', 'P00', 'C01', 'C10', 'C11'] if getattr(self, k) is not None]
+        if isinstance(l_x[0], np.ndarray):
+            return np.concatenate([x.flatten() for x in l_x], 0)
+        return self.backend.bk_concat([self.backend.bk_flattenR(x) for x in l_x], 0)
 
-    # ---------------------------------------------−---------
     def flattenMask(self):
         if isinstance(self.P00,np.ndarray):
             if self.S1 is None:
@@ -297,79 +223,23 @@ class scat_cov:
                     n=n+1
         return(j1[0:n],j2[0:n],j3[0:n])
     
+    def binop(self, other, l_fct, fct):
+        # apply to each coefficient the function of l_fct (SC_COEFFS order) if other is a scat_cov,
+        # else fct with the scalar other. A coefficient missing in self or other is None.
+        if isinstance(other, scat_cov):
+            res = [None if getattr(self, k) is None or getattr(other, k) is None else \
+                   l_fct[i](getattr(self, k), getattr(other, k)) for i, k in enumerate(SC_COEFFS)]
+        else:
+            res = [None if getattr(self, k) is None else fct(getattr(self, k), other) for k in SC_COEFFS]
+        return scat_cov(res[0], res[1], res[2], res[3], s1=res[4], c10=res[5], backend=self.backend)
+
     def __add__(self, other):
         assert isinstance(other, float)  or isinstance(other, np.float32) or isinstance(other, int) or \
                isinstance(other, bool) or isinstance(other, scat_cov)
+        return self.binop(other, [self.doadd, self.doadd, lambda x, y: x + y, self.doadd, lambda x, y: x + y, self.doadd], lambda x, y: x + y)
 
-        if self.S1 is None:
-            s1 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.S1 is None:
-                    s1=None
-                else:
-                    s1 = self.S1 + other.S1
-            else:
-                s1 = self.S1 + other
-
-        if self.C10 is None:
-            c10 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.C10 is None:
-                    c10=None
-                else:
-                    c10 = self.doadd(self.C10 , other.C10)
-            else:
-                c10 = self.C10 + other
-                
-        if self.C11 is None:
-            c11 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.C11 is None:
-                    c11 = None
-                else:
-                    c11 = self.doadd(self.C11, other.C11 )
-            else:
-                c11 = self.C11+other 
-
-        if isinstance(other, scat_cov):
-            return scat_cov(self.doadd(self.S0,other.S0),
-                            self.doadd(self.P00,other.P00),
-                            (self.C01 + other.C01),
-                            c11,s1=s1, c10=c10,backend=self.backend)
-        else:
-            return scat_cov((self.S0 + other),
-                            (self.P00 + other),
-                            (self.C01 + other),
-                            c11,s1=s1, c10=c10,backend=self.backend)
-
-    
     def relu(self):
-
-        if self.S1 is None:
-            s1 = None
-        else:
-            s1 = self.backend.bk_relu(self.S1)
-
-        if self.C10 is None:
-            c10 = None
-        else:
-            c10 = self.backend.bk_relu(self.c10)
-                
-        if self.C11 is None:
-            c11 = None
-        else:
-            c11 = self.backend.bk_relu(self.c11)
-
-        return scat_cov(self.backend.bk_relu(self.S0),
-                        self.backend.bk_relu(self.P00),
-                        self.backend.bk_relu(self.C01),
-                        c11,
-                        s1=s1, 
-                        c10=c10,
-                        backend=self.backend)
+        return sc_apply(self.backend.bk_relu, self)
 
     def __radd__(self, other):
         return self.__add__(other)
@@ -377,194 +247,22 @@ class scat_cov:
     def __truediv__(self, other):
         assert isinstance(other, float)  or isinstance(other, np.float32) or isinstance(other, int) or \
                isinstance(other, bool) or isinstance(other, scat_cov)
-
-        if self.S1 is None:
-            s1 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.S1 is None:
-                    s1 = None
-                else:
-                    s1 = self.dodiv(self.S1 , other.S1)
-            else:
-                s1 = self.dodiv(self.S1 , other)
-
-        if self.C10 is None:
-            c10 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.C10 is None:
-                    c10 = None
-                else:
-                    c10 = self.dodiv(self.C10 , other.C10)
-            else:
-                c10 = self.dodiv(self.C10 , other)
-                
-        if self.C11 is None:
-            c11 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.C11 is None:
-                    c11 = None
-                else:
-                    c11 = self.dodiv(self.C11, other.C11 )
-            else:
-                c11 = self.C11/other 
-
-        if isinstance(other, scat_cov):
-            return scat_cov(self.dodiv(self.S0,other.S0),
-                            self.dodiv(self.P00,other.P00),
-                            self.dodiv(self.C01,other.C01),
-                            c11,s1=s1, c10=c10,backend=self.backend)
-        else:
-            return scat_cov((self.S0 / other),
-                            (self.P00 / other),
-                            (self.C01 / other),
-                            c11,s1=s1, c10=c10,backend=self.backend)
+        return self.binop(other, [self.dodiv, self.dodiv, self.dodiv, self.dodiv, self.dodiv, self.dodiv], lambda x, y: x / y)
 
     def __rtruediv__(self, other):
         assert isinstance(other, float)  or isinstance(other, np.float32) or isinstance(other, int) or \
                isinstance(other, bool) or isinstance(other, scat_cov)
-
-        if self.S1 is None:
-            s1 = None
-        else:
-            if isinstance(other, scat_cov):
-                s1 = other.S1 / self.S1
-            else:
-                s1 = other/self.S1
-
-        if self.C10 is None:
-            c10 = None
-        else:
-            if isinstance(other, scat_cov):
-                c10 = self.dodiv(other.C10 , self.C10)
-            else:
-                c10 = other/self.C10
-                
-        if self.C11 is None:
-            c11 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.C11 is None:
-                    c11 = None
-                else:
-                    c11 = self.dodiv( other.C11,self.C11 )
-            else:
-                c11 = other/self.C11
-
-        if isinstance(other, scat_cov):
-            return scat_cov(self.dodiv(other.S0,self.S0),
-                            self.dodiv(other.P00,self.P00),
-                            (other.C01 / self.C01),
-                            c11,s1=s1, c10=c10,backend=self.backend)
-        else:
-            return scat_cov((other/self.S0 ),
-                            (other/self.P00 ),
-                            (other/self.C01 ),
-                            (other/self.C11 ),
-                            s1=s1, c10=c10,backend=self.backend)
+        return self.binop(other, [lambda x, y: self.dodiv(y, x), lambda x, y: self.dodiv(y, x), lambda x, y: y / x, lambda x, y: self.dodiv(y, x), lambda x, y: y / x, lambda x, y: self.dodiv(y, x)], lambda x, y: y / x)
 
     def __rsub__(self, other):
-
         assert isinstance(other, float)  or isinstance(other, np.float32) or isinstance(other, int) or \
                isinstance(other, bool) or isinstance(other, scat_cov)
-
-        if self.S1 is None:
-            s1 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.S1 is None:
-                    s1 = None
-                else:
-                    s1 = other.S1 - self.S1
-            else:
-                s1 = other - self.S1
-
-        if self.C10 is None:
-            c10 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.C10 is None:
-                    c10 = None
-                else:
-                    c10 = self.domin(other.C10 , self.C10 )
-            else:
-                c10 = other - self.C10
-                
-        if self.C11 is None:
-            c11 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.C11 is None:
-                    c11 = None
-                else:
-                    c11 = self.domin( other.C11,self.C11 )
-            else:
-                c11 = other - self.C11
-
-        if isinstance(other, scat_cov):
-            return scat_cov(self.domin(other.S0,self.S0),
-                            self.domin(other.P00,self.P00),
-                            (other.C01 - self.C01),
-                            c11,s1=s1, c10=c10,
-                            backend=self.backend)
-        else:
-            return scat_cov((other-self.S0),
-                            (other-self.P00),
-                            (other-self.C01),
-                            c11,s1=s1, c10=c10,
-                            backend=self.backend)
+        return self.binop(other, [lambda x, y: self.domin(y, x), lambda x, y: self.domin(y, x), lambda x, y: y - x, lambda x, y: self.domin(y, x), lambda x, y: y - x, lambda x, y: self.domin(y, x)], lambda x, y: y - x)
         
     def __sub__(self, other):
         assert isinstance(other, float)  or isinstance(other, np.float32) or isinstance(other, int) or \
                isinstance(other, bool) or isinstance(other, scat_cov)
-
-        if self.S1 is None:
-            s1 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.S1 is None:
-                    s1 = None
-                else:
-                    s1 = self.S1 - other.S1
-            else:
-                s1 = self.S1 - other
-
-        if self.C10 is None:
-            c10 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.C10 is None:
-                    c10 = None
-                else:
-                    c10 = self.domin(self.C10 , other.C10)
-            else:
-                c10 = self.C10 - other
-                
-        if self.C11 is None:
-            c11 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.C11 is None:
-                    c11 = None
-                else:
-                    c11 = self.domin(self.C11 , other.C11)
-            else:
-                c11 = self.C11 - other
-
-        if isinstance(other, scat_cov):
-            return scat_cov(self.domin(self.S0,other.S0),
-                            self.domin(self.P00,other.P00),
-                            (self.C01 - other.C01),
-                            c11,
-                            s1=s1, c10=c10,backend=self.backend)
-        else:
-            return scat_cov((self.S0 - other),
-                            (self.P00 - other),
-                            (self.C01 - other),
-                            c11,
-                            s1=s1, c10=c10,backend=self.backend)
+        return self.binop(other, [self.domin, self.domin, lambda x, y: x - y, self.domin, lambda x, y: x - y, self.domin], lambda x, y: x - y)
         
     def domult(self,x,y):
         if x.dtype==y.dtype:
@@ -607,53 +305,7 @@ class scat_cov:
     def __mul__(self, other):
         assert isinstance(other, float)  or isinstance(other, np.float32) or isinstance(other, int) or \
                isinstance(other, bool) or isinstance(other, scat_cov)
-
-        if self.S1 is None:
-            s1 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.S1 is None:
-                    s1 = None
-                else:
-                    s1 = self.S1 * other.S1
-            else:
-                s1 = self.S1 * other
-
-        if self.C10 is None:
-            c10 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.C10 is None:
-                    c10 = None
-                else:
-                    c10 = self.domult(self.C10 , other.C10)
-            else:
-                c10 = self.C10 * other
-
-        if self.C11 is None:
-            c11 = None
-        else:
-            if isinstance(other, scat_cov):
-                if other.C11 is None:
-                    c11 = None
-                else:
-                    c11 = self.domult(self.C11 , other.C11)
-            else:
-                c11 = self.C11 * other
-
-        if isinstance(other, scat_cov):
-            return scat_cov(self.domult(self.S0,other.S0),
-                            self.domult(self.P00,other.P00),
-                            self.domult(self.C01,other.C01),
-                            c11,
-                            s1=s1, c10=c10,backend=self.backend)
-        else:
-            return scat_cov((self.S0 * other),
-                            (self.P00 * other),
-                            (self.C01 * other),
-                            c11,
-                            s1=s1, c10=c10,backend=self.backend)
-
+        return self.binop(other, [self.domult, self.domult, self.domult, self.domult, lambda x, y: x * y, self.domult], lambda x, y: x * y)
     
     def __rmul__(self, other):
         return self.__mul__(other)
@@ -1036,56 +688,14 @@ class scat_cov:
         self.idx2=self.backend.constant(idx2)
 
     def sqrt(self):
-
-        s1=None
-        c10=None
-        
-        if self.S1 is not None:
-            s1=self.backend.bk_sqrt(self.S1)
-        if self.C10 is not None:
-            c10=self.backend.bk_sqrt(self.C10)
-
-        s0=self.backend.bk_sqrt(self.S0)
-        p00=self.backend.bk_sqrt(self.P00)
-        c01=self.backend.bk_sqrt(self.C01)
-        c11=self.backend.bk_sqrt(self.C11)
-        
-        return scat_cov(s0,p00, c01, c11, s1=s1, c10=c10,backend=self.backend)
+        return sc_apply(self.backend.bk_sqrt, self)
     
     def L1(self):
-
-        s1=None
-        c10=None
-        
-        if self.S1 is not None:
-            s1=self.backend.bk_L1(self.S1)
-        if self.C10 is not None:
-            c10=self.backend.bk_L1(self.C10)
-
-        s0=self.backend.bk_L1(self.S0)
-        p00=self.backend.bk_L1(self.P00)
-        c01=self.backend.bk_L1(self.C01)
-        c11=self.backend.bk_L1(self.C11)
-        
-        return scat_cov(s0,p00, c01, c11, s1=s1, c10=c10,backend=self.backend)
+        return sc_apply(self.backend.bk_L1, self)
 
     
     def square_comp(self):
-
-        s1=None
-        c10=None
-        
-        if self.S1 is not None:
-            s1=self.backend.bk_square_comp(self.S1)
-        if self.C10 is not None:
-            c10=self.backend.bk_square_comp(self.C10)
-
-        s0=self.backend.bk_square_comp(self.S0)
-        p00=self.backend.bk_square_comp(self.P00)
-        c01=self.backend.bk_square_comp(self.C01)
-        c11=self.backend.bk_square_comp(self.C11)
-        
-        return scat_cov(s0,p00, c01, c11, s1=s1, c10=c10,backend=self.backend)
+        return sc_apply(self.backend.bk_square_comp, self)
     
     def iso_mean(self,repeat=False):
         shape=list(self.P00.shape)
@@ -1429,6 +1039,160 @@ class scat_cov:
                          (c11),
                         s1=(s1),backend=self.backend)
 
+# ---------------------------------------------−---------
+# Per-scale transforms of a constant image given by funct.prepare :
+#   conv[j3]        I * Psi_j3                     [Nbatch, Npix_j3, Norient3]
+#   M_square[j3]    |I * Psi_j3|^2 and M[j3] its modulus
+#   MconvPsi[j3]    M_j2 * Psi_j3 for all j2 <= j3 [Nbatch, Npix_j3, Norient3, (j3+1)*Norient2]
+#   MconvPsi_dic[j3][j2] the same for one j2       [Nbatch, Npix_j3, Norient3, Norient2]
+# The object is accepted by funct.eval as image1 or image2 and only the other image is transformed.
+# The transforms do not depend on the mask, they are stored as constants (no gradient).
+class scat_cov_prepared:
+    def __init__(self, shape, image, cmat=None, cmat2=None):
+        self.shape        = shape
+        self.I            = image
+        self.cmat         = cmat
+        self.cmat2        = cmat2
+        self.conv         = []
+        self.M_square     = []
+        self.M            = []
+        self.MconvPsi     = []
+        self.MconvPsi_dic = []
+
+    def append(self, conv, M_square, M, MconvPsi, MconvPsi_dic):
+        self.conv.append(conv)
+        self.M_square.append(M_square)
+        self.M.append(M)
+        self.MconvPsi.append(MconvPsi)
+        self.MconvPsi_dic.append(MconvPsi_dic)
+
+    def get_nscale(self):
+        return len(self.conv)
+
+# ---------------------------------------------−---------
+def sc_apply(fct, *l_sc):
+    # apply fct to each coefficient of the scat_cov of l_sc, a coefficient missing in one of them is None
+    res = [None if any([getattr(x, k) is None for x in l_sc]) else fct(*[getattr(x, k) for x in l_sc]) for k in SC_COEFFS]
+    return scat_cov(res[0], res[1], res[2], res[3], s1=res[4], c10=res[5], backend=l_sc[0].backend)
+
+# ---------------------------------------------−---------
+# Running mean and variance of scat_cov (Welford, updated by blocks with the
+# pairwise formula of Chan et al.).
+# The first axis of the coefficients is the sample axis: a scat_cov given by eval
+# is one sample, or Nbatch samples for a batch of images. The statistics stay in
+# the backend type and the memory does not depend on the number of samples.
+# With calc_cov the covariance of the flattened coefficients (real and imaginary
+# parts separated, see vector) is also accumulated [Ncoeff, Ncoeff].
+# Accumulators of several processes are combined with merge (an accumulator or
+# the picklable get_state of an other process) or with allreduce for MPI.
+class scat_cov_accumulator:
+    def __init__(self, backend=None, calc_cov=False):
+        self.backend  = backend
+        self.calc_cov = calc_cov
+        self.n        = 0
+        self.mean     = None  # scat_cov [1, Nmask, ...]
+        self.m2       = None  # scat_cov sum of |x - mean|^2
+        self.vmean    = None  # [Ncoeff]
+        self.vm2      = None  # [Ncoeff, Ncoeff] sum of (v - vmean)(v - vmean)^T
+
+    def update(self, x):
+        if self.backend is None:
+            self.backend = x.backend
+        backend = self.backend
+        x = sc_apply(backend.bk_cast, x)
+        nb = int(x.S0.shape[0])
+        mean = sc_apply(lambda a: backend.bk_reduce_sum(a, axis=0)[None] / nb, x)
+        m2 = sc_apply(lambda a, b: backend.bk_reduce_sum(backend.bk_square(backend.bk_abs(a - b)), axis=0)[None], x, mean)
+        vmean, vm2 = None, None
+        if self.calc_cov:
+            v = self.vector(x)
+            vmean = backend.bk_reduce_sum(v, axis=0) / nb
+            vm2 = backend.bk_einsum('ki,kj->ij', v - vmean[None], v - vmean[None])
+        self._merge(nb, mean, m2, vmean, vm2)
+        return self
+
+    def vector(self, x):
+        # flattened real vector of each sample [Nsample, Ncoeff]
+        backend = self.backend
+        nb = int(x.S0.shape[0])
+        l_v = []
+        for k in ['S0', 'S1', 'P00', 'C01', 'C10', 'C11']:
+            a = getattr(x, k)
+            if a is None:
+                continue
+            a = backend.bk_reshape(a, [nb, -1])
+            if backend.bk_is_complex(a):
+                l_v = l_v + [backend.bk_real(a), backend.bk_imag(a)]
+            else:
+                l_v.append(a)
+        return backend.bk_concat(l_v, axis=1)
+
+    def _merge(self, n, mean, m2, vmean=None, vm2=None):
+        if n == 0:
+            return
+        if self.n == 0:
+            self.n, self.mean, self.m2, self.vmean, self.vm2 = n, mean, m2, vmean, vm2
+            return
+        backend = self.backend
+        ntot = self.n + n
+        f = n / ntot
+        g = self.n * n / ntot
+        delta = sc_apply(lambda a, b: a - b, mean, self.mean)
+        self.m2 = sc_apply(lambda a, b, d: a + b + g * backend.bk_square(backend.bk_abs(d)), self.m2, m2, delta)
+        self.mean = sc_apply(lambda a, d: a + f * d, self.mean, delta)
+        if self.calc_cov:
+            dv = vmean - self.vmean
+            self.vm2 = self.vm2 + vm2 + g * backend.bk_einsum('i,j->ij', dv, dv)
+            self.vmean = self.vmean + f * dv
+        self.n = ntot
+
+    def get_state(self):
+        # picklable state (numpy arrays) to send the accumulator to an other process
+        backend = self.backend
+        if self.n == 0:
+            return (0, None, None, None, None)
+        return (self.n,
+                [backend.to_numpy(getattr(self.mean, k)) for k in SC_COEFFS],
+                [backend.to_numpy(getattr(self.m2, k)) for k in SC_COEFFS],
+                backend.to_numpy(self.vmean), backend.to_numpy(self.vm2))
+
+    def merge(self, other):
+        if isinstance(other, scat_cov_accumulator):
+            if self.backend is None:
+                self.backend = other.backend
+            other = other.get_state()
+        n, l_mean, l_m2, vmean, vm2 = other
+        if n == 0:
+            return self
+        backend = self.backend
+        def to_sc(l):
+            l = [None if a is None else backend.bk_cast(a) for a in l]
+            return scat_cov(l[0], l[1], l[2], l[3], s1=l[4], c10=l[5], backend=backend)
+        if self.calc_cov:
+            vmean, vm2 = backend.bk_cast(vmean), backend.bk_cast(vm2)
+        self._merge(n, to_sc(l_mean), to_sc(l_m2), vmean, vm2)
+        return self
+
+    def allreduce(self, comm):
+        # merge the accumulators of all the MPI ranks, each rank gets the global statistics
+        l_state = comm.allgather(self.get_state())
+        self.n, self.mean, self.m2, self.vmean, self.vm2 = 0, None, None, None, None
+        for state in l_state:
+            self.merge(state)
+        return self
+
+    def get_mean(self):
+        return self.mean
+
+    def get_var(self, ddof=0):
+        return sc_apply(lambda a: a / (self.n - ddof), self.m2)
+
+    def get_std(self, ddof=0):
+        return sc_apply(lambda a: self.backend.bk_sqrt(a / (self.n - ddof)), self.m2)
+
+    def get_cov(self, ddof=0):
+        return self.vm2 / (self.n - ddof)
+
 class funct(FOC.FoCUS):
 
     def fill(self,im,nullval=hp.UNSEEN):
@@ -1437,60 +1201,13 @@ class funct(FOC.FoCUS):
         return self.fill_healpy(im,nullval=nullval)
 
     def moments(self,list_scat):
-        S0=None
+        # mean and std (numpy) over the items of list_scat, computed on the fly
+        # each item is one sample, the result keeps the [Nbatch, ...] shape of the items
+        acc = scat_cov_accumulator(backend=self.backend)
         for k in list_scat:
-            tmp=list_scat[k]
-            nS0=np.expand_dims(tmp.S0.numpy(),0)
-            nP00=np.expand_dims(tmp.P00.numpy(),0)
-            nC01=np.expand_dims(tmp.C01.numpy(),0)
-            nC11=np.expand_dims(tmp.C11.numpy(),0)
-            if tmp.C10 is not None:
-                nC10=np.expand_dims(tmp.C10.numpy(),0)
-            if tmp.S1 is not None:
-                nS1=np.expand_dims(tmp.S1.numpy(),0)
-                
-            if S0 is None:
-                S0=nS0
-                P00=nP00
-                C01=nC01
-                C11=nC11
-                if tmp.C10 is not None:
-                    C10=nC10
-                if tmp.S1 is not None:
-                    S1=nS1
-            else:
-                S0=np.concatenate([S0,nS0],0)
-                P00=np.concatenate([P00,nP00],0)
-                C01=np.concatenate([C01,nC01],0)
-                C11=np.concatenate([C11,nC11],0)
-                if tmp.C10 is not None:
-                    C10=np.concatenate([C10,nC10],0)
-                if tmp.S1 is not None:
-                    S1=np.concatenate([S1,nS1],0)
-        sS0=np.std(S0,0)
-        sP00=np.std(P00,0)
-        sC01=np.std(C01,0)
-        sC11=np.std(C11,0)
-        mS0=np.mean(S0,0)
-        mP00=np.mean(P00,0)
-        mC01=np.mean(C01,0)
-        mC11=np.mean(C11,0)
-        if tmp.C10 is not None:
-            sC10=np.std(C10,0)
-            mC10=np.mean(C10,0)
-        else:
-            sC10=None
-            mC10=None
-            
-        if tmp.S1 is not None:
-            sS1=np.std(S1,0)
-            mS1=np.mean(S1,0)
-        else:
-            sS1=None
-            mS1=None
-            
-        return scat_cov(mS0, mP00, mC01, mC11, s1=mS1,c10=mC10,backend=self.backend), \
-            scat_cov(sS0, sP00, sC01, sC11, s1=sS1,c10=sC10,backend=self.backend)
+            acc.update(sc_apply(lambda a: a[None], list_scat[k]))
+        return sc_apply(lambda a: self.backend.to_numpy(a)[0], acc.get_mean()), \
+            sc_apply(lambda a: self.backend.to_numpy(a)[0], acc.get_std())
 
     # compute local direction to make the statistical analysis more efficient
     def stat_cfft(self,im,image2=None,upscale=False,smooth_scale=0):
@@ -1518,8 +1235,8 @@ class funct(FOC.FoCUS):
             ss=self.backend.bk_reduce_mean(sim[:,:,1]-sim[:,:,3],0)
             for m in range(smooth_scale):
                 if cc.shape[0]>12:
-                    cc=self.ud_grade_2(self.smooth(cc))
-                    ss=self.ud_grade_2(self.smooth(ss))
+                    cc=self.smooth_ud_grade_2(cc)
+                    ss=self.smooth_ud_grade_2(ss)
             if cc.shape[0]!=tmp.shape[0]:
                 ll_nside=int(np.sqrt(tmp.shape[1]//12))
                 cc=self.up_grade(cc,ll_nside)
@@ -1547,8 +1264,8 @@ class funct(FOC.FoCUS):
                 ss=self.smooth(self.backend.bk_reduce_mean(sim2[:,:,1]-sim2[:,:,3],0))
                 for m in range(smooth_scale):
                     if cc.shape[0]>12:
-                        cc=self.ud_grade_2(self.smooth(cc))
-                        ss=self.ud_grade_2(self.smooth(ss))
+                        cc=self.smooth_ud_grade_2(cc)
+                        ss=self.smooth_ud_grade_2(ss)
                 if cc.shape[0]!=sim.shape[1]:
                     ll_nside=int(np.sqrt(sim.shape[1]//12))
                     cc=self.up_grade(cc,ll_nside)
@@ -1595,7 +1312,8 @@ class funct(FOC.FoCUS):
                     tmpi2=self.ud_grade_2(tmpi2,axis=1)
         return cmat,cmat2
     
-    def eval(self, image1, image2=None, mask=None, norm=None, Auto=True, calc_var=False,cmat=None,cmat2=None):
+    def eval(self, image1, image2=None, mask=None, norm=None, Auto=True, calc_var=False,cmat=None,cmat2=None,
+             coeffs=None, scales=None):
         """
         Calculates the scattering correlations for a batch of images. Mean are done over pixels.
         mean of modulus:
@@ -1612,10 +1330,11 @@ class funct(FOC.FoCUS):
              Normalization : divide by (P00_j1 * P00_j2)^0.5
         Parameters
         ----------
-        image1: tensor
+        image1: tensor or scat_cov_prepared
             Image on which we compute the scattering coefficients [Nbatch, Npix, 1, 1]
-        image2: tensor
+        image2: tensor or scat_cov_prepared
             Second image. If not None, we compute cross-scattering covariance coefficients.
+            A scat_cov_prepared (see prepare) is not transformed again.
         mask:
         norm: None or str
             If None no normalization is applied, if 'auto' normalize by the reference P00,
@@ -1623,18 +1342,34 @@ class funct(FOC.FoCUS):
         all_cross: False or True
             If False compute all the coefficient even the Imaginary part,
             If True return only the terms computable in the auto case.
+        coeffs: None or list
+            Coefficients to compute among 'S0', 'S1', 'P00', 'C01', 'C10' and 'C11' (all if None),
+            the others are None. The modules, convolutions and downsamplings that they do not
+            need are skipped.
+        scales: None or list
+            Scales j3 for which S1, P00, C01, C10 and C11 are computed (all if None), the
+            coefficient axis then only contains these scales. The loop on scales stops at the
+            last one (except for norm='auto' without reference P00, computed at all the scales).
         Returns
         -------
         S1, P00, C01, C11 normalized
         """
         return_data=self.return_data
+        # prepared images (see prepare), their transforms are not computed again
+        prep1 = image1 if isinstance(image1, scat_cov_prepared) else None
+        prep2 = image2 if isinstance(image2, scat_cov_prepared) else None
+        for prep in [prep1, prep2]:
+            if prep is not None and (prep.cmat is not cmat or prep.cmat2 is not cmat2):
+                print('The prepared image should be computed with the cmat and cmat2 given to eval')
+                exit(0)
         # Check input consistency
         if image2 is not None:
             if list(image1.shape)!=list(image2.shape):
                 print('The two input image should have the same size to eval Scattering Covariance')
                 exit(0)
         if mask is not None:
-            if list(image1.shape)!=list(mask.shape)[1:]:
+            # the images can be a batch [Nbatch, Npix] of images
+            if list(image1.shape)[-len(mask.shape[1:]):]!=list(mask.shape)[1:]:
                 print('The mask should have the same size ',mask.shape,'than the input image ',image1.shape,'to eval Scattering Covariance')
                 exit(0)
         if self.use_2D and len(image1.shape)<2:
@@ -1650,7 +1385,6 @@ class funct(FOC.FoCUS):
             all_cross=False
 
         ### PARAMETERS
-        axis = 1
         # determine jmax and nside corresponding to the input map
         im_shape = image1.shape
         if self.use_2D:
@@ -1676,16 +1410,27 @@ class funct(FOC.FoCUS):
             J = int(np.log(nside) / np.log(2))  # Number of j scales
             
         Jmax = J - self.OSTEP  # Number of steps for the loop on scales
-        
+
+        ### COEFFICIENT SELECTION
+        if coeffs is None:
+            coeffs = SC_COEFFS
+        for k in coeffs:
+            if k not in SC_COEFFS:
+                print('Unknown coefficient',k,'the scattering covariance coefficients are',SC_COEFFS)
+                exit(0)
+        if scales is None:
+            scales = range(Jmax)
+        scales = [j3 for j3 in scales if 0 <= j3 < Jmax]
+        do_S0, do_S1, do_P00, do_C01, do_C11 = [k in coeffs for k in ['S0', 'S1', 'P00', 'C01', 'C11']]
+        do_C10 = cross and ('C10' in coeffs)
+        # the modules |I * Psi_j2| are carried through the scales only if C01, C10 or C11 use them
+        need_M1 = do_C11 or (do_C10 if cross else do_C01)
+        need_M2 = cross and (do_C11 or do_C01)
+
         ### LOCAL VARIABLES (IMAGES and MASK)
-        if len(image1.shape) == 1 or (len(image1.shape)==2 and self.use_2D):
-            I1 = self.backend.bk_cast(self.backend.bk_expand_dims(image1, 0))  # Local image1 [Nbatch, Npix]
-            if cross:
-                I2 = self.backend.bk_cast(self.backend.bk_expand_dims(image2, 0))  # Local image2 [Nbatch, Npix]
-        else:
-            I1 = self.backend.bk_cast(image1)  # Local image1 [Nbatch, Npix]
-            if cross:
-                I2 = self.backend.bk_cast(image2)  # Local image2 [Nbatch, Npix]
+        I1 = self._input_image(image1)  # Local image1 [Nbatch, Npix]
+        if cross:
+            I2 = self._input_image(image2)  # Local image2 [Nbatch, Npix]
 
         if mask is None:
             if self.use_2D:
@@ -1694,32 +1439,16 @@ class funct(FOC.FoCUS):
                 vmask = self.backend.bk_ones([1, npix], dtype=self.all_type)
         else:
             vmask = self.backend.bk_cast(mask)  # [Nmask, Npix]
+        # the normalised masks of the scales are shared by the masked means of this eval
+        self.start_mean_mask()
             
-        if self.KERNELSZ > 3:
-            # if the kernel size is bigger than 3 increase the binning before smoothing
-            if self.use_2D:
-                vmask=self.up_grade(vmask,I1.shape[axis]*2,axis=1,nouty=I1.shape[axis+1]*2)
-                I1=self.up_grade(I1,I1.shape[axis]*2,axis=axis,nouty=I1.shape[axis+1]*2)
-                if cross:
-                    I2=self.up_grade(I2,I2.shape[axis]*2,axis=axis,nouty=I2.shape[axis+1]*2)
-            else:
-                I1 = self.up_grade(I1, nside * 2, axis=axis)
-                vmask = self.up_grade(vmask, nside * 2, axis=1)
-                if cross:
-                    I2 = self.up_grade(I2, nside * 2, axis=axis)
-                    
-            if self.KERNELSZ > 5:
-                # if the kernel size is bigger than 3 increase the binning before smoothing
-                if self.use_2D:
-                    vmask=self.up_grade(vmask,I1.shape[axis]*2,axis=1,nouty=I1.shape[axis+1]*2)
-                    I1=self.up_grade(I1,I1.shape[axis]*2,axis=axis,nouty=I1.shape[axis+1]*2)
-                    if cross:
-                        I2=self.up_grade(I2,I2.shape[axis]*2,axis=axis,nouty=I2.shape[axis+1]*2)
-                else:
-                    I1 = self.up_grade(I1, nside * 4, axis=axis)
-                    vmask = self.up_grade(vmask, nside * 4, axis=1)
-                    if cross:
-                        I2 = self.up_grade(I2, nside * 4, axis=axis)
+        # if the kernel size is bigger than 3 increase the binning before smoothing
+        # (a prepared image is already at this resolution)
+        vmask = self._increase_binning(vmask, nside)
+        if prep1 is None:
+            I1 = self._increase_binning(I1, nside)
+        if cross and prep2 is None:
+            I2 = self._increase_binning(I2, nside)
 
         # Normalize the masks because they have different pixel numbers
         # vmask /= self.backend.bk_reduce_sum(vmask, axis=1)[:, None]  # [Nmask, Npix]
@@ -1727,6 +1456,10 @@ class funct(FOC.FoCUS):
         ### INITIALIZATION
         # Coefficients
         S1, P00, C01, C11, C10 = None, None, None, None, None
+        # the coefficients of each scale are collected in lists and stacked once along the
+        # coefficient axis at the end (growing a tensor with concat copies it at each scale)
+        l_S1, l_P00, l_C01, l_C11, l_C10 = [], [], [], [], []
+        l_VS1, l_VP00, l_VC01, l_VC11, l_VC10 = [], [], [], [], []
 
         # Dictionaries for C01 computation
         M1_dic = {}  # M stands for Module M1 = |I1 * Psi|
@@ -1746,14 +1479,22 @@ class funct(FOC.FoCUS):
             if cross:
                 P2_dic = self.P2_dic
 
-        if return_data:
+        # last scale of the loop, the reference P00 of norm='auto' is computed at all the scales
+        jlast = max(scales + [-1])
+        if (norm == 'auto') and (self.P1_dic is None):
+            jlast = Jmax - 1
+
+        if not do_S0:
+            s0, vs0 = None, None
+        elif return_data:
             s0=I1
         else:
             if calc_var:
                 if not cross:
                     s0,vs0 = self.masked_mean(I1,vmask,axis=1,calc_var=True)
                 else:
-                    s0,vs0 = (self.masked_mean(I1,vmask,axis=1,calc_var=True)+self.masked_mean(I2,vmask,axis=1,calc_var=True))/2
+                    (s0,vs0),(s0_2,vs0_2) = self.masked_means([I1, I2], vmask, calc_var=True)
+                    s0,vs0 = (s0+s0_2)/2,(vs0+vs0_2)/2
             else:
                 if not cross:
                     s0 = self.masked_mean(I1,vmask,axis=1)
@@ -1763,108 +1504,129 @@ class funct(FOC.FoCUS):
 
         #### COMPUTE S1, P00, C01 and C11
         nside_j3 = nside  # NSIDE start (nside_j3 = nside / 2^j3)
-        for j3 in range(Jmax):
-            if return_data:
-                if C01 is None:
-                    C01={}
-                C01[j3]=None
+        for j3 in range(jlast + 1):
+            ###### Reshape for the scale j3
+            if j3 > 0:
+                ### Image I1,
+                # downscale the I1 [Nbatch, Npix_j3]
+                if prep1 is None:
+                    I1 = self.smooth_ud_grade_2(I1, axis=1)
+
+                ### Image I2
+                if cross and prep2 is None:
+                    I2 = self.smooth_ud_grade_2(I2, axis=1)
+
+                ### Modules
+                # all the stored modules [Nbatch, Npix_j3, Norient3] are downscaled with a single product
+                # (only the ones used by the selected coefficients, those of a prepared image are not needed)
+                l_dic = []
+                if need_M1 and prep1 is None:
+                    l_dic.append(M1_dic)
+                if need_M2 and prep2 is None:
+                    l_dic.append(M2_dic)
+                if len(l_dic) > 0:
+                    l_mod = [M_dic[j2] for M_dic in l_dic for j2 in range(0, j3)]  # j2 < j3
+                    l_mod = self._smooth_ud_grade_modules(l_mod)
+                    for k, M_dic in enumerate(l_dic):
+                        for j2 in range(0, j3):
+                            M_dic[j2] = l_mod[k * j3 + j2]
+                ### Mask
+                vmask = self.ud_grade_2(vmask, axis=1)
+
+                if self.mask_thres is not None:
+                    vmask = self.backend.bk_threshold(vmask,self.mask_thres)
+
+                ### NSIDE_j3
+                nside_j3 = nside_j3 // 2
+
+            # coefficients of the scale j3, nothing is computed if the scale is not used
+            do_j3 = j3 in scales
+            if not (do_j3 or need_M1 or need_M2 or cond_init_P1_dic):
+                continue
+
+            if return_data and do_j3:
+                if do_C01:
+                    if C01 is None:
+                        C01={}
+                    C01[j3]=None
                 
-                if C10 is None:
-                    C10={}
-                C10[j3]=None
+                if do_C10:
+                    if C10 is None:
+                        C10={}
+                    C10[j3]=None
                 
-                if C11 is None:
-                    C11={}
-                C11[j3]=None
+                if do_C11:
+                    if C11 is None:
+                        C11={}
+                    C11[j3]=None
 
             ####### S1 and P00
-            ### Make the convolution I1 * Psi_j3
-            conv1 = self.convol(I1, axis=1)  # [Nbatch, Npix_j3, Norient3]
-
-            if cmat is not None:
-                tmp2=self.backend.bk_repeat(conv1,4,axis=-1)
-                conv1=self.backend.bk_reduce_sum(self.backend.bk_reshape(cmat[j3]*tmp2,[1,cmat[j3].shape[0],4,4]),2)
-                
-            ### Take the module M1 = |I1 * Psi_j3|
-            M1_square = conv1*self.backend.bk_conjugate(conv1) # [Nbatch, Npix_j3, Norient3]
-            M1 = self.backend.bk_L1(M1_square)  # [Nbatch, Npix_j3, Norient3]
+            ### Make the convolution I1 * Psi_j3 and take the module M1 = |I1 * Psi_j3|
+            if prep1 is None:
+                conv1, M1_square, M1 = self._conv_modulus(I1, j3, cmat=cmat)  # [Nbatch, Npix_j3, Norient3]
+            else:
+                conv1, M1_square, M1 = prep1.conv[j3], prep1.M_square[j3], prep1.M[j3]
             # Store M1_j3 in a dictionary
-            M1_dic[j3] = M1
+            if need_M1:
+                M1_dic[j3] = M1
 
             if not cross:  # Auto
                 M1_square=self.backend.bk_real(M1_square)
                 
                 ### P00_auto = < M1^2 >_pix
                 # Apply the mask [Nmask, Npix_j3] and average over pixels
+                # (P00 and S1 are reduced together)
                 if return_data:
                     p00=M1_square
-                else:
+                    s1=M1
+                elif (do_j3 and (do_P00 or do_S1)) or cond_init_P1_dic:
                     if calc_var:
-                        p00,vp00 = self.masked_mean(M1_square, vmask, axis=1,rank=j3,calc_var=True)
+                        (p00,vp00),(s1,vs1) = self.masked_means([M1_square, M1], vmask, calc_var=True)
                     else:
-                        p00 = self.masked_mean(M1_square, vmask, axis=1,rank=j3)
+                        p00,s1 = self.masked_means([M1_square, M1], vmask)
                 
                 if cond_init_P1_dic:
                     # We fill P1_dic with P00 for normalisation of C01 and C11
                     P1_dic[j3] = p00  # [Nbatch, Nmask, Norient3]
 
                 # We store P00_auto to return it [Nbatch, Nmask, NP00, Norient3]
-                if return_data:
-                    if P00 is None:
-                        P00={}
-                    P00[j3]=p00
-                else:
-                    if norm == 'auto':  # Normalize P00
-                        p00 /= P1_dic[j3]
-                    if P00 is None:
-                        P00 = p00[:, :, None, :]  # Add a dimension for NP00
-                        if calc_var:
-                            VP00 = vp00[:, :, None, :]  # Add a dimension for NP00
+                if do_j3 and do_P00:
+                    if return_data:
+                        if P00 is None:
+                            P00={}
+                        P00[j3]=p00
                     else:
-                        P00 = self.backend.bk_concat([P00, p00[:, :, None, :]], axis=2)
+                        if norm == 'auto':  # Normalize P00
+                            p00 = p00 / P1_dic[j3]
+                        l_P00.append(p00)
                         if calc_var:
-                            VP00 = self.backend.bk_concat([VP00, vp00[:, :, None, :]], axis=2)
+                            l_VP00.append(vp00)
 
                 #### S1_auto computation
                 ### Image 1 : S1 = < M1 >_pix
-                # Apply the mask [Nmask, Npix_j3] and average over pixels
-                if return_data:
-                    s1=M1
-                else:
-                    if calc_var:
-                        s1,vs1 = self.masked_mean(M1, vmask, axis=1,rank=j3,calc_var=True)  # [Nbatch, Nmask, Norient3]
-                    else:
-                        s1 = self.masked_mean(M1, vmask, axis=1,rank=j3)  # [Nbatch, Nmask, Norient3]
-                    
-                if return_data:
-                    if S1 is None:
-                        S1={}
-                    S1[j3]=s1
-                else:
-                    ### Normalize S1
-                    if norm is not None:
-                        s1 /= (P1_dic[j3]) ** 0.5
-                    ### We store S1 for image1  [Nbatch, Nmask, NS1, Norient3]
-                    if S1 is None:
-                        S1 = s1[:, :, None, :]  # Add a dimension for NS1
-                        if calc_var:
-                            VS1 = vs1[:, :, None, :]  # Add a dimension for NS1
+                if do_j3 and do_S1:
+                    if return_data:
+                        if S1 is None:
+                            S1={}
+                        S1[j3]=s1
                     else:
-                        S1 = self.backend.bk_concat([S1, s1[:, :, None, :]], axis=2)
+                        ### Normalize S1
+                        if norm is not None:
+                            s1 = s1 / (P1_dic[j3]) ** 0.5
+                        ### We store S1 for image1  [Nbatch, Nmask, NS1, Norient3]
+                        l_S1.append(s1)
                         if calc_var:
-                            VS1 = self.backend.bk_concat([VS1, vs1[:, :, None, :]], axis=2)
+                            l_VS1.append(vs1)
 
             else:  # Cross
-                ### Make the convolution I2 * Psi_j3
-                conv2 = self.convol(I2, axis=1)  # [Nbatch, Npix_j3, Norient3]
-                if cmat is not None:
-                    tmp2=self.backend.bk_repeat(conv2,4,axis=-1)
-                    conv2=self.backend.bk_reduce_sum(self.backend.bk_reshape(cmat[j3]*tmp2,[1,cmat[j3].shape[0],4,4]),2)
-                ### Take the module M2 = |I2 * Psi_j3|
-                M2_square = conv2*self.backend.bk_conjugate(conv2)  # [Nbatch, Npix_j3, Norient3]
-                M2 = self.backend.bk_L1(M2_square)  # [Nbatch, Npix_j3, Norient3]
+                ### Make the convolution I2 * Psi_j3 and take the module M2 = |I2 * Psi_j3|
+                if prep2 is None:
+                    conv2, M2_square, M2 = self._conv_modulus(I2, j3, cmat=cmat)  # [Nbatch, Npix_j3, Norient3]
+                else:
+                    conv2, M2_square, M2 = prep2.conv[j3], prep2.M_square[j3], prep2.M[j3]
                 # Store M2_j3 in a dictionary
-                M2_dic[j3] = M2
+                if need_M2:
+                    M2_dic[j3] = M2
 
                 ### P00_auto = < M2^2 >_pix
                 # Not returned, only for normalization
@@ -1874,95 +1636,104 @@ class funct(FOC.FoCUS):
                         p1=M1_square
                         p2=M2_square
                     else:
-                        if calc_var:
-                            p1,vp1 = self.masked_mean(M1_square, vmask, axis=1,rank=j3,calc_var=True)  # [Nbatch, Nmask, Norient3]
-                            p2,vp2 = self.masked_mean(M2_square, vmask, axis=1,rank=j3,calc_var=True)  # [Nbatch, Nmask, Norient3]
-                        else:
-                            p1 = self.masked_mean(M1_square, vmask, axis=1,rank=j3)  # [Nbatch, Nmask, Norient3]
-                            p2 = self.masked_mean(M2_square, vmask, axis=1,rank=j3)  # [Nbatch, Nmask, Norient3]
+                        # only used for the normalisation, their variance is not needed
+                        p1,p2 = self.masked_means([M1_square, M2_square], vmask)  # [Nbatch, Nmask, Norient3]
                     # We fill P1_dic with P00 for normalisation of C01 and C11
                     P1_dic[j3] = p1  # [Nbatch, Nmask, Norient3]
                     P2_dic[j3] = p2  # [Nbatch, Nmask, Norient3]
 
-                ### P00_cross = < (I1 * Psi_j3) (I2 * Psi_j3)^* >_pix
-                # z_1 x z_2^* = (a1a2 + b1b2) + i(b1a2 - a1b2)
-                p00 = conv1 * self.backend.bk_conjugate(conv2)
-                MX = self.backend.bk_L1(p00)
-                # Apply the mask [Nmask, Npix_j3] and average over pixels
-                if return_data:
-                    p00=p00
-                else:
-                    if calc_var:
-                        p00,vp00 = self.masked_mean(p00, vmask, axis=1,rank=j3,calc_var=True)
+                if do_j3 and (do_P00 or do_S1):
+                    ### P00_cross = < (I1 * Psi_j3) (I2 * Psi_j3)^* >_pix
+                    # z_1 x z_2^* = (a1a2 + b1b2) + i(b1a2 - a1b2)
+                    p00 = conv1 * self.backend.bk_conjugate(conv2)
+                    MX = self.backend.bk_L1(p00)
+                    # Apply the mask [Nmask, Npix_j3] and average over pixels
+                    # (P00 and S1 are reduced together)
+                    if return_data:
+                        s1=MX
                     else:
-                        p00 = self.masked_mean(p00, vmask, axis=1,rank=j3)
+                        if calc_var:
+                            (p00,vp00),(s1,vs1) = self.masked_means([p00, MX], vmask, calc_var=True)
+                        else:
+                            p00,s1 = self.masked_means([p00, MX], vmask)
 
-                if return_data:
-                    if P00 is None:
-                        P00={}
-                    P00[j3]=p00
-                else:
-                    ### Normalize P00_cross
-                    if norm == 'auto':
-                        p00 /= (P1_dic[j3] * P2_dic[j3])**0.5
+                if do_j3 and do_P00:
+                    if return_data:
+                        if P00 is None:
+                            P00={}
+                        P00[j3]=p00
+                    else:
+                        ### Normalize P00_cross
+                        if norm == 'auto':
+                            p00 = p00 / (P1_dic[j3] * P2_dic[j3])**0.5
 
-                    ### Store P00_cross as complex [Nbatch, Nmask, NP00, Norient3]
-                    if not all_cross:
-                        p00=self.backend.bk_real(p00)
+                        ### Store P00_cross as complex [Nbatch, Nmask, NP00, Norient3]
+                        if not all_cross:
+                            p00=self.backend.bk_real(p00)
 
-                    if P00 is None:
-                        P00 = p00[:,:,None,:]  # Add a dimension for NP00
-                        if calc_var:
-                            VP00 = vp00[:,:,None,:]  # Add a dimension for NP00
-                    else:
-                        P00 = self.backend.bk_concat([P00, p00[:,:,None,:]], axis=2)
+                        l_P00.append(p00)
                         if calc_var:
-                            VP00 = self.backend.bk_concat([VP00, vp00[:,:,None,:]], axis=2)
+                            l_VP00.append(vp00)
                     
                 #### S1_auto computation
                 ### Image 1 : S1 = < M1 >_pix
-                # Apply the mask [Nmask, Npix_j3] and average over pixels
-                if return_data:
-                    s1=MX
-                else:
-                    if calc_var:
-                        s1,vs1 = self.masked_mean(MX, vmask, axis=1,rank=j3,calc_var=True)  # [Nbatch, Nmask, Norient3]
-                    else:
-                        s1 = self.masked_mean(MX, vmask, axis=1,rank=j3)  # [Nbatch, Nmask, Norient3]
-                if return_data:
-                    if S1 is None:
-                        S1={}
-                    S1[j3]=s1
-                else:
-                    ### Normalize S1
-                    if norm is not None:
-                        s1 /= (P1_dic[j3]) ** 0.5
-                    ### We store S1 for image1  [Nbatch, Nmask, NS1, Norient3]
-                    if S1 is None:
-                        S1 = s1[:, :, None, :]  # Add a dimension for NS1
-                        if calc_var:
-                            VS1 = vs1[:, :, None, :]  # Add a dimension for NS1
+                if do_j3 and do_S1:
+                    if return_data:
+                        if S1 is None:
+                            S1={}
+                        S1[j3]=s1
                     else:
-                        S1 = self.backend.bk_concat([S1, s1[:, :, None, :]], axis=2)
+                        ### Normalize S1
+                        if norm is not None:
+                            s1 = s1 / (P1_dic[j3]) ** 0.5
+                        ### We store S1 for image1  [Nbatch, Nmask, NS1, Norient3]
+                        l_S1.append(s1)
                         if calc_var:
-                            VS1 = self.backend.bk_concat([VS1, vs1[:, :, None, :]], axis=2)
-                        
-            # Initialize dictionaries for |I1*Psi_j| * Psi_j3
-            M1convPsi_dic = {}
+                            l_VS1.append(vs1)
+
+            if not do_j3:
+                continue
+
+            ###### M_j2 * Psi_j3 for all j2 <= j3
+            # M1convPsi is used by C01 (auto), C10 (cross) and C11, M2convPsi by C01 and C11 (cross).
+            # They are computed with one convolution of the stacked modules, or taken from a prepared image.
+            need_Psi1 = do_C11 or (do_C10 if cross else do_C01)
+            need_Psi2 = cross and (do_C11 or do_C01)
+            M1convPsi_dic, M1convPsi_stack = {}, None
+            if need_Psi1:
+                if prep1 is not None:
+                    M1convPsi_dic, M1convPsi_stack = dict(prep1.MconvPsi_dic[j3]), prep1.MconvPsi[j3]
+                else:
+                    M1convPsi_stack = self._compute_MconvPsi(j3, M1_dic, M1convPsi_dic, cmat2=cmat2)
             if cross:
-                # Initialize dictionaries for |I2*Psi_j| * Psi_j3
-                M2convPsi_dic = {}
+                M2convPsi_dic, M2convPsi_stack = {}, None
+                if need_Psi2:
+                    if prep2 is not None:
+                        M2convPsi_dic, M2convPsi_stack = dict(prep2.MconvPsi_dic[j3]), prep2.MconvPsi[j3]
+                    else:
+                        M2convPsi_stack = self._compute_MconvPsi(j3, M2_dic, M2convPsi_dic, cmat2=cmat2)
 
             ###### C01
+            # the C01 of all the j2 <= j3 are computed with one contraction over the pixels,
+            # the per-pixel products are only built for return_data, calc_var and use_2D
+            l_c01, l_c10 = None, None
+            if not (return_data or calc_var or self.use_2D):
+                if do_C01:
+                    if cross:
+                        l_c01 = self._compute_C01_batch(j3, conv1, vmask, M2convPsi_stack)
+                    else:
+                        l_c01 = self._compute_C01_batch(j3, conv1, vmask, M1convPsi_stack)
+                if do_C10:
+                    l_c10 = self._compute_C01_batch(j3, conv2, vmask, M1convPsi_stack)
+                
             for j2 in range(0, j3+1):  # j2 <= j3
-                if return_data:
-                    if C11[j3] is None:
-                        C11[j3]={}
-                    C11[j3][j2]=None
-                    
                 ### C01_auto = < (I1 * Psi)_j3 x (|I1 * Psi_j2| * Psi_j3)^* >_pix
                 if not cross:
-                    if calc_var:
+                    if not do_C01:
+                        break
+                    if l_c01 is not None:
+                        c01 = l_c01[j2]
+                    elif calc_var:
                         c01,vc01 = self._compute_C01(j2,j3,
                                                      conv1,
                                                      vmask,
@@ -1984,185 +1755,153 @@ class funct(FOC.FoCUS):
                     else:
                         ### Normalize C01 with P00_j [Nbatch, Nmask, Norient_j]
                         if norm is not None:
-                            c01 /= (P1_dic[j2][:, :, None, :] *
-                                    P1_dic[j3][:, :, :, None]) ** 0.5  # [Nbatch, Nmask, Norient3, Norient2]
+                            c01 = c01 / (P1_dic[j2][:, :, None, :] *
+                                         P1_dic[j3][:, :, :, None]) ** 0.5  # [Nbatch, Nmask, Norient3, Norient2]
 
                         ### Store C01 as a complex [Nbatch, Nmask, NC01, Norient3, Norient2]
-                        if C01 is None:
-                            C01 = c01[:,:,None,:,:]  # Add a dimension for NC01
-                            if calc_var:
-                                VC01 = vc01[:,:,None,:,:]  # Add a dimension for NC01
-                        else:
-                            C01 = self.backend.bk_concat([C01, c01[:, :, None, :, :]],
-                                                     axis=2)  # Add a dimension for NC01
-                            if calc_var:
-                                VC01 = self.backend.bk_concat([VC01, vc01[:, :, None, :, :]],
-                                                              axis=2)  # Add a dimension for NC01
+                        l_C01.append(c01)
+                        if calc_var:
+                            l_VC01.append(vc01)
 
                 ### C01_cross = < (I1 * Psi)_j3 x (|I2 * Psi_j2| * Psi_j3)^* >_pix
                 ### C10_cross = < (I2 * Psi)_j3 x (|I1 * Psi_j2| * Psi_j3)^* >_pix
                 else:
-                    if calc_var:
-                        c01,vc01 = self._compute_C01(j2,j3,
-                                                     conv1,
-                                                     vmask,
-                                                     M2_dic,
-                                                     M2convPsi_dic,
-                                                     calc_var=True,cmat2=cmat2)
-                        c10,vc10 = self._compute_C01(j2,j3,
-                                                     conv2,
-                                                     vmask,
-                                                     M1_dic,
-                                                     M1convPsi_dic,
-                                                     calc_var=True,cmat2=cmat2)
-                    else: 
-                        c01 = self._compute_C01(j2,j3,
-                                                conv1,
-                                                vmask,
-                                                M2_dic,
-                                                M2convPsi_dic,
-                                                return_data=return_data,cmat2=cmat2)
-                        c10 = self._compute_C01(j2,j3,
-                                                conv2,
-                                                vmask,
-                                                M1_dic,
-                                                M1convPsi_dic,
-                                                return_data=return_data,cmat2=cmat2)
+                    if not (do_C01 or do_C10):
+                        break
+                    if do_C01:
+                        if l_c01 is not None:
+                            c01 = l_c01[j2]
+                        elif calc_var:
+                            c01,vc01 = self._compute_C01(j2,j3,
+                                                         conv1,
+                                                         vmask,
+                                                         M2_dic,
+                                                         M2convPsi_dic,
+                                                         calc_var=True,cmat2=cmat2)
+                        else:
+                            c01 = self._compute_C01(j2,j3,
+                                                    conv1,
+                                                    vmask,
+                                                    M2_dic,
+                                                    M2convPsi_dic,
+                                                    return_data=return_data,cmat2=cmat2)
+                    if do_C10:
+                        if l_c10 is not None:
+                            c10 = l_c10[j2]
+                        elif calc_var:
+                            c10,vc10 = self._compute_C01(j2,j3,
+                                                         conv2,
+                                                         vmask,
+                                                         M1_dic,
+                                                         M1convPsi_dic,
+                                                         calc_var=True,cmat2=cmat2)
+                        else:
+                            c10 = self._compute_C01(j2,j3,
+                                                    conv2,
+                                                    vmask,
+                                                    M1_dic,
+                                                    M1convPsi_dic,
+                                                    return_data=return_data,cmat2=cmat2)
                     
                     if return_data:
-                        if C01[j3] is None:
-                            C01[j3]={}
-                            C10[j3]={}
-                        C01[j3][j2]=c01
-                        C10[j3][j2]=c10
+                        if do_C01:
+                            if C01[j3] is None:
+                                C01[j3]={}
+                            C01[j3][j2]=c01
+                        if do_C10:
+                            if C10[j3] is None:
+                                C10[j3]={}
+                            C10[j3][j2]=c10
                     else:
                         ### Normalize C01 and C10 with P00_j [Nbatch, Nmask, Norient_j]
-                        if norm is not None:
-                            c01 /= (P2_dic[j2][:, :, None, :] *
-                                    P1_dic[j3][:, :, :, None]) ** 0.5  # [Nbatch, Nmask, Norient3, Norient2]
-                            c10 /= (P1_dic[j2][:, :, None, :] *
-                                    P2_dic[j3][:, :, :, None]) ** 0.5  # [Nbatch, Nmask, Norient3, Norient2]
-
                         ### Store C01 and C10 as a complex [Nbatch, Nmask, NC01, Norient3, Norient2]
-                        if C01 is None:
-                            C01 = c01[:, :, None, :, :] # Add a dimension for NC01
-                            if calc_var:
-                                VC01 = vc01[:, :, None, :, :] # Add a dimension for NC01
-                        else:
-                            C01 = self.backend.bk_concat([C01,c01[:, :, None, :, :]],axis=2)  # Add a dimension for NC01
-                            if calc_var:
-                                VC01 = self.backend.bk_concat([VC01,vc01[:, :, None, :, :]],axis=2)  # Add a dimension for NC01
-                        if C10 is None:
-                            C10 = c10[:, :, None, :, :]  # Add a dimension for NC01
+                        if do_C01:
+                            if norm is not None:
+                                c01 = c01 / (P2_dic[j2][:, :, None, :] *
+                                             P1_dic[j3][:, :, :, None]) ** 0.5  # [Nbatch, Nmask, Norient3, Norient2]
+                            l_C01.append(c01)
                             if calc_var:
-                                VC10 = vc10[:, :, None, :, :]  # Add a dimension for NC01
-                        else:
-                            C10 = self.backend.bk_concat([C10,c10[:, :, None, :, :]], axis=2)  # Add a dimension for NC01
+                                l_VC01.append(vc01)
+                        if do_C10:
+                            if norm is not None:
+                                c10 = c10 / (P1_dic[j2][:, :, None, :] *
+                                             P2_dic[j3][:, :, :, None]) ** 0.5  # [Nbatch, Nmask, Norient3, Norient2]
+                            l_C10.append(c10)
                             if calc_var:
-                                VC10 = self.backend.bk_concat([VC10,vc10[:, :, None, :, :]], axis=2)  # Add a dimension for NC01
+                                l_VC10.append(vc10)
                         
 
-                ##### C11
+            ##### C11
+            if not do_C11:
+                continue
+
+            # with batch_C11 all the (j1,j2) pairs of the scale are computed with one contraction
+            if self.batch_C11 and not (return_data or calc_var):
+                if cross:
+                    l_c11 = self._compute_C11_batch(j3, vmask, M1convPsi_dic, M2convPsi_dic=M2convPsi_dic,
+                                                    M1convPsi_stack=M1convPsi_stack, M2convPsi_stack=M2convPsi_stack)
+                else:
+                    l_c11 = self._compute_C11_batch(j3, vmask, M1convPsi_dic, M1convPsi_stack=M1convPsi_stack)
+            else:
+                l_c11 = None
+                
+            for j2 in range(0, j3+1):  # j2 <= j3
+                if return_data:
+                    if C11[j3] is None:
+                        C11[j3]={}
+                    C11[j3][j2]=None
+                    
                 for j1 in range(0, j2+1):  # j1 <= j2
                     ### C11_auto = <(|I1 * psi1| * psi3)(|I1 * psi2| * psi3)^*>
-                    if not cross:
-                        if calc_var:
-                            c11,vc11 = self._compute_C11(j1, j2, vmask,
-                                                         M1convPsi_dic,
-                                                         M2convPsi_dic=None,
-                                                         calc_var=True) # [Nbatch, Nmask, Norient3, Norient2, Norient1]
-                        else:
-                            c11 = self._compute_C11(j1, j2, vmask,
-                                                    M1convPsi_dic,
-                                                    M2convPsi_dic=None,
-                                                    return_data=return_data) # [Nbatch, Nmask, Norient3, Norient2, Norient1]
+                    ### C11_cross = <(|I1 * psi1| * psi3)(|I2 * psi2| * psi3)^*>
+                    if cross:
+                        l_M2convPsi_dic = M2convPsi_dic
+                    else:
+                        l_M2convPsi_dic = None
                         
-                        if return_data:
-                            if C11[j3][j2] is None:
-                                C11[j3][j2]={}
-                            C11[j3][j2][j1]=c11
-                        else:
-                            ### Normalize C11 with P00_j [Nbatch, Nmask, Norient_j]
-                            if norm is not None:
-                                c11 /= (P1_dic[j1][:, :, None, None, :] *
-                                        P1_dic[j2][:, :, None, :,
-                                                   None]) ** 0.5  # [Nbatch, Nmask, Norient3, Norient2, Norient1]
-                            ### Store C11 as a complex [Nbatch, Nmask, NC11, Norient3, Norient2, Norient1]
-                            if C11 is None:
-                                C11 = c11[:, :, None, :, :, :]  # Add a dimension for NC11
-                                if calc_var:
-                                    VC11 = vc11[:, :, None, :, :, :]  # Add a dimension for NC11
-                            else:
-                                C11 = self.backend.bk_concat([C11,c11[:, :, None, :, :, :]],
-                                                     axis=2)  # Add a dimension for NC11
-                                if calc_var:
-                                    VC11 = self.backend.bk_concat([VC11,vc11[:, :, None, :, :, :]],
-                                                             axis=2)  # Add a dimension for NC11
-
-                        ### C11_cross = <(|I1 * psi1| * psi3)(|I2 * psi2| * psi3)^*>
+                    if l_c11 is not None:
+                        c11 = l_c11[j2][j1]
+                    elif calc_var:
+                        c11,vc11 = self._compute_C11(j1, j2, vmask,
+                                                     M1convPsi_dic,
+                                                     M2convPsi_dic=l_M2convPsi_dic,
+                                                     calc_var=True) # [Nbatch, Nmask, Norient3, Norient2, Norient1]
                     else:
-                        if calc_var:
-                            c11,vc11 = self._compute_C11(j1, j2, vmask,
-                                                         M1convPsi_dic,
-                                                         M2convPsi_dic=M2convPsi_dic,
-                                                         calc_var=True)  # [Nbatch, Nmask, Norient3, Norient2, Norient1]
-                        else:
-                            c11 = self._compute_C11(j1, j2, vmask,
-                                                    M1convPsi_dic,
-                                                    M2convPsi_dic=M2convPsi_dic,
-                                                    return_data=return_data)  # [Nbatch, Nmask, Norient3, Norient2, Norient1]
-
-                        if return_data:
-                            if C11[j3][j2] is None:
-                                C11[j3][j2]={}
-                            C11[j3][j2][j1]=c11
-                        else:
-                            ### Normalize C11 with P00_j [Nbatch, Nmask, Norient_j]
-                            if norm is not None:
-                                c11 /= (P1_dic[j1][:, :, None, None, :] *
-                                        P2_dic[j2][:, :, None, :, None]) ** 0.5  # [Nbatch, Nmask, Norient3, Norient2, Norient1]
-                            ### Store C11 as a complex [Nbatch, Nmask, NC11, Norient3, Norient2, Norient1]
-                            if C11 is None:
-                                C11 = c11[:, :, None, :, :, :]  # Add a dimension for NC11
-                                if calc_var:
-                                    VC11 = vc11[:, :, None, :, :, :]  # Add a dimension for NC11
+                        c11 = self._compute_C11(j1, j2, vmask,
+                                                M1convPsi_dic,
+                                                M2convPsi_dic=l_M2convPsi_dic,
+                                                return_data=return_data) # [Nbatch, Nmask, Norient3, Norient2, Norient1]
+                        
+                    if return_data:
+                        if C11[j3][j2] is None:
+                            C11[j3][j2]={}
+                        C11[j3][j2][j1]=c11
+                    else:
+                        ### Normalize C11 with P00_j [Nbatch, Nmask, Norient_j]
+                        if norm is not None:
+                            if cross:
+                                c11 = c11 / (P1_dic[j1][:, :, None, None, :] *
+                                             P2_dic[j2][:, :, None, :, None]) ** 0.5  # [Nbatch, Nmask, Norient3, Norient2, Norient1]
                             else:
-                                C11 = self.backend.bk_concat([C11,c11[:, :, None, :, :, :]],
-                                                     axis=2)  # Add a dimension for NC11
-                                if calc_var:
-                                    VC11 = self.backend.bk_concat([VC11,vc11[:, :, None, :, :, :]],
-                                                                 axis=2)  # Add a dimension for NC11
-            
-            ###### Reshape for next iteration on j3
-            ### Image I1,
-            # downscale the I1 [Nbatch, Npix_j3]
-            if j3 != Jmax - 1:
-                I1_smooth = self.smooth(I1, axis=1)
-                I1 = self.ud_grade_2(I1_smooth, axis=1)
-
-                ### Image I2
-                if cross:
-                    I2_smooth = self.smooth(I2, axis=1)
-                    I2 = self.ud_grade_2(I2_smooth, axis=1)
-
-                ### Modules
-                for j2 in range(0, j3 + 1):  # j2 =< j3
-                    ### Dictionary M1_dic[j2]
-                    M1_smooth = self.smooth(M1_dic[j2], axis=1)  # [Nbatch, Npix_j3, Norient3]
-                    M1_dic[j2] = self.ud_grade_2(M1_smooth, axis=1)  # [Nbatch, Npix_j3, Norient3]
-
-                    ### Dictionary M2_dic[j2]
-                    if cross:
-                        M2_smooth = self.smooth(M2_dic[j2], axis=1)  # [Nbatch, Npix_j3, Norient3]
-                        M2_dic[j2] = self.ud_grade_2(M2_smooth, axis=1)  # [Nbatch, Npix_j3, Norient3]
-                ### Mask
-                vmask = self.ud_grade_2(vmask, axis=1)
-
-                if self.mask_thres is not None:
-                    vmask = self.backend.bk_threshold(vmask,self.mask_thres)
+                                c11 = c11 / (P1_dic[j1][:, :, None, None, :] *
+                                             P1_dic[j2][:, :, None, :, None]) ** 0.5  # [Nbatch, Nmask, Norient3, Norient2, Norient1]
+                        ### Store C11 as a complex [Nbatch, Nmask, NC11, Norient3, Norient2, Norient1]
+                        l_C11.append(c11)
+                        if calc_var:
+                            l_VC11.append(vc11)
+
+        ### Stack the coefficients [Nbatch, Nmask, Ncoeff, ...]
+        # (None for the coefficients that are not computed)
+        if not return_data:
+            def stack(l):
+                if len(l) == 0:
+                    return None
+                return self.backend.bk_stack(l, axis=2)
+            S1, P00, C01, C11, C10 = [stack(l) for l in [l_S1, l_P00, l_C01, l_C11, l_C10]]
+            if calc_var:
+                VS1, VP00, VC01, VC11, VC10 = [stack(l) for l in [l_VS1, l_VP00, l_VC01, l_VC11, l_VC10]]
 
-                ### NSIDE_j3
-                nside_j3 = nside_j3 // 2
+        self.stop_mean_mask()
 
         ### Store P1_dic and P2_dic in self
         if (norm == 'auto') and (self.P1_dic is None):
@@ -2183,11 +1922,153 @@ class funct(FOC.FoCUS):
             else:
                 return scat_cov(s0,P00, C01, C11, s1=S1,c10=C10,backend=self.backend)
 
+    def eval_many(self, image1, image2=None, mask=None, norm=None, Auto=True, cmat=None, cmat2=None,
+                  nbatch=16, return_all=True):
+        """
+        Calculates the scattering covariance of a stack of images (e.g. noise simulations) by
+        micro-batches of nbatch images, each micro-batch is computed with one call of eval.
+        Parameters
+        ----------
+        image1: tensor
+            Stack of images [Nsim, Npix] ([Nsim, Nx, Ny] in 2D) or a single image
+        image2: tensor
+            Second stack of images [Nsim, Npix] or a single image used with all the images of image1.
+            If None the auto coefficients are computed.
+        nbatch: int
+            Number of images given at once to eval
+        return_all: bool
+            If True the coefficients of all the images are returned
+        Returns
+        -------
+        mean, std: scat_cov [1, Nmask, ...] over the Nsim images (updated for each micro-batch)
+        all: scat_cov [Nsim, Nmask, ...] if return_all
+        """
+        # the stacked images have one more dimension than a single image
+        ndim = 3 if self.use_2D else 2
+        nsim = None
+        for im in [image1, image2]:
+            if im is not None and len(im.shape) == ndim:
+                if nsim is not None and nsim != im.shape[0]:
+                    print('The two stacks of images should have the same number of images to eval_many')
+                    exit(0)
+                nsim = int(im.shape[0])
+        if nsim is None:
+            print('eval_many needs a stack of images [Nsim, Npix]')
+            exit(0)
+
+        def get_batch(im, k, n):
+            if im is None:
+                return None
+            if len(im.shape) == ndim:
+                return im[k:k + n]
+            # single image used for all the images of the stack
+            return self.backend.bk_concat([self.backend.bk_expand_dims(self.backend.bk_cast(im), 0)] * n, axis=0)
+
+        l_res = []
+        acc = scat_cov_accumulator(backend=self.backend)
+        for k in range(0, nsim, nbatch):
+            n = min(nbatch, nsim - k)
+            res = self.eval(get_batch(image1, k, n), image2=get_batch(image2, k, n), mask=mask,
+                            norm=norm, Auto=Auto, cmat=cmat, cmat2=cmat2)
+            if return_all:
+                l_res.append(res)
+            acc.update(res)
+
+        if not return_all:
+            return acc.get_mean(), acc.get_std()
+        return acc.get_mean(), acc.get_std(), sc_apply(lambda *l: self.backend.bk_concat(list(l), axis=0), *l_res)
+
     def clean_norm(self):
         self.P1_dic = None
         self.P2_dic = None
+        # the compiled evals with norm='auto' use the reference P00 as constants
+        self.eval_comp_cache = {k: v for k, v in self.eval_comp_cache.items() if k[3] != 'auto'}
         return
 
+    def prepare(self, image, cmat=None, cmat2=None):
+        """
+        Compute once the per-scale transforms of an image that does not change between the
+        calls of eval (e.g. the reference map of a synthesis loss): convolutions, modulus and
+        M_j2 * Psi_j3. The result is given to eval as image1 or image2, only the other image
+        is then transformed.
+        Parameters
+        ----------
+        image: tensor
+            Image [Nbatch, Npix] or [Npix]
+        cmat, cmat2:
+            the rotation matrices that will be given to eval
+        Returns
+        -------
+        scat_cov_prepared
+        """
+        if isinstance(image, scat_cov_prepared):
+            return image
+        if self.use_2D and len(image.shape)<2:
+            print('To work with 2D scattering transform, two dimension is needed, input map has only on dimension')
+            exit(0)
+
+        im_shape = image.shape
+        if self.use_2D:
+            if len(image.shape)==2:
+                nside=np.min([im_shape[0],im_shape[1]])
+            else:
+                nside=np.min([im_shape[1],im_shape[2]])
+            J = int(np.log(nside-self.KERNELSZ) / np.log(2))  # Number of j scales
+        else:
+            if len(image.shape)==2:
+                npix = int(im_shape[1])  # Number of pixels
+            else:
+                npix = int(im_shape[0])  # Number of pixels
+            nside=int(np.sqrt(npix//12))
+            J = int(np.log(nside) / np.log(2))  # Number of j scales
+        Jmax = J - self.OSTEP  # Number of steps for the loop on scales
+
+        # the transforms are constants, no gradient goes through them
+        I = self._increase_binning(self.backend.constant(self._input_image(image)), nside)
+        res = scat_cov_prepared(im_shape, I, cmat=cmat, cmat2=cmat2)
+
+        M_dic = {}
+        for j3 in range(Jmax):
+            conv, M_square, M = self._conv_modulus(I, j3, cmat=cmat)
+            M_dic[j3] = M
+            MconvPsi_dic = {}
+            MconvPsi = self._compute_MconvPsi(j3, M_dic, MconvPsi_dic, cmat2=cmat2)
+            res.append(conv, M_square, M, MconvPsi, MconvPsi_dic)
+
+            if j3 != Jmax - 1:
+                I = self.smooth_ud_grade_2(I, axis=1)
+                l_mod = self._smooth_ud_grade_modules([M_dic[j2] for j2 in range(0, j3 + 1)])
+                for j2 in range(0, j3 + 1):
+                    M_dic[j2] = l_mod[j2]
+        return res
+
+    def _input_image(self, image):
+        # [Nbatch, Npix] (or [Nbatch, Nx, Ny]) image in the backend type
+        if isinstance(image, scat_cov_prepared):
+            return image.I
+        if len(image.shape) == 1 or (len(image.shape)==2 and self.use_2D):
+            return self.backend.bk_cast(self.backend.bk_expand_dims(image, 0))
+        return self.backend.bk_cast(image)
+
+    def _increase_binning(self, im, nside):
+        # if the kernel size is bigger than 3 (resp. 5) increase the binning by 2 (resp. 4) before smoothing
+        if self.KERNELSZ > 3:
+            for k in range(1 + int(self.KERNELSZ > 5)):
+                if self.use_2D:
+                    im = self.up_grade(im, im.shape[1]*2, axis=1, nouty=im.shape[2]*2)
+                else:
+                    im = self.up_grade(im, nside * 2**(k + 1), axis=1)
+        return im
+
+    def _conv_modulus(self, I, j3, cmat=None):
+        # return I * Psi_j3, |I * Psi_j3|^2 and |I * Psi_j3| [Nbatch, Npix_j3, Norient3]
+        conv = self.convol(I, axis=1)
+        if cmat is not None:
+            tmp2=self.backend.bk_repeat(conv,4,axis=-1)
+            conv=self.backend.bk_reduce_sum(self.backend.bk_reshape(cmat[j3]*tmp2,[1,cmat[j3].shape[0],4,4]),2)
+        M_square = conv*self.backend.bk_conjugate(conv)
+        return conv, M_square, self.backend.bk_L1(M_square)
+
     def _compute_C01(self, j2, j3,conv,
                      vmask, M_dic,
                      MconvPsi_dic,
@@ -2204,14 +2085,18 @@ class funct(FOC.FoCUS):
         cc01, sc01: real and imag parts of C01 coeff
         """
         ### Compute |I1 * Psi_j2| * Psi_j3 = M1_j2 * Psi_j3
-        # Warning: M1_dic[j2] is already at j3 resolution [Nbatch, Npix_j3, Norient3]
-        MconvPsi = self.convol(M_dic[j2], axis=1)  # [Nbatch, Npix_j3, Norient3, Norient2]
-        if cmat2 is not None:
-            tmp2=self.backend.bk_repeat(MconvPsi,4,axis=-1)
-            MconvPsi=self.backend.bk_reduce_sum(self.backend.bk_reshape(cmat2[j3][j2]*tmp2,[1,cmat2[j3].shape[1],4,4,4]),3)
-        
-        # Store it so we can use it in C11 computation
-        MconvPsi_dic[j2] = MconvPsi  # [Nbatch, Npix_j3, Norient3, Norient2]
+        if j2 in MconvPsi_dic:
+            # already computed (prepared image)
+            MconvPsi = MconvPsi_dic[j2]
+        else:
+            # Warning: M1_dic[j2] is already at j3 resolution [Nbatch, Npix_j3, Norient3]
+            MconvPsi = self.convol(M_dic[j2], axis=1)  # [Nbatch, Npix_j3, Norient3, Norient2]
+            if cmat2 is not None:
+                tmp2=self.backend.bk_repeat(MconvPsi,4,axis=-1)
+                MconvPsi=self.backend.bk_reduce_sum(self.backend.bk_reshape(cmat2[j3][j2]*tmp2,[1,cmat2[j3].shape[1],4,4,4]),3)
+
+            # Store it so we can use it in C11 computation
+            MconvPsi_dic[j2] = MconvPsi  # [Nbatch, Npix_j3, Norient3, Norient2]
 
         ### Compute the product (I2 * Psi)_j3 x (M1_j2 * Psi_j3)^*
         # z_1 x z_2^* = (a1a2 + b1b2) + i(b1a2 - a1b2)
@@ -2243,6 +2128,10 @@ class funct(FOC.FoCUS):
         else:  # Cross
             M2 = M2convPsi_dic[j2]
 
+        if not (return_data or calc_var):
+            ### Masked contraction over the pixels, the product is not built
+            return self.masked_cross_mean(M1, M2, vmask)  # [Nbatch, Nmask, Norient3, Norient2, Norient1]
+
         ### Compute the product (|I1 * Psi_j1| * Psi_j3)(|I2 * Psi_j2| * Psi_j3)
         # z_1 x z_2^* = (a1a2 + b1b2) + i(b1a2 - a1b2)
         c11 = self.backend.bk_expand_dims(M1, -2) * self.backend.bk_conjugate(self.backend.bk_expand_dims(M2, -1))  # [Nbatch, Npix_j3, Norient3, Norient2, Norient1]
@@ -2258,51 +2147,110 @@ class funct(FOC.FoCUS):
                 c11 = self.masked_mean(c11, vmask, axis=1,rank=j2)  # [Nbatch, Nmask, Norient3, Norient2, Norient1]
                 return c11
 
+    def _compute_C01_batch(self, j3, conv, vmask, MconvPsi):
+        """
+        Compute the C01 coefficients of all the j2 <= j3 (auto or cross) with one contraction over
+        the pixels, the per-pixel products are not built. MconvPsi is the stacked M_j2 * Psi_j3
+        [Nbatch, Npix_j3, Norient3, (j3+1)*Norient2] given by _compute_MconvPsi.
+        Return the dictionary c01[j2] [Nbatch, Nmask, Norient3, Norient2]
+        """
+        ### Masked mean of (I2 * Psi)_j3 x (M1_j2 * Psi_j3)^*
+        c01 = self.masked_cross_mean(self.backend.bk_expand_dims(conv, -1), MconvPsi, vmask)  # [Nbatch, Nmask, Norient3, (j3+1)*Norient2, 1]
+
+        res = {}
+        for j2 in range(j3 + 1):
+            res[j2] = c01[:, :, :, j2 * self.NORIENT:(j2 + 1) * self.NORIENT, 0]
+        return res
+
+    def _compute_MconvPsi(self, j3, M_dic, MconvPsi_dic, cmat2=None):
+        """
+        Compute |I1 * Psi_j2| * Psi_j3 = M1_j2 * Psi_j3 for all the j2 <= j3 with one convolution of the
+        stacked modules. Fill MconvPsi_dic and return the stack [Nbatch, Npix_j3, Norient3, (j3+1)*Norient2]
+        """
+        # Warning: M1_dic[j2] is already at j3 resolution [Nbatch, Npix_j3, Norient3]
+        if self.use_2D:
+            # the 2D kernels only convolve NORIENT channels, one convolution per j2
+            for j2 in range(j3 + 1):
+                l_MconvPsi = self.convol(M_dic[j2], axis=1)  # [Nbatch, X, Y, Norient3, Norient2]
+                if cmat2 is not None:
+                    tmp2=self.backend.bk_repeat(l_MconvPsi,4,axis=-1)
+                    l_MconvPsi=self.backend.bk_reduce_sum(self.backend.bk_reshape(cmat2[j3][j2]*tmp2,[1,cmat2[j3].shape[1],4,4,4]),3)
+                MconvPsi_dic[j2] = l_MconvPsi
+            return self.backend.bk_concat([MconvPsi_dic[j2] for j2 in range(j3 + 1)], axis=-1)
+
+        # the convolution is ordered as [Nbatch, Npix_j3, Norient3, (j3+1)*Norient2], as for a single j2
+        MconvPsi = self.convol(self.backend.bk_concat([M_dic[j2] for j2 in range(j3 + 1)], axis=2), axis=1)
+        MconvPsi = self.backend.bk_reshape(MconvPsi, [MconvPsi.shape[0], MconvPsi.shape[1], self.NORIENT, (j3 + 1) * self.NORIENT])
+        for j2 in range(j3 + 1):
+            l_MconvPsi = MconvPsi[:, :, :, j2 * self.NORIENT:(j2 + 1) * self.NORIENT]
+            if cmat2 is not None:
+                tmp2=self.backend.bk_repeat(l_MconvPsi,4,axis=-1)
+                l_MconvPsi=self.backend.bk_reduce_sum(self.backend.bk_reshape(cmat2[j3][j2]*tmp2,[1,cmat2[j3].shape[1],4,4,4]),3)
+            # Store it so we can use it in C11 computation
+            MconvPsi_dic[j2] = l_MconvPsi  # [Nbatch, Npix_j3, Norient3, Norient2]
+        if cmat2 is not None:
+            MconvPsi = self.backend.bk_concat([MconvPsi_dic[j2] for j2 in range(j3 + 1)], axis=3)
+        return MconvPsi
+
+    def _compute_C11_batch(self, j3, vmask,
+                           M1convPsi_dic,
+                           M2convPsi_dic=None,
+                           M1convPsi_stack=None,
+                           M2convPsi_stack=None):
+        """
+        Compute the C11 coefficients of all the (j1,j2) pairs, j1 <= j2 <= j3, with one contraction
+        over the pixels. Return the dictionary c11[j2][j1] [Nbatch, Nmask, Norient3, Norient2, Norient1]
+        The stacked M * Psi_j3 [Nbatch, Npix_j3, Norient3, (j3+1)*Norient] given by _compute_MconvPsi are reused.
+        """
+        M1 = M1convPsi_stack
+        if M1 is None:
+            M1 = self.backend.bk_concat([M1convPsi_dic[j] for j in range(j3 + 1)], axis=-1)
+        if M2convPsi_dic is None:  # Auto
+            M2 = M1
+        else:  # Cross
+            M2 = M2convPsi_stack
+            if M2 is None:
+                M2 = self.backend.bk_concat([M2convPsi_dic[j] for j in range(j3 + 1)], axis=-1)
+
+        # [Nbatch, Nmask, Norient3, (j3+1)*Norient2, (j3+1)*Norient1]
+        c11 = self.masked_cross_mean(M1, M2, vmask)
+
+        res = {}
+        for j2 in range(j3 + 1):
+            res[j2] = {}
+            for j1 in range(j2 + 1):
+                res[j2][j1] = c11[:, :, :, j2 * self.NORIENT:(j2 + 1) * self.NORIENT, j1 * self.NORIENT:(j1 + 1) * self.NORIENT]
+        return res
+
+    def _smooth_ud_grade_modules(self, l_mod):
+        # smooth and downgrade a list of modules [Nbatch, Npix_j, Norient] with one product,
+        # the 2D smoothing kernels only apply to NORIENT channels (one call per module)
+        if self.use_2D:
+            return [self.smooth_ud_grade_2(M, axis=1) for M in l_mod]
+        res = self.smooth_ud_grade_2(self.backend.bk_concat(l_mod, axis=2), axis=1)
+        return [res[:, :, k * self.NORIENT:(k + 1) * self.NORIENT] for k in range(len(l_mod))]
+
     def square(self, x):
         if isinstance(x, scat_cov):
-            if x.S1 is None:
-                return scat_cov(self.backend.bk_square(self.backend.bk_abs(x.S0)),
-                                self.backend.bk_square(self.backend.bk_abs(x.P00)),
-                                self.backend.bk_square(self.backend.bk_abs(x.C01)),
-                                self.backend.bk_square(self.backend.bk_abs(x.C11)),backend=self.backend)
-            else:
-                return scat_cov(self.backend.bk_square(self.backend.bk_abs(x.S0)),
-                                self.backend.bk_square(self.backend.bk_abs(x.P00)),
-                                self.backend.bk_square(self.backend.bk_abs(x.C01)),
-                                self.backend.bk_square(self.backend.bk_abs(x.C11)),
-                                s1=self.backend.bk_square(self.backend.bk_abs(x.S1)),backend=self.backend)
+            return sc_apply(lambda a: self.backend.bk_square(self.backend.bk_abs(a)), x)
         else:
             return self.backend.bk_abs(self.backend.bk_square(x))
 
     def sqrt(self, x):
         if isinstance(x, scat_cov):
-            if x.S1 is None:
-                return scat_cov(self.backend.bk_sqrt(self.backend.bk_abs(x.S0)),
-                                self.backend.bk_sqrt(self.backend.bk_abs(x.P00)),
-                                self.backend.bk_sqrt(self.backend.bk_abs(x.C01)),
-                                self.backend.bk_sqrt(self.backend.bk_abs(x.C11)),backend=self.backend)
-            else:
-                return scat_cov(self.backend.bk_sqrt(self.backend.bk_abs(x.S0)),
-                                self.backend.bk_sqrt(self.backend.bk_abs(x.P00)),
-                                self.backend.bk_sqrt(self.backend.bk_abs(x.C01)),
-                                self.backend.bk_sqrt(self.backend.bk_abs(x.C11)),
-                                s1=self.backend.bk_sqrt(self.backend.bk_abs(x.S1)),backend=self.backend)
+            return sc_apply(lambda a: self.backend.bk_sqrt(self.backend.bk_abs(a)), x)
         else:
             return self.backend.bk_abs(self.backend.bk_sqrt(x))
 
+    def sc_list(self, x):
+        # coefficients of x used by the reductions (C10 is not included)
+        return [getattr(x, k) for k in ['S0', 'P00', 'S1', 'C01', 'C11'] if getattr(x, k) is not None]
+
     def reduce_mean(self, x):
         if isinstance(x, scat_cov):
-            if x.S1 is None:
-                result = (self.backend.bk_reduce_mean(self.backend.bk_abs(x.S0)) + \
-                          self.backend.bk_reduce_mean(self.backend.bk_abs(x.P00)) + \
-                          self.backend.bk_reduce_mean(self.backend.bk_abs(x.C01)) + \
-                          self.backend.bk_reduce_mean(self.backend.bk_abs(x.C11)))/3
-            else:
-                result = (self.backend.bk_reduce_mean(self.backend.bk_abs(x.S0)) + \
-                          self.backend.bk_reduce_mean(self.backend.bk_abs(x.P00)) + \
-                          self.backend.bk_reduce_mean(self.backend.bk_abs(x.S1)) + \
-                          self.backend.bk_reduce_mean(self.backend.bk_abs(x.C01)) + \
-                          self.backend.bk_reduce_mean(self.backend.bk_abs(x.C11)))/4
+            l_x = self.sc_list(x)
+            # sum of the means divided by the number of coefficients minus one (3 for S0, P00, C01, C11)
+            result = sum([self.backend.bk_reduce_mean(self.backend.bk_abs(a)) for a in l_x])/max(1, len(l_x) - 1)
         else:
             return self.backend.bk_reduce_mean(x)
         return result
@@ -2310,124 +2258,135 @@ class funct(FOC.FoCUS):
     def reduce_sum(self, x):
         
         if isinstance(x, scat_cov):
-            if x.S1 is None:
-                result = self.backend.bk_reduce_sum(x.S0) + \
-                         self.backend.bk_reduce_sum(x.P00) + \
-                         self.backend.bk_reduce_sum(x.C01) + \
-                         self.backend.bk_reduce_sum(x.C11)
-            else:
-                result = self.backend.bk_reduce_sum(x.S0) + \
-                         self.backend.bk_reduce_sum(x.P00) + \
-                         self.backend.bk_reduce_sum(x.S1) + \
-                         self.backend.bk_reduce_sum(x.C01) + \
-                         self.backend.bk_reduce_sum(x.C11)
+            result = sum([self.backend.bk_reduce_sum(a) for a in self.sc_list(x)])
         else:
             return self.backend.bk_reduce_sum(x)
         return result
 
         
     def ldiff(self,sig,x):
-
-        if x.S1 is None:
-            if x.C10 is not None:
-                return scat_cov(x.domult(sig.S0,x.S0)*x.domult(sig.S0,x.S0),
-                                x.domult(sig.P00,x.P00)*x.domult(sig.P00,x.P00),
-                                x.domult(sig.C01,x.C01)*x.domult(sig.C01,x.C01),
-                                x.domult(sig.C11,x.C11)*x.domult(sig.C11,x.C11),
-                                C10=x.domult(sig.C10,x.C10)*x.domult(sig.C10,x.C10),
-                                backend=self.backend)
-            else:
-                return scat_cov(x.domult(sig.S0,x.S0)*x.domult(sig.S0,x.S0),
-                                x.domult(sig.P00,x.P00)*x.domult(sig.P00,x.P00),
-                                x.domult(sig.C01,x.C01)*x.domult(sig.C01,x.C01),
-                                x.domult(sig.C11,x.C11)*x.domult(sig.C11,x.C11),
-                                backend=self.backend)
-        else:
-            if x.C10 is None:
-                return scat_cov(x.domult(sig.S0,x.S0)*x.domult(sig.S0,x.S0),
-                                x.domult(sig.P00,x.P00)*x.domult(sig.P00,x.P00),
-                                x.domult(sig.C01,x.C01)*x.domult(sig.C01,x.C01),
-                                x.domult(sig.C11,x.C11)*x.domult(sig.C11,x.C11),
-                                S1=x.domult(sig.S1,x.S1)*x.domult(sig.S1,x.S1),
-                                C10=x.domult(sig.C10,x.C10)*x.domult(sig.C10,x.C10),
-                                backend=self.backend)
-            else:
-                return scat_cov(x.domult(sig.S0,x.S0)*x.domult(sig.S0,x.S0),
-                                x.domult(sig.P00,x.P00)*x.domult(sig.P00,x.P00),
-                                x.domult(sig.C01,x.C01)*x.domult(sig.C01,x.C01),
-                                x.domult(sig.C11,x.C11)*x.domult(sig.C11,x.C11),
-                                S1=x.domult(sig.S1,x.S1)*x.domult(sig.S1,x.S1),
-                                backend=self.backend)
+        return sc_apply(lambda a, b: x.domult(a, b)*x.domult(a, b), sig, x)
 
     
     def log(self, x):
         if isinstance(x, scat_cov):
-
-            if x.S1 is None:
-                result = self.backend.bk_log(x.S0) + \
-                         self.backend.bk_log(x.P00) + \
-                         self.backend.bk_log(x.C01) + \
-                         self.backend.bk_log(x.C11)
-            else:
-                result = self.backend.bk_log(x.S0) + \
-                         self.backend.bk_log(x.P00) + \
-                         self.backend.bk_log(x.S1) + \
-                         self.backend.bk_log(x.C01) + \
-                         self.backend.bk_log(x.C11)
+            result = sum([self.backend.bk_log(a) for a in self.sc_list(x)])
         else:
             return self.backend.bk_log(x)
         
         return result
 
     # ---------------------------------------------−---------
-    def std(self,list_of_sc):
-        n=len(list_of_sc)
-        res=list_of_sc[0]
-        res2=list_of_sc[0]*list_of_sc[0]
-        for k in range(1,n):
-            res=res+list_of_sc[k]
-            res2=res2+list_of_sc[k]*list_of_sc[k]
-
-        if res.S1 is None:
-            if res.C10 is not None:
-                return scat_cov(x.domult(sig.S0,x.S0)*x.domult(sig.S0,x.S0),
-                                x.domult(sig.P00,x.P00)*x.domult(sig.P00,x.P00),
-                                x.domult(sig.C01,x.C01)*x.domult(sig.C01,x.C01),
-                                x.domult(sig.C11,x.C11)*x.domult(sig.C11,x.C11),
-                                C10=x.domult(sig.C10,x.C10)*x.domult(sig.C10,x.C10),
-                                backend=self.backend)
-            else:
-                return scat_cov(x.domult(sig.S0,x.S0)*x.domult(sig.S0,x.S0),
-                                x.domult(sig.P00,x.P00)*x.domult(sig.P00,x.P00),
-                                x.domult(sig.C01,x.C01)*x.domult(sig.C01,x.C01),
-                                x.domult(sig.C11,x.C11)*x.domult(sig.C11,x.C11),
-                                backend=self.backend)
-        else:
-            if res.C10 is None:
-                return scat_cov(x.domult(sig.S0,x.S0)*x.domult(sig.S0,x.S0),
-                                x.domult(sig.P00,x.P00)*x.domult(sig.P00,x.P00),
-                                x.domult(sig.C01,x.C01)*x.domult(sig.C01,x.C01),
-                                x.domult(sig.C11,x.C11)*x.domult(sig.C11,x.C11),
-                                S1=x.domult(sig.S1,x.S1)*x.domult(sig.S1,x.S1),
-                                C10=x.domult(sig.C10,x.C10)*x.domult(sig.C10,x.C10),
-                                backend=self.backend)
+    def stack(self,list_of_sc):
+        # scat_cov with a leading sample axis from a list (or a dictionary) of scat_cov
+        if isinstance(list_of_sc,scat_cov):
+            return list_of_sc
+        if isinstance(list_of_sc,dict):
+            list_of_sc=list(list_of_sc.values())
+        return sc_apply(lambda *l: self.backend.bk_concat([self.backend.bk_cast(a) for a in l],axis=0),*list_of_sc)
+
+    def mean(self,list_of_sc):
+        # mean over the samples of a list of scat_cov or of a scat_cov with a leading sample axis
+        return sc_apply(lambda a: self.backend.bk_reduce_mean(a,axis=0)[None],self.stack(list_of_sc))
+
+    def std(self,list_of_sc,ddof=0):
+        # std over the samples of a list of scat_cov or of a scat_cov with a leading sample axis,
+        # for complex coefficients the std of the modulus of the deviation (as np.std)
+        x=self.stack(list_of_sc)
+        n=int(x.S0.shape[0])
+        def fct(a):
+            d=self.backend.bk_abs(a-self.backend.bk_reduce_mean(a,axis=0)[None])
+            return self.backend.bk_sqrt(self.backend.bk_reduce_sum(self.backend.bk_square(d),axis=0)[None]/(n-ddof))
+        return sc_apply(fct,x)
+
+    # ---------------------------------------------−---------
+    # Compiled eval : the eval of a given signature (shapes of the images and of the mask, norm,
+    # Auto, calc_var, coeffs, scales) is traced once with tf.function (tensorflow) or
+    # torch.compile (torch) and the compiled function is kept in self.eval_comp_cache.
+    # The first call of a signature is done in eager mode (it builds the operators of each
+    # scale before the trace). The calls that can not be traced use the eager eval :
+    # numpy backend, prepared images, cmat/cmat2, return_data and norm='auto' before the
+    # reference P00 is computed. If the trace fails the signature stays in eager mode.
+    def get_eval_comp(self, image1, image2=None, mask=None, norm=None, Auto=True, calc_var=False,
+                      coeffs=None, scales=None):
+        if self.backend.BACKEND == self.backend.NUMPY or self.return_data:
+            return None, None
+        if norm == 'auto' and self.P1_dic is None:
+            return None, None
+
+        def sig(x):
+            if x is None:
+                return None
+            return (tuple(x.shape), str(x.dtype))
+
+        key = (sig(image1), sig(image2), sig(mask), norm, Auto, calc_var,
+               None if coeffs is None else tuple(coeffs),
+               None if scales is None else tuple(scales),
+               id(self.P1_dic) if norm == 'auto' else None)
+
+        if key not in self.eval_comp_cache:
+            return key, None
+        return key, self.eval_comp_cache[key]
+
+    def eval_comp_fast(self, image1, image2=None, mask=None, norm=None, Auto=True, cmat=None, cmat2=None,
+                       calc_var=False, coeffs=None, scales=None):
+        # return S0, P00, S1, C01, C11, C10 (a tuple of them for each scat_cov if calc_var)
+        def comp(res):
+            return res.S0, res.P00, res.S1, res.C01, res.C11, res.C10
+
+        def fct(im1, im2, vmask):
+            res = self.eval(im1, image2=im2, mask=vmask, norm=norm, Auto=Auto, calc_var=calc_var,
+                            coeffs=coeffs, scales=scales)
+            if calc_var:
+                return comp(res[0]), comp(res[1])
+            return comp(res)
+
+        key, cfct = None, None
+        if cmat is None and cmat2 is None and not isinstance(image1, scat_cov_prepared) \
+           and not isinstance(image2, scat_cov_prepared):
+            l_im = [None if x is None else self.backend.bk_cast(x) for x in [image1, image2, mask]]
+            key, cfct = self.get_eval_comp(l_im[0], image2=l_im[1], mask=l_im[2], norm=norm, Auto=Auto,
+                                           calc_var=calc_var, coeffs=coeffs, scales=scales)
+        if cfct is not None:
+            try:
+                return cfct(*l_im)
+            except Exception as e:
+                if not self.silent:
+                    print('Compiled eval failed, eager mode is used for this signature :', e)
+                self.eval_comp_cache[key] = None
+
+        res = self.eval(image1, image2=image2, mask=mask, norm=norm, Auto=Auto, calc_var=calc_var,
+                        cmat=cmat, cmat2=cmat2, coeffs=coeffs, scales=scales)
+        if key is not None and key not in self.eval_comp_cache:
+            if self.backend.BACKEND == self.backend.TENSORFLOW:
+                self.eval_comp_cache[key] = self.backend.backend.function(fct)
             else:
-                return scat_cov(x.domult(sig.P00,x.P00)*x.domult(sig.P00,x.P00),
-                                x.domult(sig.S1,x.S1)*x.domult(sig.S1,x.S1),
-                                x.domult(sig.C01,x.C01)*x.domult(sig.C01,x.C01),
-                                x.domult(sig.C11,x.C11)*x.domult(sig.C11,x.C11),
-                                backend=self.backend)
-        return(self.NORIENT)
-    """
-    @tf.function
-    """
-    def eval_comp_fast(self, image1, image2=None,mask=None,norm=None, Auto=True,cmat=None,cmat2=None):
-
-        res=self.eval(image1, image2=image2,mask=mask,Auto=Auto,cmat=cmat,cmat2=cmat2)
-        return res.S0,res.P00,res.S1,res.C01,res.C11,res.C10
-
-    def eval_fast(self, image1, image2=None,mask=None,norm=None, Auto=True,cmat=None,cmat2=None):
-        s0,p0,s1,c01,c11,c10=self.eval_comp_fast(image1, image2=image2,mask=mask,Auto=Auto,cmat=cmat,cmat2=cmat2)
-        return scat_cov(s0, p0,  c01, c11, s1=s1,c10=c10,backend=self.backend)
-        
-        
+                self.eval_comp_cache[key] = self.backend.backend.compile(fct, dynamic=False)
+        if calc_var:
+            return comp(res[0]), comp(res[1])
+        return comp(res)
+
+    def eval_fast(self, image1, image2=None, mask=None, norm=None, Auto=True, cmat=None, cmat2=None,
+                  calc_var=False, coeffs=None, scales=None):
+        """
+        Same as eval using a compiled function for each signature of the call (shapes of the
+        images and of the mask, norm, Auto, calc_var, coeffs and scales) : tf.function with
+        tensorflow, torch.compile with torch. The first call of a signature is eager, the second
+        one traces the function and the next ones only run the compiled graph.
+        The numpy backend, prepared images, cmat/cmat2 and return_data use the eager eval.
+        With torch on CPU the complex operators are not generated by the compiler and the
+        eager eval can be faster.
+        """
+        def sc(l):
+            s0, p0, s1, c01, c11, c10 = l
+            return scat_cov(s0, p0, c01, c11, s1=s1, c10=c10, backend=self.backend)
+
+        res = self.eval_comp_fast(image1, image2=image2, mask=mask, norm=norm, Auto=Auto, cmat=cmat, cmat2=cmat2,
+                                  calc_var=calc_var, coeffs=coeffs, scales=scales)
+        if calc_var:
+            return sc(res[0]), sc(res[1])
+        return sc(res)
+
+    def clean_eval_comp(self):
+        self.eval_comp_cache = {}
+        return
@@ -0,0 +1,81 @@
+import numpy as np
+import json
+import os
+import socket
+
+# Single file store for the precomputed operators of FoCUS.
+#
+# A template file contains a small JSON header followed by contiguous arrays:
+#   'FOSCATTPL' | header length (uint64) | header (json) | array 0 | array 1 | ...
+# The header gives the configuration and, for each array, its dtype, shape and
+# offset. The arrays are opened with np.memmap, thus no data is read before use
+# and several processes share the same pages of the system cache.
+# A file is written in a temporary file renamed at the end, a reader never sees
+# a partially written template.
+
+TEMPLATE_MAGIC=b'FOSCATTPL'
+TEMPLATE_FORMAT=1
+TEMPLATE_ALIGN=64
+
+# ---------------------------------------------−---------
+def write_template(filename,arrays,header={}):
+    header=dict(header)
+    header['format']=TEMPLATE_FORMAT
+    desc={}
+    offset=0
+    for k in arrays:
+        data=np.ascontiguousarray(arrays[k])
+        desc[k]={'dtype':data.dtype.str,'shape':list(data.shape),'offset':offset}
+        offset+=((data.nbytes+TEMPLATE_ALIGN-1)//TEMPLATE_ALIGN)*TEMPLATE_ALIGN
+    header['arrays']=desc
+
+    head=json.dumps(header).encode()
+    start=len(TEMPLATE_MAGIC)+8+len(head)
+    pad=((start+TEMPLATE_ALIGN-1)//TEMPLATE_ALIGN)*TEMPLATE_ALIGN-start
+    head=head+b' '*pad
+
+    # the host name keeps the temporary names of the MPI ranks distinct on a shared file system
+    tmpname='%s.%s.%d.tmp'%(filename,socket.gethostname(),os.getpid())
+    with open(tmpname,'wb') as f:
+        f.write(TEMPLATE_MAGIC)
+        f.write(np.array([len(head)],dtype='<u8').tobytes())
+        f.write(head)
+        for k in arrays:
+            data=np.ascontiguousarray(arrays[k])
+            f.write(data.tobytes())
+            pad=((data.nbytes+TEMPLATE_ALIGN-1)//TEMPLATE_ALIGN)*TEMPLATE_ALIGN-data.nbytes
+            f.write(b'\0'*pad)
+    os.replace(tmpname,filename)
+
+# ---------------------------------------------−---------
+# return (header,arrays) with the arrays memory mapped in read only mode,
+# or None if the file does not exist, is not a valid template or is truncated
+def read_template(filename):
+    try:
+        size=os.path.getsize(filename)
+        with open(filename,'rb') as f:
+            if f.read(len(TEMPLATE_MAGIC))!=TEMPLATE_MAGIC:
+                return None
+            nhead=int(np.frombuffer(f.read(8),dtype='<u8')[0])
+            header=json.loads(f.read(nhead).decode())
+    except:
+        return None
+
+    if header.get('format')!=TEMPLATE_FORMAT:
+        return None
+
+    start=len(TEMPLATE_MAGIC)+8+nhead
+    arrays={}
+    for k in header['arrays']:
+        desc=header['arrays'][k]
+        nbytes=int(np.prod(desc['shape']))*np.dtype(desc['dtype']).itemsize
+        if start+desc['offset']+nbytes>size:
+            return None
+    for k in header['arrays']:
+        desc=header['arrays'][k]
+        if np.prod(desc['shape'])==0:
+            arrays[k]=np.zeros(desc['shape'],dtype=desc['dtype'])
+        else:
+            arrays[k]=np.memmap(filename,dtype=desc['dtype'],mode='r',
+                                offset=start+desc['offset'],shape=tuple(desc['shape']))
+    return header,arrays
@@ -0,0 +1,84 @@
+import numpy as np
+# test the batched masked means (masked_means, masked_cross_mean) against the
+# per-tensor formula of masked_mean, and run one use_2D eval
+nside=16
+npix=12*nside**2
+np.random.seed(1234)
+
+import foscat.scat_cov as sc
+op=sc.funct(all_type='float64')
+bk=op.backend
+
+mask=(np.random.rand(2,npix)>0.3).astype('float64')
+xr=np.random.randn(2,npix,4)
+xc=np.random.randn(2,npix,4)+0.3J*np.random.randn(2,npix,4)
+
+# reference : x [Nbatch,Npix,...] and mask [Nmask,Npix] to [Nbatch,Nmask,...]
+# (bk_sqrt is the square root of the absolute value)
+def ref_mean(x,calc_var=False):
+    vh=np.sum(mask,1)[None,:,None]
+    v1=np.einsum('mp,bpr->bmr',mask,x)
+    v2=np.einsum('mp,bpr->bmr',mask,x*x)
+    res=v1/vh
+    if not calc_var:
+        return res
+    if np.iscomplexobj(x):
+        return res,np.sqrt(np.abs((v2.real/vh-res.real**2)/v2.real))+1J*np.sqrt(np.abs((v2.imag/vh-res.imag**2)/v2.real))
+    return res,np.sqrt(np.abs((v2/vh-res*res)/vh))
+
+def diff(a,b):
+    return np.max(np.abs(np.array(a)-b))/np.max(np.abs(b))
+
+tmask=bk.bk_cast(mask)
+tr=bk.bk_cast(xr)
+tc=bk.bk_complex(bk.bk_cast(xc.real),bk.bk_cast(xc.imag))
+
+test=0.0
+mr,mc=op.masked_means([tr,tc],tmask)
+test=max(test,diff(mr,ref_mean(xr)),diff(mc,ref_mean(xc)))
+print('masked_means',test)
+
+(mr,vr),(mc,vc)=op.masked_means([tr,tc],tmask,calc_var=True)
+rmr,rvr=ref_mean(xr,calc_var=True)
+rmc,rvc=ref_mean(xc,calc_var=True)
+test=max(test,diff(mr,rmr),diff(vr,rvr),diff(mc,rmc),diff(vc,rvc))
+print('masked_means calc_var',test)
+
+# masked_mean of one tensor
+test=max(test,diff(op.masked_mean(tc,tmask,axis=1),ref_mean(xc)))
+print('masked_mean',test)
+
+# x [Nbatch,Npix,K,A], y [Nbatch,Npix,K,C] to mean(x conj(y)) [Nbatch,Nmask,K,C,A]
+x=np.random.randn(2,npix,4,3)+1J*np.random.randn(2,npix,4,3)
+y=np.random.randn(2,npix,4,5)+1J*np.random.randn(2,npix,4,5)
+ref=np.einsum('mp,bpka,bpkc->bmkca',mask,x,np.conj(y))/np.sum(mask,1)[None,:,None,None,None]
+tx=bk.bk_complex(bk.bk_cast(x.real),bk.bk_cast(x.imag))
+ty=bk.bk_complex(bk.bk_cast(y.real),bk.bk_cast(y.imag))
+test=max(test,diff(op.masked_cross_mean(tx,ty,tmask),ref))
+print('masked_cross_mean',test)
+
+# test scat_cov2D : the 2D masks [Nmask,X,Y] go through the per-tensor masked_mean
+import foscat.scat_cov2D as sc2d
+op2d=sc2d.funct(KERNELSZ=3,all_type='float64')
+op2db=sc2d.funct(KERNELSZ=3,all_type='float64',batch_C11=True)
+
+im=np.random.randn(32,32)
+im2=np.random.randn(32,32)
+mask2d=np.ones([2,32,32])
+mask2d[1,:16]=0.0
+
+a=op2d.eval(im,image2=im2,mask=mask2d)
+b=op2db.eval(im,image2=im2,mask=mask2d)
+test2d=0.0
+for k in ['S0','P00','S1','C01','C10','C11']:
+    va=np.array(getattr(a,k))
+    vb=np.array(getattr(b,k))
+    if not np.all(np.isfinite(va)):
+        test2d=np.inf
+    test2d=max(test2d,np.max(np.abs(va-vb))/np.max(np.abs(va)))
+print('scat_cov2D',a.C11.shape,test2d)
+
+if not (test<1E-10 and test2d<1E-10):
+    print('T016 FAILED')
+    exit(1)
+print('T016 OK')
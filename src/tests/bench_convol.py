@@ -0,0 +1,61 @@
+import numpy as np
+import sys
+import time
+import foscat.FoCUS as FOC
+
+# Benchmark of the HEALPix convolution engines of FoCUS:
+#   sparse : sparse operator [NORIENT*Npix,Npix] and sparse-dense product
+#   gather : int32 neighbour table [Npix,K^2], gather and einsum
+# For each engine the time to build the operator (templates are computed before),
+# the time of a convolution of a real map and of a complex [Npix,NORIENT] map,
+# and the difference between the two engines are given.
+#
+# usage : python bench_convol.py [BACKEND] [KERNELSZ] [nside ...]
+
+BACKEND='tensorflow'
+if len(sys.argv)>1:
+    BACKEND=sys.argv[1]
+KERNELSZ=5
+if len(sys.argv)>2:
+    KERNELSZ=int(sys.argv[2])
+nsides=[64,128,256,512,1024]
+if len(sys.argv)>3:
+    nsides=[int(v) for v in sys.argv[3:]]
+NREPEAT=5
+
+def to_numpy(x):
+    if hasattr(x,'numpy'):
+        return x.numpy()
+    return np.asarray(x)
+
+def chrono(op,x):
+    op.convol(x)
+    t0=time.time()
+    for k in range(NREPEAT):
+        res=op.convol(x)
+    return (time.time()-t0)/NREPEAT,res
+
+for NORIENT in [4,8]:
+    for nside in nsides:
+        npix=12*nside*nside
+        # compute the template once, outside of the timings
+        FOC.FoCUS(BACKEND=BACKEND,KERNELSZ=KERNELSZ,NORIENT=NORIENT,silent=True).init_wave(nside)
+
+        xr=np.random.randn(npix)
+        xc=np.random.randn(npix,NORIENT)+1j*np.random.randn(npix,NORIENT)
+
+        res={}
+        for engine in ['sparse','gather']:
+            op=FOC.FoCUS(BACKEND=BACKEND,KERNELSZ=KERNELSZ,NORIENT=NORIENT,silent=True,conv_engine=engine)
+            t0=time.time()
+            op.init_wave(nside)
+            t_init=time.time()-t0
+            t_real,r1=chrono(op,op.backend.bk_cast(xr))
+            t_cplx,r2=chrono(op,op.backend.bk_cast(xc))
+            res[engine]=(to_numpy(r1),to_numpy(r2))
+            print('NORIENT=%d nside=%5d %-6s init %8.3fs real %8.4fs complex %8.4fs'%(NORIENT,nside,engine,t_init,t_real,t_cplx))
+            del op
+
+        diff=max([np.max(abs(res['sparse'][k]-res['gather'][k]))/np.max(abs(res['sparse'][k])) for k in range(2)])
+        print('NORIENT=%d nside=%5d relative difference %.3g'%(NORIENT,nside,diff))
+        sys.stdout.flush()
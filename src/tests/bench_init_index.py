@@ -0,0 +1,113 @@
+import numpy as np
+import healpy as hp
+import sys
+import time
+import foscat.FoCUS as FOC
+
+# Benchmark of the HEALPix kernel precomputation (FoCUS.init_index).
+# The historical one pixel at a time loop is timed on a subset of pixels and
+# extrapolated to the full map, the vectorized builder is timed on the full map
+# when it fits in the time budget, and both results are compared on the subset.
+#
+# usage : python bench_init_index.py [KERNELSZ] [nside ...]
+
+def legacy_comp_wave(nside,l_kernel,norient,pix):
+    aa=np.cos(np.arange(norient)/norient*np.pi).reshape(1,norient)
+    bb=np.sin(np.arange(norient)/norient*np.pi).reshape(1,norient)
+    x,y,z=hp.pix2vec(nside,np.arange(12*nside*nside),nest=True)
+    to,po=hp.pix2ang(nside,np.arange(12*nside*nside),nest=True)
+
+    wav=np.zeros([pix.shape[0],l_kernel**2,norient],dtype='complex')
+    wwav=np.zeros([pix.shape[0],l_kernel**2])
+    iwav=np.zeros([pix.shape[0],l_kernel**2],dtype='int')
+
+    scale=4
+    if nside>scale*2:
+        th,ph=hp.pix2ang(nside//scale,np.arange(12*(nside//scale)**2),nest=True)
+    else:
+        lidx=np.arange(12*nside*nside)
+
+    pw=np.pi/4.0
+    pw2=1/2.0
+    if l_kernel==3:
+        pw=1.0
+        pw2=1.0
+    elif l_kernel==7:
+        pw=np.pi/4.0
+        pw2=1.0/3.0
+
+    t0=time.time()
+    for i,k in enumerate(pix):
+        if nside>scale*2:
+            lidx=hp.get_all_neighbours(nside//scale,th[k//(scale*scale)],ph[k//(scale*scale)],nest=True)
+            lidx=np.concatenate([lidx,np.array([(k//(scale*scale))])],0)
+            lidx=np.repeat(lidx*(scale*scale),(scale*scale))+ \
+                  np.tile(np.arange((scale*scale)),lidx.shape[0])
+
+        delta=(x[lidx]-x[k])**2+(y[lidx]-y[k])**2+(z[lidx]-z[k])**2
+        pidx=np.where(delta<(10)/(nside**2))[0]
+        if len(pidx)<l_kernel**2:
+            pidx=np.arange(delta.shape[0])
+
+        w=np.exp(-pw2*delta[pidx]*(nside**2))
+        pidx=pidx[np.argsort(-w)[0:l_kernel**2]]
+        pidx=pidx[np.argsort(lidx[pidx])]
+
+        w=np.exp(-pw2*delta[pidx]*(nside**2))
+        iwav[i]=lidx[pidx]
+        wwav[i]=w
+        rot=[po[k]/np.pi*180.0,90+(-to[k])/np.pi*180.0]
+        r=hp.Rotator(rot=rot)
+        ty,tx=r(to[iwav[i]],po[iwav[i]])
+        ty=ty-np.pi/2
+
+        xx=np.expand_dims(pw*nside*np.pi*tx/np.cos(ty),-1)
+        yy=np.expand_dims(pw*nside*np.pi*ty,-1)
+
+        wav[i,:,:]=(np.cos(xx*aa+yy*bb)+complex(0.0,1.0)*np.sin(xx*aa+yy*bb))*np.expand_dims(w,-1)
+
+    wav=wav-np.expand_dims(np.mean(wav,1),1)
+    wav=wav/np.expand_dims(np.std(wav,1),1)
+    wwav=wwav/np.expand_dims(np.sum(wwav,1),1)
+    return iwav,wwav,wav,time.time()-t0
+
+KERNELSZ=5
+NORIENT=4
+if len(sys.argv)>1:
+    KERNELSZ=int(sys.argv[1])
+nsides=[64,256,1024]
+if len(sys.argv)>2:
+    nsides=[int(v) for v in sys.argv[2:]]
+
+nsub=2048
+for nside in nsides:
+    npix=12*nside*nside
+    pix0=npix//3
+    pix=np.arange(pix0,min(pix0+nsub,npix))
+
+    iwav,wwav,wav,dt_old=legacy_comp_wave(nside,KERNELSZ,NORIENT,pix)
+    t_old=dt_old*npix/pix.shape[0]
+
+    t0=time.time()
+    n_iwav,n_wwav,n_wav=FOC.comp_wave_chunk(nside,KERNELSZ,NORIENT,pix[0],pix[-1]+1)
+    dt_new=time.time()-t0
+
+    print('nside=%5d check iwav %s wwav %s wav %s (max diff %.3g)'%(nside,
+                                                                   np.array_equal(iwav,n_iwav),
+                                                                   np.array_equal(wwav,n_wwav),
+                                                                   np.array_equal(wav,n_wav),
+                                                                   np.max(abs(wav-n_wav))))
+
+    if npix<=12*256*256:
+        t0=time.time()
+        nchunk=(1<<22)//max(144,NORIENT*KERNELSZ**2)
+        for k in range(0,npix,nchunk):
+            FOC.comp_wave_chunk(nside,KERNELSZ,NORIENT,k,min(k+nchunk,npix))
+        t_new=time.time()-t0
+        mode='measured'
+    else:
+        t_new=dt_new*npix/pix.shape[0]
+        mode='extrapolated'
+
+    print('nside=%5d legacy %10.1fs (extrapolated) vectorized %8.2fs (%s) speed-up %.1f'%(nside,t_old,t_new,mode,t_old/t_new))
+    sys.stdout.flush()